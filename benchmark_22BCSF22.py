@@ -0,0 +1,263 @@
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import main_22BCSF22 as his
+
+
+#Lines written to the dataset file at once while generating
+GENERATE_BLOCK_ROWS = 100000
+#Year and month of the date queries; visits are six months apart from 2000-01-01, so the fourth visit
+#of every patient with one falls on 2001-06-30
+QUERY_YEAR, QUERY_MONTH = 2001, 6
+
+
+def generateSyntheticDataset(fileName, rows, patients=None, skew=1.0, invalidRatio=0.0, seed=0):
+    """
+    Writes a synthetic patient file in the patientId,date,temp,hr,rr,sbp,dbp,spo2 format.
+
+    fileName: The name of the file to write.
+    rows: The number of lines to write.
+    patients: The number of patients. If None, one patient per 10 rows is used.
+    skew: How unevenly the visits are spread over the patients; the patient of rank r gets a share
+          proportional to 1 / r ** skew, so 0 gives every patient the same number of visits.
+    invalidRatio: The fraction of lines that are made invalid (out of range, missing fields, bad number or bad date).
+    seed: The seed of the random generator, so the same arguments always give the same file.
+    return: The number of patients written.
+    Visits of a patient are written together, every six months from 2000-01-01, like patients.txt.
+    """
+    generator = random.Random(seed)
+    patients = patients or max(rows // 10, 1)
+    weights = [1 / rank ** skew for rank in range(1, patients + 1)]
+    total = sum(weights)
+    counts = [int(rows * weight / total) for weight in weights]
+    #Handing out the rows lost to rounding to the biggest patients
+    for i in range(rows - sum(counts)):
+        counts[i % patients] += 1
+
+    start = datetime.date(2000, 1, 1).toordinal()
+    block = []
+    written = 0
+    with open(fileName, 'w') as file:
+        for patient_id, count in enumerate(counts, 1):
+            for visit in range(count):
+                day = datetime.date.fromordinal(start + (visit * 182) % 2920000).isoformat()
+                if generator.random() < invalidRatio:
+                    line = _invalidLine(generator, patient_id, day)
+                else:
+                    line = (f"{patient_id},{day},{min(max(round(generator.gauss(37.1, 0.4), 1), 35.0), 42.0)},"
+                            f"{generator.randint(55, 110)},{generator.randint(12, 24)},{generator.randint(95, 160)},"
+                            f"{generator.randint(60, 100)},{generator.randint(85, 100)}")
+                block.append(line)
+                if len(block) >= GENERATE_BLOCK_ROWS:
+                    file.write(("\n" if written else "") + "\n".join(block))
+                    written += len(block)
+                    block = []
+        if block:
+            file.write(("\n" if written else "") + "\n".join(block))
+    return patients
+
+
+def _invalidLine(generator, patientId, day):
+    #One of the kinds of lines readPatientsFromFile rejects
+    kind = generator.randrange(4)
+    if kind == 0:
+        return f"{patientId},{day},45.0,70,18,120,80,95"
+    if kind == 1:
+        return f"{patientId},{day},37.0,70,18,120,80"
+    if kind == 2:
+        return f"{patientId},{day},37.0,seventy,18,120,80,95"
+    return f"{patientId},2023-02-30,37.0,70,18,120,80,95"
+
+#--- end of generatesyntheticdataset ---#
+
+
+def _timed(function, repeat):
+    #Best wall time of running the function repeat times, with its output discarded
+    best = None
+    result = None
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = function()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def _benchmarkSize(rows, patients, skew, invalidRatio, workdir, repeat, writes):
+    #Benchmarks every public function on one generated dataset; runs in its own process so peak RSS is per size
+    fileName = os.path.join(workdir, f"bench_{rows}.txt")
+    patient_count = generateSyntheticDataset(fileName, rows, patients, skew, invalidRatio)
+    operations = {}
+
+    def record(name, seconds, items):
+        operations[name] = {'seconds': seconds, 'itemsPerSecond': items / seconds if seconds else None, 'items': items}
+
+    his.useSnapshots = False
+    seconds, store = _timed(lambda: his.readPatientsFromFile(fileName), repeat)
+    record('readPatientsFromFile', seconds, rows)
+
+    his.useSnapshots = True
+    #The first read writes the snapshot the timed reads load
+    _timed(lambda: his.readPatientsFromFile(fileName), 1)
+    seconds, _ = _timed(lambda: his.readPatientsFromFile(fileName), repeat)
+    record('readPatientsFromFile (snapshot)', seconds, rows)
+
+    visits = store.visitCount()
+    seconds, _ = _timed(lambda: his.displayStats(store, 0), repeat)
+    record('displayStats', seconds, visits)
+    seconds, _ = _timed(lambda: his.computeStats(store), repeat)
+    record('computeStats', seconds, visits)
+    #The date queries go through the index, so their items are the visits found rather than all visits
+    seconds, found = _timed(lambda: his.findVisitsByDate(store, QUERY_YEAR, QUERY_MONTH), repeat)
+    record('findVisitsByDate (year and month)', seconds, len(found))
+    seconds, found = _timed(lambda: his.findVisitsByDate(store, None, QUERY_MONTH), repeat)
+    record('findVisitsByDate (month)', seconds, len(found))
+
+    def followUp():
+        store._followUpCache.clear()
+        return his.findPatientsWhoNeedFollowUp(store)
+    seconds, _ = _timed(followUp, repeat)
+    record('findPatientsWhoNeedFollowUp', seconds, visits)
+
+    #Writes go to a copy so every size starts from the same file
+    copy = fileName + '.write'
+    shutil.copyfile(fileName, copy)
+    his.useSnapshots = False
+    _, writable = _timed(lambda: his.readPatientsFromFile(copy), 1)
+    seconds, _ = _timed(lambda: [his.addPatientData(writable, 1, '2030-1-1', 37, 70, 18, 120, 80, 95, copy)
+                                 for _ in range(writes)], 1)
+    record('addPatientData', seconds, writes)
+    batch = [(1, '2030-1-1', 37, 70, 18, 120, 80, 95)] * writes
+    seconds, _ = _timed(lambda: his.addPatientDataBatch(writable, batch, copy, 'never'), 1)
+    record('addPatientDataBatch', seconds, writes)
+    deletes = [patient_id for patient_id in range(2, patient_count + 1) if patient_id in writable][:writes]
+    seconds, _ = _timed(lambda: [his.deleteAllVisitsOfPatient(writable, patient_id, copy) for patient_id in deletes], 1)
+    record('deleteAllVisitsOfPatient', seconds, len(deletes))
+    if his._compactionThread is not None:
+        his._compactionThread.join()
+
+    #ru_maxrss is in kilobytes on Linux and in bytes on macOS. The children are the parse workers of
+    #parallel loads, which have all exited by now; their peak is added since they run next to this process
+    unit = 1024 if sys.platform == 'darwin' else 1
+    own_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // unit
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // unit
+    result = {'rows': rows, 'patients': patient_count, 'fileBytes': os.path.getsize(fileName),
+              'operations': operations, 'peakRssKb': own_rss + child_rss,
+              'peakRssSelfKb': own_rss, 'peakRssChildrenKb': child_rss}
+    for name in (fileName, copy):
+        for path in (name, name + his.SNAPSHOT_SUFFIX, name + '.lock'):
+            if os.path.exists(path):
+                os.remove(path)
+    return result
+
+
+def runBenchmarks(sizes, outFile=None, patients=None, skew=1.0, invalidRatio=0.01, repeat=3, writes=100, workdir=None):
+    """
+    Generates a dataset of every size and times the public functions on it.
+
+    sizes: The numbers of rows to benchmark, e.g. [10 ** 3, 10 ** 4, 10 ** 5].
+    outFile: If given, the results are saved to this JSON file.
+    patients, skew, invalidRatio: Passed to generateSyntheticDataset; patients None means rows / 10.
+    repeat: Read operations are run this many times and the best time is kept.
+    writes: The number of visits added and patients deleted by the write benchmarks.
+    workdir: Directory for the generated files. If None, a temporary directory is used.
+    return: The results, as saved to outFile.
+    Each size runs in a fresh process, so peakRssKb is the peak memory of that size alone: the peak of
+    the process plus the biggest peak of its parse workers (peakRssSelfKb and peakRssChildrenKb).
+    """
+    results = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(), 'platform': platform.platform(),
+               'cpuCount': os.cpu_count(), 'skew': skew, 'invalidRatio': invalidRatio, 'sizes': []}
+    with tempfile.TemporaryDirectory(dir=workdir) as directory:
+        for rows in sizes:
+            with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+                size_result = pool.apply(_benchmarkSize, (rows, patients, skew, invalidRatio, directory, repeat, writes))
+            results['sizes'].append(size_result)
+            printBenchmark(size_result)
+    if outFile:
+        with open(outFile, 'w') as file:
+            json.dump(results, file, indent=2)
+    return results
+
+
+def printBenchmark(sizeResult, previous=None):
+    """
+    Prints the timings of one size, and the change against a previous run of the same size when given.
+    """
+    print(f"{sizeResult['rows']} rows, {sizeResult['patients']} patients, {sizeResult['fileBytes']} bytes, "
+          f"peak RSS {sizeResult['peakRssKb'] / 1024:.1f} MB"
+          + (f" ({sizeResult['peakRssChildrenKb'] / 1024:.1f} MB in workers)" if sizeResult.get('peakRssChildrenKb') else ""))
+    for name, timing in sizeResult['operations'].items():
+        line = f"  {name:<36} {timing['seconds'] * 1000:>12.3f} ms"
+        if timing['itemsPerSecond']:
+            line += f" {timing['itemsPerSecond']:>16,.0f} items/s"
+        if previous and name in previous['operations'] and previous['operations'][name]['seconds']:
+            line += f"  x{previous['operations'][name]['seconds'] / timing['seconds']:.2f} vs previous" if timing['seconds'] else ""
+        print(line)
+
+
+def compareBenchmarks(previousFile, currentFile):
+    """
+    Prints two saved benchmark runs side by side, as speedups of the current run over the previous one.
+    """
+    with open(previousFile) as file:
+        previous = {size['rows']: size for size in json.load(file)['sizes']}
+    with open(currentFile) as file:
+        current = json.load(file)
+    for size in current['sizes']:
+        printBenchmark(size, previous.get(size['rows']))
+
+#--- end of runbenchmarks ---#
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Synthetic data generator and benchmarks for main_22BCSF22.py")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('generate', help="write a synthetic patient file")
+    command.add_argument('output')
+    command.add_argument('--rows', type=lambda text: int(float(text)), default=1000)
+    command.add_argument('--patients', type=int)
+    command.add_argument('--skew', type=float, default=1.0)
+    command.add_argument('--invalid-ratio', type=float, default=0.0)
+    command.add_argument('--seed', type=int, default=0)
+
+    command = commands.add_parser('run', help="benchmark the public functions")
+    command.add_argument('--sizes', default='1e3,1e4,1e5', help="comma separated row counts (default: 1e3,1e4,1e5)")
+    command.add_argument('--output', help="save the results to this JSON file")
+    command.add_argument('--patients', type=int)
+    command.add_argument('--skew', type=float, default=1.0)
+    command.add_argument('--invalid-ratio', type=float, default=0.01)
+    command.add_argument('--repeat', type=int, default=3)
+    command.add_argument('--writes', type=int, default=100)
+    command.add_argument('--workdir')
+
+    command = commands.add_parser('compare', help="compare two saved benchmark runs")
+    command.add_argument('previous')
+    command.add_argument('current')
+
+    args = parser.parse_args(argv)
+    if args.command == 'generate':
+        generateSyntheticDataset(args.output, args.rows, args.patients, args.skew, args.invalid_ratio, args.seed)
+    elif args.command == 'run':
+        sizes = [int(float(size)) for size in args.sizes.split(',')]
+        runBenchmarks(sizes, args.output, args.patients, args.skew, args.invalid_ratio, args.repeat, args.writes, args.workdir)
+    else:
+        compareBenchmarks(args.previous, args.current)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,600 @@
 from typing import List, Dict, Optional
+from array import array
+from collections import Counter, deque
+from collections.abc import Mapping, Sequence
+import argparse
+import asyncio
+import atexit
+import bisect
+import concurrent.futures
+import contextlib
+import cProfile
+import datetime
+import functools
+import heapq
+import http
+import io
+import itertools
+import json
+import math
+import mmap
+import operator
+import os
+import pstats
+import shlex
+import shutil
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.parse
+import zlib
+try:
+    import fcntl
+except ImportError:
+    #Advisory file locks are only available on Unix; elsewhere only threads are synchronised
+    fcntl = None
+
+
+#Names of the vital sign columns, in the same order as they appear in a visit
+VITAL_NAMES = ('temperature', 'heart_rate', 'respiratory_rate', 'systolic_bp', 'diastolic_bp', 'oxygen_saturation')
+
+
+def parseVisitDate(date):
+    """
+    Converts a visit date into a day number.
+
+    date: The date of the visit in the format 'yyyy-mm-dd'.
+    return: The proleptic Gregorian ordinal of the date (1 for 0001-01-01).
+    Raises ValueError if the date is malformed or is not a real calendar date.
+    """
+    year, month, day = date.split('-')
+    return datetime.date(int(year), int(month), int(day)).toordinal()
+
+
+def formatVisitDate(dayNumber):
+    """
+    Converts a day number produced by parseVisitDate back into a 'yyyy-mm-dd' string.
+    """
+    return datetime.date.fromordinal(dayNumber).isoformat()
+
+
+class RunningAggregate:
+    """
+    Running count, mean and sum of squared deviations (Welford) of the six vital signs.
+
+    Aggregates can be merged and subtracted, so the contribution of one patient can be
+    added to or removed from a total without going over the visits again.
+    """
+    __slots__ = ('count', 'means', 'm2')
+
+    def __init__(self, count=0, means=None, m2=None):
+        self.count = count
+        self.means = list(means) if means is not None else [0.0] * len(VITAL_NAMES)
+        self.m2 = list(m2) if m2 is not None else [0.0] * len(VITAL_NAMES)
+
+    @classmethod
+    def fromColumns(cls, columns):
+        """
+        Builds an aggregate from one array of values per vital sign, using C level sums over the arrays.
+        """
+        count = len(columns[0])
+        if count == 0:
+            return cls()
+        means = []
+        m2 = []
+        for values in columns:
+            mean = math.fsum(values) / count
+            means.append(mean)
+            m2.append(max(math.fsum(map(operator.mul, values, values)) - count * mean * mean, 0.0))
+        return cls(count, means, m2)
+
+    def copy(self):
+        return RunningAggregate(self.count, self.means, self.m2)
+
+    def variances(self):
+        """
+        Returns the population variance of each vital sign, or None values when there is no data.
+        """
+        if self.count == 0:
+            return [None] * len(VITAL_NAMES)
+        return [m2 / self.count for m2 in self.m2]
+
+    def add(self, values):
+        """
+        Adds one visit, given as the six vital sign values in the order of VITAL_NAMES.
+        """
+        self.count += 1
+        for i, value in enumerate(values):
+            delta = value - self.means[i]
+            self.means[i] += delta / self.count
+            self.m2[i] += delta * (value - self.means[i])
+
+    def merge(self, other):
+        """
+        Adds all the visits summarised by another aggregate.
+        """
+        if other.count == 0:
+            return
+        total = self.count + other.count
+        for i in range(len(VITAL_NAMES)):
+            delta = other.means[i] - self.means[i]
+            self.means[i] += delta * other.count / total
+            self.m2[i] += other.m2[i] + delta * delta * self.count * other.count / total
+        self.count = total
+
+    def subtract(self, other):
+        """
+        Removes the visits summarised by another aggregate, which must be a part of this one.
+        """
+        remaining = self.count - other.count
+        if remaining <= 0:
+            self.count = 0
+            self.means = [0.0] * len(VITAL_NAMES)
+            self.m2 = [0.0] * len(VITAL_NAMES)
+            return
+        for i in range(len(VITAL_NAMES)):
+            mean = (self.count * self.means[i] - other.count * other.means[i]) / remaining
+            delta = other.means[i] - mean
+            self.m2[i] = max(self.m2[i] - other.m2[i] - delta * delta * remaining * other.count / self.count, 0.0)
+            self.means[i] = mean
+        self.count = remaining
+
+#--- end of runningaggregate ---#
+
+
+class PatientVisits(Sequence):
+    """
+    Read-only view of the visits of one patient inside a VisitStore.
+
+    Each item is a visit list [date (str), temperature (float), heart rate (int), respiratory rate (int),
+    systolic blood pressure (int), diastolic blood pressure (int), oxygen saturation (int)], built on demand
+    from the store columns, so the view behaves like the list of visits returned by the old dictionary.
+    """
+    __slots__ = ('_store', '_ranges')
+
+    def __init__(self, store, ranges):
+        self._store = store
+        self._ranges = ranges
+
+    def rows(self):
+        """
+        Yields the store row numbers of the visits, in visit order.
+        """
+        for start, stop in self._ranges:
+            yield from range(start, stop)
+
+    def __len__(self):
+        return sum(stop - start for start, stop in self._ranges)
+
+    def __iter__(self):
+        visit = self._store._visit
+        for row in self.rows():
+            yield visit(row)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index >= 0:
+            for start, stop in self._ranges:
+                if index < stop - start:
+                    return self._store._visit(start + index)
+                index -= stop - start
+        raise IndexError("visit index out of range")
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class VisitStore(Mapping):
+    """
+    Columnar storage for patient visits.
+
+    Every vital sign is kept in its own typed array, dates are kept as int32 day numbers and a
+    patientId -> row ranges index gives the rows of each patient. The store is a read-only mapping of
+    patientId -> PatientVisits, so it can be used anywhere the old dictionary of visit lists was used.
+    Data is changed only through appendVisit and deletePatient.
+    """
+
+    #Shared by all stores; only held while the date index is built or merged
+    _dateIndexLock = threading.Lock()
+
+    def __init__(self):
+        #One entry per row, in insertion order
+        self._pids = array('q')
+        self._days = array('i')
+        self._temps = array('d')
+        self._heartRates = array('h')
+        self._respiratoryRates = array('h')
+        self._systolicBps = array('h')
+        self._diastolicBps = array('h')
+        self._oxygenSaturations = array('h')
+        #1 for rows of a patient that is still stored, 0 for rows of deleted patients
+        self._live = bytearray()
+        #patientId -> list of [start, stop) row ranges, in visit order
+        self._index = {}
+        self._deadRows = 0
+        self._extraRanges = 0
+        #Running aggregates, built on first use and then kept up to date by appendVisit and deletePatient
+        self._totalAggregate = None
+        self._patientAggregates = None
+        #value -> count of every vital sign column over the stored visits, for the percentiles of computeStats;
+        #built on first use and then kept up to date like the running aggregates
+        self._valueCounts = None
+        #Date index: day numbers in ascending order and the row of each entry, built on first date query
+        self._dateDays = None
+        self._dateRows = None
+        #Rows appended out of date order since the last date query, merged into the date index by the next one
+        self._datePending = array('q')
+        #Counts of the lines read and rejected, set by readPatientsFromFile
+        self.loadReport = None
+        #Follow-up rule key -> {patientId: needs follow-up}, entries are dropped when the patient changes
+        self._followUpCache = {}
+        #Trend window -> {patientId: trends of computeTrends}, entries are dropped when the patient changes
+        self._trendCache = {}
+        #Absolute name, generation and size of the file the store has read up to, set by readPatientsFromFile
+        self._sourceFile = None
+        self._sourceGeneration = None
+        self._sourceSize = None
+
+    @classmethod
+    def fromPatients(cls, patients):
+        """
+        Builds a store from a dictionary of patient IDs, where each patient has a list of visits.
+        """
+        store = cls()
+        for patient_id, visits in patients.items():
+            for visit in visits:
+                store.appendVisit(patient_id, *visit)
+        return store
+
+    def columns(self):
+        """
+        Returns the six vital sign columns, in the order of VITAL_NAMES.
+        """
+        return (self._temps, self._heartRates, self._respiratoryRates,
+                self._systolicBps, self._diastolicBps, self._oxygenSaturations)
+
+    def ranges(self, patientId=None):
+        """
+        Returns the [start, stop) row ranges of one patient, or of all stored patients in patient order.
+        """
+        if patientId is not None:
+            return self._index[patientId]
+        if self._deadRows == 0 and self._extraRanges == 0:
+            #Compact store: the patient ranges follow each other without gaps
+            return [[0, len(self._days)]] if self._days else []
+        return [rng for ranges in self._index.values() for rng in ranges]
+
+    def gather(self, column, ranges):
+        """
+        Returns the values of a column for the given row ranges, without copying when a single range covers the column.
+        """
+        if len(ranges) == 1 and ranges[0][0] == 0 and ranges[0][1] == len(column):
+            return column
+        values = array(column.typecode)
+        for start, stop in ranges:
+            values.extend(column[start:stop])
+        return values
+
+    def aggregate(self, patientId=None):
+        """
+        Returns the RunningAggregate of one patient, or of all patients when patientId is None.
+        The aggregates are built once from the columns and are then updated in O(1) per change.
+        Raises KeyError if the patient is not found.
+        """
+        if self._patientAggregates is None:
+            columns = self.columns()
+            patient_aggregates = {
+                patient_id: RunningAggregate.fromColumns([self.gather(column, ranges) for column in columns])
+                for patient_id, ranges in self._index.items()}
+            total = RunningAggregate()
+            for patient_aggregate in patient_aggregates.values():
+                total.merge(patient_aggregate)
+            #Setting the total first, so a concurrent reader never sees the patient aggregates without it
+            self._totalAggregate = total
+            self._patientAggregates = patient_aggregates
+        if patientId is None:
+            return self._totalAggregate
+        return self._patientAggregates[patientId]
+
+    def valueCounts(self):
+        """
+        Returns a Counter of the values of each vital sign column over all stored visits, in the order of VITAL_NAMES.
+        The counts are built once from the columns and are then updated in O(1) per added visit.
+        """
+        if self._valueCounts is None:
+            ranges = self.ranges()
+            self._valueCounts = [Counter(self.gather(column, ranges)) for column in self.columns()]
+        return self._valueCounts
+
+    def _dateIndex(self):
+        #The date index, built or brought up to date under a lock so concurrent readers never see it half merged
+        with self._dateIndexLock:
+            if self._dateDays is None:
+                self._buildDateIndex()
+            elif self._datePending:
+                self._mergePendingDates()
+            return self._dateDays, self._dateRows
+
+    def _buildDateIndex(self):
+        #Counting sort of the live rows by day: only the distinct days are sorted, and the rows are placed
+        #straight into a typed array, in row order within a day
+        days = self._days
+        counts = Counter(itertools.compress(days, self._live))
+        date_days = array('i')
+        starts = {}
+        for day in sorted(counts):
+            starts[day] = len(date_days)
+            date_days.extend(array('i', (day,)) * counts[day])
+        date_rows = array('q', bytes(8 * len(date_days)))
+        for row, day in itertools.compress(enumerate(days), self._live):
+            position = starts[day]
+            date_rows[position] = row
+            starts[day] = position + 1
+        self._dateRows = date_rows
+        self._dateDays = date_days
+        self._datePending = array('q')
+
+    def _mergePendingDates(self):
+        #Merging the rows appended out of date order in one pass, copying the index between them in slices
+        days = self._days
+        pending = sorted(self._datePending, key=lambda row: (days[row], row))
+        date_days = array('i')
+        date_rows = array('q')
+        previous = 0
+        for row in pending:
+            position = bisect.bisect_right(self._dateDays, days[row], previous)
+            date_days.extend(self._dateDays[previous:position])
+            date_rows.extend(self._dateRows[previous:position])
+            date_days.append(days[row])
+            date_rows.append(row)
+            previous = position
+        date_days.extend(self._dateDays[previous:])
+        date_rows.extend(self._dateRows[previous:])
+        self._dateRows = date_rows
+        self._dateDays = date_days
+        self._datePending = array('q')
+
+    def rowsBetweenDays(self, firstDay, lastDay):
+        """
+        Returns the rows of the visits whose day number is in [firstDay, lastDay], in date order.
+        The lookup uses a sorted date index, so it takes O(log n + k) for k matching visits.
+        """
+        date_days, date_rows = self._dateIndex()
+        low = bisect.bisect_left(date_days, firstDay)
+        high = bisect.bisect_right(date_days, lastDay, low)
+        rows = date_rows[low:high]
+        if self._deadRows:
+            #Skipping entries of deleted patients, which stay in the index until the next compaction
+            live = self._live
+            return [row for row in rows if live[row]]
+        return rows
+
+    def dayRange(self):
+        """
+        Returns the first and last day number of the stored visits, or None when the store is empty.
+        """
+        date_days, _ = self._dateIndex()
+        if not date_days:
+            return None
+        return date_days[0], date_days[-1]
+
+    def _visit(self, row):
+        return [formatVisitDate(self._days[row]), self._temps[row], self._heartRates[row],
+                self._respiratoryRates[row], self._systolicBps[row], self._diastolicBps[row],
+                self._oxygenSaturations[row]]
+
+    def __getitem__(self, patientId):
+        return PatientVisits(self, self._index[patientId])
+
+    def __contains__(self, patientId):
+        return patientId in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __repr__(self):
+        return f"VisitStore({len(self._index)} patients, {self.visitCount()} visits)"
+
+    def visitCount(self):
+        """
+        Returns the number of visits of all patients that are still stored.
+        """
+        return len(self._days) - self._deadRows
+
+    def appendVisit(self, patientId, date, temp, hr, rr, sbp, dbp, spo2):
+        """
+        Appends one visit for a patient.
+
+        date: The date of the visit, either as 'yyyy-mm-dd' or as a day number from parseVisitDate.
+        The other arguments are the vital signs of the visit; values are not range checked here.
+        Raises ValueError if the date is invalid or a value, the patient ID included, does not fit its column.
+        """
+        day = parseVisitDate(date) if isinstance(date, str) else int(date)
+        row = len(self._days)
+        #Appending the day first so a bad date leaves the columns untouched
+        self._days.append(day)
+        try:
+            #A patient ID outside int64 raises OverflowError here, before the row is counted as stored
+            self._pids.append(patientId)
+            self._temps.append(float(temp))
+            self._heartRates.append(int(hr))
+            self._respiratoryRates.append(int(rr))
+            self._systolicBps.append(int(sbp))
+            self._diastolicBps.append(int(dbp))
+            self._oxygenSaturations.append(int(spo2))
+        except (OverflowError, TypeError, ValueError) as error:
+            self._truncate(row)
+            raise ValueError(str(error))
+        self._live.append(1)
+
+        #Extending the last range of the patient when the rows are adjacent
+        ranges = self._index.get(patientId)
+        if ranges is None:
+            self._index[patientId] = [[row, row + 1]]
+        elif ranges[-1][1] == row:
+            ranges[-1][1] = row + 1
+        else:
+            ranges.append([row, row + 1])
+            self._extraRanges += 1
+
+        #Keeping the running aggregates and value counts up to date
+        if self._patientAggregates is not None or self._valueCounts is not None:
+            values = (self._temps[row], self._heartRates[row], self._respiratoryRates[row],
+                      self._systolicBps[row], self._diastolicBps[row], self._oxygenSaturations[row])
+            if self._patientAggregates is not None:
+                self._totalAggregate.add(values)
+                self._patientAggregates.setdefault(patientId, RunningAggregate()).add(values)
+            if self._valueCounts is not None:
+                for counts, value in zip(self._valueCounts, values):
+                    counts[value] += 1
+
+        #Keeping the date index sorted
+        if self._dateDays is not None:
+            if not self._datePending and (not self._dateDays or self._dateDays[-1] <= day):
+                self._dateDays.append(day)
+                self._dateRows.append(row)
+            else:
+                #Merged by the next date query, instead of an O(n) insert into the index per visit
+                self._datePending.append(row)
+
+        self._invalidatePatient(patientId)
+        return row
+
+    def _invalidatePatient(self, patientId):
+        #Dropping the cached results that depend on the visits of a patient
+        for cache in self._followUpCache.values():
+            cache.pop(patientId, None)
+        for cache in self._trendCache.values():
+            cache.pop(patientId, None)
+
+    def extendRows(self, columns, start, stop):
+        """
+        Appends rows [start, stop) of parsed columns in one go.
+
+        columns: The patientId, day number and six vital sign arrays, as produced by the file parser.
+        """
+        if start >= stop:
+            return
+        if (self._patientAggregates is not None or self._valueCounts is not None or self._dateDays is not None
+                or self._followUpCache or self._trendCache):
+            #The running aggregates, value counts and date index are updated row by row
+            for row in range(start, stop):
+                self.appendVisit(*(column[row] for column in columns))
+            return
+        first = len(self._days)
+        for target, source in zip((self._pids, self._days) + self.columns(), columns):
+            target.extend(source[start:stop])
+        self._live.extend(b'\x01' * (stop - start))
+
+        #Adding one range per run of rows of the same patient
+        row = first
+        for patient_id, group in itertools.groupby(columns[0][start:stop]):
+            end = row + sum(1 for _ in group)
+            ranges = self._index.get(patient_id)
+            if ranges is None:
+                self._index[patient_id] = [[row, end]]
+            elif ranges[-1][1] == row:
+                ranges[-1][1] = end
+            else:
+                ranges.append([row, end])
+                self._extraRanges += 1
+            row = end
+
+    def _replaceWith(self, other):
+        #Taking over the contents of another store, keeping this object for the code that refers to it
+        self.__dict__.clear()
+        self.__dict__.update(other.__dict__)
+
+    def _truncate(self, length):
+        for column in (self._pids, self._days) + self.columns():
+            del column[length:]
+
+    def deletePatient(self, patientId):
+        """
+        Removes all visits of a patient.
+
+        return: The number of visits removed (0 if the patient was not stored).
+        """
+        ranges = self._index.pop(patientId, None)
+        if ranges is None:
+            return 0
+        if self._valueCounts is not None:
+            #Subtracting drops the values whose count reaches zero, so min and max stay right
+            self._valueCounts = [counts - Counter(self.gather(column, ranges))
+                                 for counts, column in zip(self._valueCounts, self.columns())]
+        removed = 0
+        for start, stop in ranges:
+            self._live[start:stop] = bytes(stop - start)
+            removed += stop - start
+        self._deadRows += removed
+        self._extraRanges -= len(ranges) - 1
+
+        #Removing the contribution of the patient from the running aggregates
+        if self._patientAggregates is not None:
+            self._totalAggregate.subtract(self._patientAggregates.pop(patientId))
+        self._invalidatePatient(patientId)
+
+        #Reclaiming the space once more than half of the rows are dead
+        if self._deadRows > self.visitCount():
+            self.compact()
+        return removed
+
+    def compact(self):
+        """
+        Rewrites the columns so that deleted rows are dropped and the rows of each patient are contiguous.
+        Row numbers change, so any row numbers obtained earlier become invalid.
+        """
+        if self._deadRows == 0 and self._extraRanges == 0:
+            return
+        self._setColumns(*self._compactedColumns())
+        #The date index refers to the old row numbers, so it is rebuilt on the next date query
+        self._dateDays = None
+        self._dateRows = None
+        self._datePending = array('q')
+
+    def frozenCopy(self):
+        """
+        Returns a compact copy of the store that shares no columns with it.
+
+        The copy can be written out from another thread while this store keeps being read and changed.
+        """
+        copy = VisitStore()
+        copy._setColumns(*self._compactedColumns())
+        copy._sourceFile = self._sourceFile
+        copy._sourceGeneration = self._sourceGeneration
+        copy._sourceSize = self._sourceSize
+        return copy
+
+    def _compactedColumns(self):
+        #New columns holding only the live rows, with the rows of each patient contiguous
+        old = (self._pids, self._days) + self.columns()
+        new = tuple(array(column.typecode) for column in old)
+        index = {}
+        for patient_id, ranges in self._index.items():
+            start = len(new[0])
+            for first, stop in ranges:
+                for source, target in zip(old, new):
+                    target.extend(source[first:stop])
+            index[patient_id] = [[start, len(new[0])]]
+        return new, index
+
+    def _setColumns(self, columns, index):
+        (self._pids, self._days, self._temps, self._heartRates, self._respiratoryRates,
+         self._systolicBps, self._diastolicBps, self._oxygenSaturations) = columns
+        self._live = bytearray(b'\x01') * len(self._days)
+        self._index = index
+        self._deadRows = 0
+        self._extraRanges = 0
+
+#--- end of visitstore ---#
 
 
 def readPatientsFromFile(fileName):
@@ -6,8 +602,8 @@ def readPatientsFromFile(fileName):
     Reads patient data from a plaintext file.
 
     fileName: The name of the file to read patient data from.
-    Returns a dictionary of patient IDs, where each patient has a list of visits.
-    The dictionary has the following structure:
+    Returns a VisitStore, a read-only mapping of patient IDs, where each patient has a list of visits.
+    The mapping has the following structure:
     {
         patientId (int): [
             [date (str), temperature (float), heart rate (int), respiratory rate (int), systolic blood pressure (int), diastolic blood pressure (int), oxygen saturation (int)],
@@ -20,373 +616,2797 @@ def readPatientsFromFile(fileName):
         ],
         ...
     }
+    The visits are kept in typed columns, and the visit lists are built on demand when accessed.
+    Tombstone lines ('DELETE,patientId') written by deleteAllVisitsOfPatient remove the visits
+    of the patient that come before them in the file.
+    The file is memory-mapped and split into newline aligned chunks which are parsed in a process pool
+    when it is larger than parallelLoadMinBytes. Invalid lines are not printed one by one; a summary
+    is printed instead, and the full counts are kept in the loadReport attribute of the store.
+    When useSnapshots is on, the data is loaded from the binary snapshot next to the file if it is
+    still valid, only parsing lines appended since; otherwise the snapshot is rebuilt after parsing.
+    When the file was split into shards by migrateToShards, a ShardedPatients mapping is returned instead.
+    """
+    if os.path.exists(os.path.join(shardDirectory(fileName), SHARD_MANIFEST)):
+        return ShardedPatients(fileName)
+
+    #Reading the file as it was at one generation and length, retrying when it was compacted meanwhile
+    for attempt in range(_READ_ATTEMPTS):
+        with _phase('read.lock'):
+            generation, source = _readerView(fileName)
+        patients = _loadPatients(fileName, source)
+        if source is None or _readerView(fileName)[0] == generation:
+            break
+    #A store whose load failed is not tied to the file, so it can never be written back over it
+    if not patients.loadReport.get('failed'):
+        patients._sourceFile = os.path.abspath(fileName)
+        patients._sourceGeneration = generation
+        patients._sourceSize = source.st_size if source is not None else 0
+    return patients
+
+
+def _loadPatients(fileName, source):
+    #Loading the first source.st_size bytes of the file, from the snapshot when it is still valid
+    if useSnapshots and source is not None:
+        with _phase('read.snapshot'):
+            patients = _readSnapshotFor(fileName, source)
+        if patients is not None:
+            if instrumentation is not None:
+                instrumentation.count('his_rows_read_total', patients.visitCount(), source='snapshot')
+            return patients
+
+    #Store which keeps the patientId and its related information
+    patients=VisitStore()
+    report = {'rows': 0, 'rejected': 0, 'byReason': {}, 'samples': {}}
+    try:
+        if source is None:
+            #Raising the error that kept the file from being read, inside the error handling below
+            os.stat(fileName)
+            raise FileNotFoundError(fileName)
+        #Parsing the file in chunks of at most loadChunkBytes, in parallel for big files,
+        #and merging each partial result in file order as soon as it is ready
+        size = source.st_size
+        workers = loadWorkers if size >= parallelLoadMinBytes else 1
+        garbage = 0
+        boundaries = _chunkBoundaries(fileName, size, max(workers, -(-size // loadChunkBytes)))
+        results = _parsedChunks(fileName, boundaries, workers)
+        while True:
+            with _phase('read.parse'):
+                result = next(results, None)
+            if result is None:
+                break
+            with _phase('read.merge'):
+                garbage += _mergeChunk(patients, result, report)
+        _logGarbage[os.path.abspath(fileName)] = garbage
+
+    #Handling exception            
+    except FileNotFoundError:
+        print(f"The file '{fileName}' could not be found.")
+        #A file that is missing from the start is empty; one that went away while it was read is a failed load
+        report['failed'] = source is not None
+        source = None
+    
+    #Handling exception
+    except Exception :
+        print("An unexpected error occurred while reading the file.")
+        report['failed'] = True
+        source = None
+
+    with _phase('read.report'):
+        _printLoadReport(fileName, report)
+    if instrumentation is not None:
+        instrumentation.count('his_rows_read_total', report['rows'], source='text')
+        for reason, count in report['byReason'].items():
+            instrumentation.count('his_rows_rejected_total', count, reason=reason)
+
+    #Making the rows of each patient contiguous
+    with _phase('read.compact'):
+        patients.compact()
+    patients.loadReport = report
+
+    #Saving a snapshot so the next start does not parse the text again
+    if useSnapshots and source is not None:
+        with _phase('read.snapshot_write'):
+            _writeSnapshotFor(patients, fileName, source, garbage)
+    return patients
+
+
+def _parsedChunks(fileName, boundaries, workers):
+    #_parseChunk results of the chunks between the boundaries, in file order. With several workers the chunks
+    #are parsed in a process pool, at most two per worker ahead of the caller, so memory stays bounded
+    ranges = list(zip(boundaries[:-1], boundaries[1:]))
+    done = 0
+    if workers > 1 and len(ranges) > 1:
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = deque()
+                while done < len(ranges):
+                    while done + len(futures) < len(ranges) and len(futures) < 2 * workers:
+                        futures.append(pool.submit(_parseChunk, fileName, *ranges[done + len(futures)]))
+                    result = futures.popleft().result()
+                    done += 1
+                    yield result
+        except (OSError, concurrent.futures.process.BrokenProcessPool):
+            #Falling back to parsing the remaining chunks in this process when no worker processes can be used
+            pass
+    for start, stop in ranges[done:]:
+        yield _parseChunk(fileName, start, stop)
+
+
+def _mergeChunk(patients, result, report):
+    #Adding the rows of a parsed chunk, replaying the tombstones where they occurred; returns the garbage records found
+    garbage = 0
+    columns = result['columns']
+    position = 0
+    for row, patient_id in result['tombstones']:
+        patients.extendRows(columns, position, row)
+        garbage += patients.deletePatient(patient_id) + 1
+        position = row
+    patients.extendRows(columns, position, len(columns[0]))
+    report['rows'] += len(columns[0])
+    for reason, count in result['byReason'].items():
+        report['byReason'][reason] = report['byReason'].get(reason, 0) + count
+        report['rejected'] += count
+    for reason, message in result['samples'].items():
+        report['samples'].setdefault(reason, message)
+    return garbage
+
+
+def _printLoadReport(fileName, report):
+    #Printing one summary of the invalid lines
+    if report['rejected']:
+        print(f"Skipped {report['rejected']} invalid line(s) in '{fileName}':")
+        for reason, count in sorted(report['byReason'].items()):
+            print(f"  {reason}: {count} (e.g. {report['samples'][reason]})")
+
+
+def _parseLine(line):
     """
-    #Dictionary which stores the patientId and its related information
-    patients={}
+    Parses and validates one line of the patient file.
+
+    return: None for an empty line, ('visit', (patientId, day number, temp, hr, rr, sbp, dbp, spo2)) for a valid visit,
+    ('delete', patientId) for a tombstone, or ('error', reason, message) for an invalid line.
+    """
+    fields = line.strip().split(',')
+
+    #Skipping empty lines
+    if fields == ['']:
+        return None
+
+    #Tombstone record
+    if fields[0] == TOMBSTONE_MARKER and len(fields) == 2:
+        try:
+            return 'delete', int(fields[1])
+        except ValueError:
+            return 'error', 'data type', f"Invalid data type in line: {line}"
+
+    #If there is no valid no of lines or information
+    if len(fields) != 8:
+        return 'error', 'fields', f"Invalid number of fields ({len(fields)}) in line: {line}"
+
     try:
-        #Opening the text file where the information is stored
-        with open(fileName,'r') as file:
-            for line in file:
-                fields = line.strip().split(',')
-                
-                #If there is no valid no of lines or information
-                if len(fields) != 8:
-                    print(f"Invalid number of fields ({len(fields)}) in line: {line}")
-                    continue
-                
+        #Accessing the datas
+        patient_id = int(fields[0])
+        date = fields[1]
+        temperature = float(fields[2])
+        heart_rate = int(fields[3])
+        respiratory_rate = int(fields[4])
+        systolic_bp = int(fields[5])
+        diastolic_bp = int(fields[6])
+        oxygen_saturation = int(fields[7])
+    except ValueError:
+        return 'error', 'data type', f"Invalid data type in line: {line}"
+
+    #Checking the patient ID fits the int64 patient column
+    if not -PATIENT_ID_LIMIT <= patient_id < PATIENT_ID_LIMIT:
+        return 'error', 'patient id', f"Invalid patient id ({patient_id}) in line: {line}"
+    #Checking the temperature value within required range
+    if not (35 <= temperature <= 42):
+        return 'error', 'temperature', f"Invalid temperature value ({temperature}) in line: {line}"
+    #Checking the hear rate within required range
+    if not (30 <= heart_rate <= 180):
+        return 'error', 'heart rate', f"Invalid heart rate value ({heart_rate}) in line: {line}"
+    #Checking the respiratory rate within required range
+    if not (5 <= respiratory_rate <= 40):
+        return 'error', 'respiratory rate', f"Invalid respiratory rate value ({respiratory_rate}) in line: {line}"
+    #Checking the systolic bp within required range
+    if not (70 <= systolic_bp <= 200):
+        return 'error', 'systolic blood pressure', f"Invalid systolic blood pressure value ({systolic_bp}) in line: {line}"
+    #Checking the diastolic bp within required range
+    if not (40 <= diastolic_bp <= 120):
+        return 'error', 'diastolic blood pressure', f"Invalid diastolic blood pressure value ({diastolic_bp}) in line: {line}"
+    #Checking the oxygen saturation within required range
+    if not (70 <= oxygen_saturation <= 100):
+        return 'error', 'oxygen saturation', f"Invalid oxygen saturation value ({oxygen_saturation}) in line: {line}"
+
+    #Checking the date is a real calendar date
+    day = _dateCache.get(date)
+    if day is None:
+        try:
+            day = _dateCache[date] = parseVisitDate(date)
+        except ValueError:
+            return 'error', 'date', f"Invalid date value ({date}) in line: {line}"
+
+    return 'visit', (patient_id, day, temperature, heart_rate, respiratory_rate, systolic_bp, diastolic_bp, oxygen_saturation)
+
+
+#Date string -> day number, visit dates repeat a lot so each one is parsed only once
+_dateCache = {}
+#Patient IDs are kept in an int64 column, so they must lie in [-PATIENT_ID_LIMIT, PATIENT_ID_LIMIT)
+PATIENT_ID_LIMIT = 1 << 63
+
+
+def _chunkBoundaries(fileName, size, chunks):
+    #Byte offsets splitting the file into chunks that start right after a newline
+    boundaries = [0]
+    if chunks > 1 and size:
+        with open(fileName, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for i in range(1, chunks):
+                newline = data.find(b'\n', max(size * i // chunks, boundaries[-1]))
+                if newline == -1:
+                    break
+                if newline + 1 > boundaries[-1]:
+                    boundaries.append(newline + 1)
+    if boundaries[-1] != size or size == 0:
+        boundaries.append(size)
+    return boundaries
+
+
+def _parseChunk(fileName, start, stop):
+    """
+    Parses the lines in bytes [start, stop) of the patient file into columns.
+
+    return: A dictionary with 'columns' (patientId, day, temperature, heart rate, respiratory rate, systolic bp,
+    diastolic bp and oxygen saturation arrays), 'tombstones' (a list of (row, patientId) giving the number of
+    rows parsed before each tombstone), 'byReason' (counts of invalid lines) and 'samples' (one message per reason).
+    """
+    columns = (array('q'), array('i'), array('d'), array('h'), array('h'), array('h'), array('h'), array('h'))
+    appends = [column.append for column in columns]
+    (add_patient, add_day, add_temperature, add_heart_rate, add_respiratory_rate,
+     add_systolic_bp, add_diastolic_bp, add_oxygen_saturation) = appends
+    date_cache = _dateCache
+    tombstones = []
+    by_reason = {}
+    samples = {}
+    if stop > start:
+        with open(fileName, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            text = data[start:stop].decode(errors='replace')
+        for line in text.split('\n'):
+            #Fast path for a valid visit with an already seen date: the same checks as _parseLine, inlined
+            fields = line.split(',')
+            if len(fields) == 8:
                 try:
-                    #Accessing the datas
                     patient_id = int(fields[0])
-                    date = fields[1]
                     temperature = float(fields[2])
                     heart_rate = int(fields[3])
                     respiratory_rate = int(fields[4])
                     systolic_bp = int(fields[5])
                     diastolic_bp = int(fields[6])
                     oxygen_saturation = int(fields[7])
-                    
-                    #Checking the temperature value within required range
-                    if not (35 <= temperature <= 42):
-                        print(f"Invalid temperature value ({temperature}) in line: {line}")
-                        continue
-                    
-                    #Checking the hear rate within required range
-                    if not (30 <= heart_rate <= 180):
-                        print(f"Invalid heart rate value ({heart_rate}) in line: {line}")
-                        continue
-                    
-                    #Checking the respiratory rate within required range
-                    if not (5 <= respiratory_rate <= 40):
-                        print(f"Invalid respiratory rate value ({respiratory_rate}) in line: {line}")
-                        continue
-                    
-                    #Checking the systolic bp within required range
-                    if not (70 <= systolic_bp <= 200):
-                        print(f"Invalid systolic blood pressure value ({systolic_bp}) in line: {line}")
-                        continue
-                    
-                    #Checking the diastolic bp within required range
-                    if not (40 <= diastolic_bp <= 120):
-                        print(f"Invalid diastolic blood pressure value ({diastolic_bp}) in line: {line}")
-                        continue
-                    
-                    #Checking the oxygen saturation within required range
-                    if not (70 <= oxygen_saturation <= 100):
-                        print(f"Invalid oxygen saturation value ({oxygen_saturation}) in line: {line}")
-                        continue
-                    
-                    if patient_id not in patients:
-                        patients[patient_id] = []
-                    
-                    #Adding the datas to the dictionary
-                    patients[patient_id].append([date, temperature, heart_rate, respiratory_rate, systolic_bp, diastolic_bp, oxygen_saturation])
-                
-                #Handling exception
                 except ValueError:
-                    print(f"Invalid data type in line: {line}")
+                    pass
+                else:
+                    day = date_cache.get(fields[1])
+                    if (day is not None and -PATIENT_ID_LIMIT <= patient_id < PATIENT_ID_LIMIT
+                            and 35 <= temperature <= 42 and 30 <= heart_rate <= 180 and 5 <= respiratory_rate <= 40
+                            and 70 <= systolic_bp <= 200 and 40 <= diastolic_bp <= 120 and 70 <= oxygen_saturation <= 100):
+                        add_patient(patient_id)
+                        add_day(day)
+                        add_temperature(temperature)
+                        add_heart_rate(heart_rate)
+                        add_respiratory_rate(respiratory_rate)
+                        add_systolic_bp(systolic_bp)
+                        add_diastolic_bp(diastolic_bp)
+                        add_oxygen_saturation(oxygen_saturation)
+                        continue
+            parsed = _parseLine(line)
+            if parsed is None:
+                continue
+            kind = parsed[0]
+            if kind == 'visit':
+                for append, value in zip(appends, parsed[1]):
+                    append(value)
+            elif kind == 'delete':
+                tombstones.append((len(columns[0]), parsed[1]))
+            else:
+                by_reason[parsed[1]] = by_reason.get(parsed[1], 0) + 1
+                samples.setdefault(parsed[1], parsed[2].rstrip())
+    return {'columns': columns, 'tombstones': tombstones, 'byReason': by_reason, 'samples': samples}
+
+#Name of the text file
+fileName='patients.txt'
+#Files at least this big are parsed in parallel by loadWorkers processes
+parallelLoadMinBytes = int(os.environ.get('HIS_PARALLEL_LOAD_MIN_BYTES', 32 << 20))
+loadWorkers = os.cpu_count() or 1
+#Largest piece of the file one process decodes and splits at a time
+loadChunkBytes = 64 << 20
+
+#--- end of readpatientsfromfile ---#
+
+#How deletes are saved: 'rewrite' rewrites the whole file, 'log' (opt in with HIS_STORAGE_MODE=log)
+#appends a tombstone record, which older versions of this program cannot read
+storageMode = os.environ.get('HIS_STORAGE_MODE', 'rewrite')
+#Log files smaller than this many bytes are never compacted
+compactionThresholdBytes = int(os.environ.get('HIS_COMPACTION_THRESHOLD', 1 << 20))
+#Whether compaction of the log runs in a background thread
+backgroundCompaction = True
+
+#First field of a tombstone record
+TOMBSTONE_MARKER = 'DELETE'
+
+#Guards the in-memory data and the file while records are written or the file is compacted
+_storageLock = threading.RLock()
+#Absolute file name -> number of tombstones and deleted visits still in the file
+_logGarbage = {}
+_compactionThread = None
+
+
+#Times readPatientsFromFile retries when the file is compacted while it is being read
+_READ_ATTEMPTS = 5
+#(lock file name, owning thread id) -> (open lock file, exclusive) for the file locks this process holds
+_heldFileLocks = {}
+
+
+@contextlib.contextmanager
+def _patientFileLock(fileName, exclusive):
+    """
+    Holds an advisory lock on the lock file next to a patient file.
+
+    Readers take a shared lock and writers an exclusive one. The lock file also holds the generation
+    number of the patient file, which is increased every time the file is rewritten.
+    Only writers create the lock file; when a reader cannot open it (no writer has run yet, or the
+    directory is read-only) None is yielded and the file is read without a lock.
+    A thread that already holds the lock of a file reuses it instead of locking again.
+    Raises RuntimeError if a thread holding the shared lock asks for the exclusive one, since upgrading
+    a flock is not atomic and two upgrading readers would deadlock.
+    """
+    path = os.path.abspath(fileName) + '.lock'
+    key = (path, threading.get_ident())
+    held = _heldFileLocks.get(key)
+    if held is not None:
+        if exclusive and not held[1]:
+            raise RuntimeError(f"The shared lock on '{path}' cannot be upgraded to an exclusive one")
+        yield held[0]
+        return
+    if exclusive:
+        file = open(path, 'a+')
+    else:
+        try:
+            file = open(path, 'r')
+        except OSError:
+            yield None
+            return
+    with file:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        _heldFileLocks[key] = (file, exclusive)
+        try:
+            yield file
+        finally:
+            del _heldFileLocks[key]
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+def _readGeneration(lockFile):
+    #Generation number kept in the lock file; 0 when there is no lock file yet
+    if lockFile is None:
+        return 0
+    lockFile.seek(0)
+    text = lockFile.read().strip()
+    return int(text) if text else 0
+
+
+def _readerView(fileName):
+    #Generation and stat of the patient file taken together under a shared lock; the stat is None if the file cannot be stat'ed
+    with _patientFileLock(fileName, exclusive=False) as lock:
+        try:
+            return _readGeneration(lock), os.stat(fileName)
+        except OSError:
+            return _readGeneration(lock), None
+
+
+def _catchUp(patients, fileName, generation):
+    #Adding the records other processes wrote since the store read the file; the caller holds the file lock
+    if not isinstance(patients, VisitStore) or patients._sourceFile != os.path.abspath(fileName):
+        return
+    size = os.path.getsize(fileName)
+    if generation == patients._sourceGeneration:
+        if size > patients._sourceSize:
+            report = {'rows': 0, 'rejected': 0, 'byReason': {}, 'samples': {}}
+            garbage = _mergeChunk(patients, _parseChunk(fileName, patients._sourceSize, size), report)
+            key = os.path.abspath(fileName)
+            _logGarbage[key] = _logGarbage.get(key, 0) + garbage
+    else:
+        #The file was rewritten by another process, so it is read again
+        patients._replaceWith(_loadPatients(fileName, os.stat(fileName)))
+        patients._sourceFile = os.path.abspath(fileName)
+    patients._sourceGeneration = generation
+    patients._sourceSize = size
+
+
+def refreshPatients(patients, fileName):
+    """
+    Brings a store returned by readPatientsFromFile up to date with changes other processes made to the file.
+
+    Records appended since the store last read the file are added; if the file was compacted, it is read again.
+    """
+    if isinstance(patients, ShardedPatients):
+        for index, store in enumerate(patients._stores):
+            if store is not None:
+                refreshPatients(store, patients.shardFile(index))
+        return patients
+    with _storageLock, _patientFileLock(fileName, exclusive=False) as lock:
+        _catchUp(patients, fileName, _readGeneration(lock))
+    return patients
+
+
+@contextlib.contextmanager
+def _writeTransaction(patients, fileName):
+    #Exclusive access to the patient file for one change, after catching up with the other writers
+    with _storageLock, _patientFileLock(fileName, exclusive=True) as lock:
+        generation = _readGeneration(lock)
+        if os.path.exists(fileName):
+            with _phase('write.catchup'):
+                _catchUp(patients, fileName, generation)
+        yield lock
+        if isinstance(patients, VisitStore) and patients._sourceFile == os.path.abspath(fileName):
+            patients._sourceSize = os.path.getsize(fileName)
+
+
+def _visitRecord(patientId, visit):
+    #Line of the text file for one visit
+    return f"{patientId},{','.join(map(str, visit))}"
+
+
+def _appendLines(fileName, lines, sync=False):
+    #Appending records to the end of the file with one write, starting them on a new line
+    with open(fileName, 'a+b') as file:
+        size = file.seek(0, os.SEEK_END)
+        prefix = b''
+        if size:
+            file.seek(size - 1)
+            if file.read(1) != b'\n':
+                prefix = b'\n'
+        written = file.write(prefix + '\n'.join(lines).encode())
+        if instrumentation is not None:
+            instrumentation.count('his_bytes_written_total', written, file='data')
+        if sync:
+            file.flush()
+            os.fsync(file.fileno())
+
+
+def compactPatientFile(patients, fileName):
+    """
+    Rewrites the patient file so that it only holds the visits of the given patients.
+
+    patients: A VisitStore or a dictionary of patient IDs, where each patient has a list of visits.
+    fileName: The name of the file to rewrite.
+    The data is written to a temporary file which then atomically replaces the original,
+    so a crash during compaction leaves either the old or the new file, never a truncated one.
+    The file is locked exclusively meanwhile, and records other processes appended are taken in first.
+    Raises ValueError for a store whose load from a file failed, as it may be missing most of the visits.
+    """
+    if isinstance(patients, VisitStore) and patients.loadReport and patients.loadReport.get('failed'):
+        raise ValueError("The patient data could not be loaded, so the file is not rewritten from it")
+    temporary = fileName + '.tmp'
+    with _writeTransaction(patients, fileName) as lock:
+        with open(temporary, 'w') as file:
+            first = True
+            for patient_id, visits in patients.items():
+                for visit in visits:
+                    file.write(("" if first else "\n") + _visitRecord(patient_id, visit))
+                    first = False
+            file.flush()
+            os.fsync(file.fileno())
+            if instrumentation is not None:
+                instrumentation.count('his_bytes_written_total', file.tell(), file='data')
+        os.replace(temporary, fileName)
+        _logGarbage[os.path.abspath(fileName)] = 0
+
+        #Telling readers the file was rewritten
+        generation = _readGeneration(lock) + 1
+        lock.truncate(0)
+        lock.write(str(generation))
+        lock.flush()
+        if isinstance(patients, VisitStore) and patients._sourceFile == os.path.abspath(fileName):
+            patients._sourceGeneration = generation
+
+        #The rewritten file has a new inode, so the snapshot is refreshed with it
+        if useSnapshots and isinstance(patients, VisitStore):
+            _writeSnapshotFor(patients, fileName, os.stat(fileName), 0)
+
+
+def _maybeCompact(patients, fileName):
+    #Compacting once the file is big enough and at least half of its records are garbage
+    global _compactionThread
+    garbage = _logGarbage.get(os.path.abspath(fileName), 0)
+    live = patients.visitCount() if isinstance(patients, VisitStore) else sum(len(visits) for visits in patients.values())
+    if garbage < live or os.path.getsize(fileName) < compactionThresholdBytes:
+        return
+    if not backgroundCompaction:
+        compactPatientFile(patients, fileName)
+    elif _compactionThread is None or not _compactionThread.is_alive():
+        #The thread writes a copy, so readers of the store, which take no lock, never see it change
+        with _storageLock:
+            if isinstance(patients, VisitStore):
+                frozen = patients.frozenCopy()
+            else:
+                frozen = {patient_id: [list(visit) for visit in visits] for patient_id, visits in patients.items()}
+        _compactionThread = threading.Thread(target=_compactCopy, args=(patients, frozen, fileName), name='compaction')
+        _compactionThread.start()
+
+
+def _compactCopy(patients, frozen, fileName):
+    #Compacting the file from a frozen copy of the store in the background
+    with _writeTransaction(frozen, fileName) as lock:
+        #Under the lock only this thread changes the store; it still matches the file when no write came in between
+        inSync = (isinstance(patients, VisitStore) and patients._sourceFile == os.path.abspath(fileName)
+                  and patients._sourceGeneration == _readGeneration(lock)
+                  and patients._sourceSize == os.path.getsize(fileName))
+        compactPatientFile(frozen, fileName)
+        if inSync:
+            #Only the bookkeeping of the store changes, its rows already match the rewritten file
+            patients._sourceGeneration = frozen._sourceGeneration
+            patients._sourceSize = os.path.getsize(fileName)
+
+#--- end of storage ---#
+
+#Whether readPatientsFromFile keeps a binary snapshot next to the text file
+useSnapshots = os.environ.get('HIS_SNAPSHOTS', '1') != '0'
+SNAPSHOT_SUFFIX = '.snap'
+SNAPSHOT_MAGIC = b'HISSNAP\x00'
+SNAPSHOT_VERSION = 1
+#magic, version, flags, patient count, row count, source size, source inode, source mtime (ns), garbage records, source checksum
+SNAPSHOT_HEADER = struct.Struct('<8sHHQQQQqQI')
+#Bytes before the end of the covered text that are checksummed to detect rewritten files
+_SNAPSHOT_CHECKSUM_BYTES = 1 << 16
+
+
+def writeSnapshot(patients, snapshotFile, source=None, garbage=0):
+    """
+    Writes the patients to a binary snapshot file.
+
+    patients: A VisitStore or a dictionary of patient IDs, where each patient has a list of visits.
+    snapshotFile: The name of the snapshot file to write.
+    source: Optional (size, inode, mtime in ns, checksum) of the text file the snapshot was built from.
+    garbage: The number of garbage records in that text file.
+
+    Layout (little endian): a 64 byte header, a patient table of (patientId, first row, row count)
+    int64 triples, then the columns as fixed width arrays: temperature (float64), date (int32 day number),
+    and heart rate, respiratory rate, systolic bp, diastolic bp and oxygen saturation (int16).
+    """
+    store = _asStore(patients)
+    if store._deadRows or store._extraRanges:
+        #Compacting a copy, as the store may be in use by readers
+        store = store.frozenCopy()
+    table = array('q')
+    for patient_id, ranges in store._index.items():
+        start, stop = ranges[0]
+        table.extend((patient_id, start, stop - start))
+    columns = [store._temps, store._days] + list(store.columns()[1:])
+    size, inode, mtime, checksum = source or (0, 0, 0, 0)
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, len(store), len(store._days),
+                                  size, inode, mtime, garbage, checksum)
+
+    temporary = f"{snapshotFile}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as file:
+        file.write(header)
+        for data in [table] + columns:
+            if sys.byteorder == 'big':
+                data = array(data.typecode, data)
+                data.byteswap()
+            data.tofile(file)
+        file.flush()
+        os.fsync(file.fileno())
+        if instrumentation is not None:
+            instrumentation.count('his_bytes_written_total', file.tell(), file='snapshot')
+    os.replace(temporary, snapshotFile)
+
+
+def loadSnapshot(snapshotFile):
+    """
+    Loads a binary snapshot written by writeSnapshot.
+
+    snapshotFile: The name of the snapshot file.
+    return: A tuple (VisitStore, header) where header is a dictionary of the header fields.
+    Raises ValueError if the file is not a snapshot of a supported version or is truncated.
+    """
+    with open(snapshotFile, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if len(data) < SNAPSHOT_HEADER.size:
+            raise ValueError("Snapshot file is truncated.")
+        fields = SNAPSHOT_HEADER.unpack_from(data)
+        header = dict(zip(('magic', 'version', 'flags', 'patientCount', 'rowCount', 'sourceSize',
+                           'sourceInode', 'sourceMtimeNs', 'garbage', 'sourceChecksum'), fields))
+        if header['magic'] != SNAPSHOT_MAGIC or header['version'] != SNAPSHOT_VERSION:
+            raise ValueError("Not a snapshot file of a supported version.")
+
+        rows = header['rowCount']
+        store = VisitStore()
+        layout = [array('q'), store._temps, store._days, store._heartRates, store._respiratoryRates,
+                  store._systolicBps, store._diastolicBps, store._oxygenSaturations]
+        counts = [3 * header['patientCount']] + [rows] * 7
+        if SNAPSHOT_HEADER.size + sum(count * column.itemsize for count, column in zip(counts, layout)) != len(data):
+            raise ValueError("Snapshot file is truncated.")
+
+        #Copying each column straight out of the mapped file, without parsing the rows
+        offset = SNAPSHOT_HEADER.size
+        with memoryview(data) as view:
+            for column, count in zip(layout, counts):
+                end = offset + count * column.itemsize
+                column.frombytes(view[offset:end])
+                offset = end
+    if sys.byteorder == 'big':
+        for column in layout:
+            column.byteswap()
+
+    #Rebuilding the patient column and index from the patient table
+    table = layout[0]
+    for i in range(0, len(table), 3):
+        patient_id, start, count = table[i], table[i + 1], table[i + 2]
+        store._pids.extend(array('q', (patient_id,)) * count)
+        store._index[patient_id] = [[start, start + count]]
+    store._live = bytearray(b'\x01') * rows
+    return store, header
+
+
+def _sourceChecksum(fileName, size):
+    #Checksum of the end of the first size bytes of the text file
+    with open(fileName, 'rb') as file:
+        file.seek(max(size - _SNAPSHOT_CHECKSUM_BYTES, 0))
+        return zlib.crc32(file.read(min(size, _SNAPSHOT_CHECKSUM_BYTES)))
+
+
+def _writeSnapshotFor(patients, fileName, source, garbage):
+    #Writing the snapshot of a text file, recording which version of the file it covers
+    try:
+        checksum = _sourceChecksum(fileName, source.st_size)
+        writeSnapshot(patients, fileName + SNAPSHOT_SUFFIX,
+                      (source.st_size, source.st_ino, source.st_mtime_ns, checksum), garbage)
+    except OSError:
+        #The snapshot is only a cache, so failing to write it is not an error
+        pass
+
+
+def _readSnapshotFor(fileName, source):
+    #Loading the snapshot of a text file when it is still valid, replaying lines appended after it
+    try:
+        patients, header = loadSnapshot(fileName + SNAPSHOT_SUFFIX)
+        covered = header['sourceSize']
+        if header['sourceInode'] != source.st_ino or source.st_size < covered:
+            return None
+        if source.st_size == covered and source.st_mtime_ns != header['sourceMtimeNs']:
+            return None
+        if _sourceChecksum(fileName, covered) != header['sourceChecksum']:
+            return None
+    except (OSError, ValueError):
+        return None
+
+    report = {'rows': patients.visitCount(), 'rejected': 0, 'byReason': {}, 'samples': {}, 'snapshot': True}
+    garbage = header['garbage']
+    if source.st_size > covered:
+        garbage += _mergeChunk(patients, _parseChunk(fileName, covered, source.st_size), report)
+        _printLoadReport(fileName, report)
+        patients.compact()
+        _writeSnapshotFor(patients, fileName, source, garbage)
+    _logGarbage[os.path.abspath(fileName)] = garbage
+    patients.loadReport = report
+    return patients
+
+
+def convertTextToSnapshot(textFile, snapshotFile):
+    """
+    Converts a patient text file into a binary snapshot file.
+    """
+    with _snapshotsDisabled():
+        patients = readPatientsFromFile(textFile)
+    writeSnapshot(patients, snapshotFile)
+    return patients
+
+
+def convertSnapshotToText(snapshotFile, textFile):
+    """
+    Converts a binary snapshot file back into a patient text file.
+    """
+    patients, _ = loadSnapshot(snapshotFile)
+    with _snapshotsDisabled():
+        compactPatientFile(patients, textFile)
+    return patients
+
+
+@contextlib.contextmanager
+def _snapshotsDisabled():
+    #Turning off the automatic snapshot next to the text file during a conversion
+    global useSnapshots
+    previous = useSnapshots
+    useSnapshots = False
+    try:
+        yield
+    finally:
+        useSnapshots = previous
+
+#--- end of snapshot ---#
+
+def displayPatientData(patients, patientId=0, out=None, format='text', limit=None, offset=0, pageSize=None):
+    """
+    Displays patient data for a given patient ID.
+
+    patients: A dictionary of patient dictionaries, where each patient has a list of visits.
+    patientId: The ID of the patient to display data for. If 0, data for all patients will be displayed.
+    out: The text stream to write to. If None, sys.stdout is used.
+    format: 'text' for the readable listing, 'csv' or 'jsonl' for machine readable output.
+    limit, offset: Only show limit visits, after skipping the first offset visits.
+    pageSize: If given, wait for the user after every pageSize visits.
+    """
+    #for all the patients information
+    if patientId == 0:
+        renderVisits(iterVisitRows(patients), out, format, limit, offset, pageSize)
+
+    #For single patient information            
+    elif patientId in patients:
+        renderVisits(iterVisitRows(patients, patientId), out, format, limit, offset, pageSize)
+
+    #If patient not found
+    else:
+        print(f"Patient with ID {patientId} not found.", file=out)
+    
+    return patients
+
+
+def displayVisits(visits, out=None, format='text', limit=None, offset=0, pageSize=None):
+    """
+    Displays a list of (patient ID, visit) tuples, such as the result of findVisitsByDate.
+
+    The arguments are the same as for displayPatientData.
+    """
+    renderVisits(visits, out, format, limit, offset, pageSize, style='visit')
+
+
+def iterVisitRows(patients, patientId=0):
+    """
+    Yields (patient ID, visit) tuples of all patients, or of one patient, straight from the store.
+    """
+    if patientId != 0:
+        for visit in patients[patientId]:
+            yield patientId, visit
+        return
+    for patient_id, visits in patients.items():
+        for visit in visits:
+            yield patient_id, visit
+
+
+#Rows collected before the buffer is written to the output
+RENDER_BUFFER_ROWS = 1000
+CSV_HEADER = ('patientId', 'date') + VITAL_NAMES
+
+
+def _patientText(patientId, visit, previous):
+    #Visit block of displayPatientData, with the patient header when the patient changes
+    header = f"Patient ID: {patientId}\n" if patientId != previous else ""
+    return (f"{header}  Visit Date: {visit[0]}\n"
+            f"    Temperature: {visit[1]} C\n"
+            f"    Heart Rate: {visit[2]} bpm\n"
+            f"    Respiratory Rate: {visit[3]} bpm\n"
+            f"    Systolic Blood Pressure: {visit[4]} mmHg\n"
+            f"    Diastolic Blood Pressure: {visit[5]} mmHg\n"
+            f"    Oxygen Saturation: {visit[6]} %\n\n")
+
+
+def _visitText(patientId, visit, previous):
+    #Visit block of the find visits by date listing
+    return (f"Patient ID: {patientId}\n"
+            f" Visit Date: {visit[0]}\n"
+            f"  Temperature: {'%.2f' % visit[1]} C\n"
+            f"  Heart Rate: {visit[2]} bpm\n"
+            f"  Respiratory Rate: {visit[3]} bpm\n"
+            f"  Systolic Blood Pressure: {visit[4]} mmHg\n"
+            f"  Diastolic Blood Pressure: {visit[5]} mmHg\n"
+            f"  Oxygen Saturation: {visit[6]} %\n")
+
+
+def _csvText(patientId, visit, previous):
+    return f"{patientId},{','.join(map(str, visit))}\n"
+
+
+def _jsonText(patientId, visit, previous):
+    record = {'patientId': patientId, 'date': visit[0]}
+    record.update(zip(VITAL_NAMES, visit[1:]))
+    return json.dumps(record) + "\n"
+
+
+def renderVisits(rows, out=None, format='text', limit=None, offset=0, pageSize=None, style='patient'):
+    """
+    Writes (patient ID, visit) rows to a text stream through a buffer.
+
+    rows: An iterable of (patient ID, visit) tuples; it is consumed lazily.
+    out: The text stream to write to. If None, sys.stdout is used.
+    format: 'text', 'csv' (with a header line) or 'jsonl' (one JSON object per line).
+    limit, offset: Only write limit rows, after skipping the first offset rows.
+    pageSize: If given, the output is flushed and the user is asked to continue after every pageSize rows.
+    style: The text layout, 'patient' for displayPatientData or 'visit' for displayVisits.
+    return: The number of rows written.
+    """
+    if format == 'text':
+        formatter = _patientText if style == 'patient' else _visitText
+    elif format == 'csv':
+        formatter = _csvText
+    elif format == 'jsonl':
+        formatter = _jsonText
+    else:
+        raise ValueError(f"Unknown output format '{format}'")
+    out = out or sys.stdout
+    rows = itertools.islice(rows, offset, None if limit is None else offset + limit)
+
+    buffer = [",".join(CSV_HEADER) + "\n"] if format == 'csv' else []
+    written = 0
+    previous = None
+    for patient_id, visit in rows:
+        buffer.append(formatter(patient_id, visit, previous))
+        previous = patient_id
+        written += 1
+        if pageSize and written % pageSize == 0:
+            out.write("".join(buffer))
+            out.flush()
+            buffer = []
+            if input("-- Press Enter for more, or q to stop -- ").strip().lower() == 'q':
+                return written
+        elif len(buffer) >= RENDER_BUFFER_ROWS:
+            out.write("".join(buffer))
+            buffer = []
+    out.write("".join(buffer))
+    out.flush()
+    return written
+
+#--- end of displaypatientdata ---#
+
+def _asStore(patients):
+    #Converting a plain dictionary of visit lists so the column based code can be used
+    return patients if isinstance(patients, VisitStore) else VisitStore.fromPatients(patients)
+
+
+def _columnStats(counts, percentiles):
+    #Statistics of one vital sign column from its value -> count mapping. The vitals take a few hundred
+    #distinct values, so counting the column (one pass in C) and sorting only the distinct values is O(n);
+    #counts of several shards can be added up before calling this
+    ordered = sorted(counts.items())
+    count = sum(counts.values())
+    if count == 0:
+        return {'count': 0, 'mean': None, 'min': None, 'max': None, 'variance': None,
+                'percentiles': {percent: None for percent in percentiles}}
+    mean = math.fsum(value * times for value, times in ordered) / count
+    squares = math.fsum(value * value * times for value, times in ordered)
+    #Rank of the last copy of each value, to find the value at a rank with bisect
+    last_ranks = list(itertools.accumulate(times for _, times in ordered))
+
+    def valueAt(rank):
+        return ordered[bisect.bisect_right(last_ranks, rank)][0]
+
+    stats = {'count': count, 'mean': mean, 'variance': max(squares / count - mean * mean, 0.0),
+             'min': ordered[0][0], 'max': ordered[-1][0], 'percentiles': {}}
+    #Linear interpolation between the closest ranks
+    for percent in percentiles:
+        position = (count - 1) * percent / 100
+        lower = math.floor(position)
+        low = valueAt(lower)
+        stats['percentiles'][percent] = low + (valueAt(min(lower + 1, count - 1)) - low) * (position - lower)
+    return stats
+
+
+def computeStats(patients, patientId=0, percentiles=(25, 50, 75, 90)):
+    """
+    Computes count, mean, min, max, population variance and percentiles of every vital sign.
+
+    patients: A VisitStore or a dictionary of patient IDs, where each patient has a list of visits.
+    patientId: The ID of the patient to compute statistics for. If 0, all patients are used.
+    percentiles: The percentiles (0-100) to compute. Pass an empty tuple to skip them.
+    return: A dictionary mapping each name in VITAL_NAMES to its statistics dictionary.
+    Raises KeyError if the patient is not found.
+    Everything is computed from the count of each value; the counts of all patients are kept in the store,
+    so after the first call the all-patients statistics only cost a pass over the few hundred distinct values.
+    """
+    if isinstance(patients, ShardedPatients):
+        if patientId != 0:
+            return computeStats(patients.store(patients.shardOf(patientId)), patientId, percentiles)
+        return _shardedStats(patients, percentiles)
+    store = _asStore(patients)
+    if patientId == 0:
+        counts = store.valueCounts()
+    else:
+        ranges = store.ranges(patientId)
+        counts = [Counter(store.gather(column, ranges)) for column in store.columns()]
+    return {name: _columnStats(column_counts, percentiles) for name, column_counts in zip(VITAL_NAMES, counts)}
+
+
+def computeStatsByPatient(patients, percentiles=()):
+    """
+    Computes the statistics of computeStats for every patient at once.
+
+    patients: A VisitStore or a dictionary of patient IDs, where each patient has a list of visits.
+    percentiles: The percentiles (0-100) to compute for each patient.
+    return: A dictionary mapping each patient ID to the result computeStats would give for that patient.
+    """
+    if isinstance(patients, ShardedPatients):
+        return {patient_id: stats for part in _fanOut(patients, 'statsByPatient', percentiles)
+                for patient_id, stats in part.items()}
+    store = _asStore(patients)
+    columns = store.columns()
+    return {patient_id: {name: _columnStats(Counter(store.gather(column, ranges)), percentiles)
+                         for name, column in zip(VITAL_NAMES, columns)}
+            for patient_id, ranges in store._index.items()}
+
+#--- end of computestats ---#
+
+def displayStats(patients, patientId=0):
+    """
+    Prints the average of each vital sign for all patients or for the specified patient.
+
+    patients: A dictionary of patient IDs, where each patient has a list of visits.
+    patientId: The ID of the patient to display vital signs for. If 0, vital signs will be displayed for all patients.
+    """
+    #Exception Handling
+    try:
+        # type casting the patientId into suitable type
+        patientId = int(patientId)
+
+        # if else conditions to check the status of patientId for printing the stats accordingly
+        if patientId == 0:
+            # reading the average of all patients data from the running aggregates
+            if isinstance(patients, ShardedPatients):
+                aggregate = _shardedAggregate(patients)
+            else:
+                aggregate = _asStore(patients).aggregate()
+            if aggregate.count == 0:
+                print("No visit data found.")
+                return
+            avg_temperature, avg_heart_rate, avg_respiratory_rate, avg_systolic_bp, avg_diastolic_bp, avg_oxygen_saturation = aggregate.means
+
+            # printing the average vital signs for all patients
+            print("Vital Signs for All Patients:")
+            print("  Average Temperature:", round(avg_temperature, 2), "°C")
+            print("  Average Heart Rate:", round(avg_heart_rate, 2), "bpm")
+            print("  Average Respiratory Rate:", round(avg_respiratory_rate, 2), "bpm")
+            print("  Average Systolic Blood Pressure:", round(avg_systolic_bp, 2), "mmHg")
+            print("  Average Diastolic Blood Pressure:", round(avg_diastolic_bp, 2), "mmHg")
+            print("  Average Oxygen Saturation:", round(avg_oxygen_saturation, 2), "%")
+
+        elif patientId in patients:
+            visits = patients[patientId]
+            if not visits:
+                print(f"No data found for patient with ID {patientId}.")
+                return
+
+            # reading the average of single patient data from the running aggregates
+            if isinstance(patients, ShardedPatients):
+                aggregate = patients.store(patients.shardOf(patientId)).aggregate(patientId)
+            else:
+                aggregate = _asStore(patients).aggregate(patientId)
+            avg_temperature, avg_heart_rate, avg_respiratory_rate, avg_systolic_bp, avg_diastolic_bp, avg_oxygen_saturation = aggregate.means
+
+            # printing the average vital signs for single patient
+            print(f"Vital Signs for Patient {patientId}:")
+            print("  Average Temperature:", round(avg_temperature, 2), "°C")
+            print("  Average Heart Rate:", round(avg_heart_rate, 2), "bpm")
+            print("  Average Respiratory Rate:", round(avg_respiratory_rate, 2), "bpm")
+            print("  Average Systolic Blood Pressure:", round(avg_systolic_bp, 2), "mmHg")
+            print("  Average Diastolic Blood Pressure:", round(avg_diastolic_bp, 2), "mmHg")
+            print("  Average Oxygen Saturation:", round(avg_oxygen_saturation, 2), "%")
+        
+        else:
+            print(f"Patient with ID {patientId} not found.")
+
+    # exception handling
+    except ValueError:
+        print("Error: 'patientId' should be an integer.")
+    except TypeError:
+        print("Error: 'patients' should be a dictionary.")
+    except Exception:
+        print("An unexpected error occurred while displaying the data.")
+
+#--- end of displaystats ---#
+
+def validateVisit(patientId, date, temp, hr, rr, sbp, dbp, spo2):
+    """
+    Converts and range checks the values of one visit.
+
+    The arguments are the same as for addPatientData and may be strings.
+    return: A tuple (record, error). record is [patientId, date, temp, hr, rr, sbp, dbp, spo2] with
+    converted values and error is None, or record is None and error is the message describing the problem.
+    """
+    try:
+        # Convert patientId to integer
+        patientId = int(patientId)
+
+        # Check if date is in valid format
+        parts = date.split('-')
+        if len(parts) != 3:
+            return None, "Invalid date. Please enter a valid date."
+        year, month, day = map(int, parts)
+        if not (1900 <= year <= 9999 and 1 <= month <= 12 and 1 <= day <= 31):
+            return None, "Invalid date. Please enter a valid date."
+        # Check the date exists in the calendar
+        try:
+            datetime.date(year, month, day)
+        except ValueError:
+            return None, "Invalid date. Please enter a valid date."
+
+        # Convert other input values to appropriate types
+        date = str(year) + '-' + str(month) + '-' + str(day)
+        temp = float(temp)
+        hr = int(hr)
+        rr = int(rr)
+        sbp = int(sbp)
+        dbp = int(dbp)
+        spo2 = int(spo2)
+    except (ValueError, TypeError, AttributeError):
+        return None, "Invalid input. Please enter valid values."
+
+    # if conditions to check the data range of patients data
+    # Check for invalid temperature range
+    if not (35.0 <= temp <= 42.0):
+        return None, "Invalid temperature. Please enter a temperature between 35.0 and 42.0 Celsius."
+    # Check for invalid heart rate range
+    if not (30 <= hr <= 180):
+        return None, "Invalid heart rate. Please enter a heart rate between 30 and 180 bpm."
+    # Check for invalid respiratory rate range
+    if not (5 <= rr <= 40):
+        return None, "Invalid respiratory rate. Please enter a respiratory rate between 5 and 40 bpm."
+    # Check for invalid systolic blood pressure range
+    if not (70 <= sbp <= 200):
+        return None, "Invalid systolic blood pressure. Please enter a systolic blood pressure between 70 and 200 mmHg."
+    # Check for invalid diastolic blood pressure range
+    if not (40 <= dbp <= 120):
+        return None, "Invalid diastolic blood pressure. Please enter a diastolic blood pressure between 40 and 120 mmHg."
+    # Check for invalid oxygen saturation range
+    if not (70 <= spo2 <= 100):
+        return None, "Invalid oxygen saturation. Please enter an oxygen saturation between 70 and 100%."
+
+    return [patientId, date, temp, hr, rr, sbp, dbp, spo2], None
+
+
+def _storeVisit(patients, record):
+    #Adding a validated record to the store or dictionary
+    patientId = record[0]
+    if isinstance(patients, VisitStore):
+        patients.appendVisit(*record)
+    else:
+        if patientId not in patients:
+            patients[patientId] = []
+        patients[patientId].append(record[1:])
+
+
+def addPatientData(patients, patientId, date, temp, hr, rr, sbp, dbp, spo2, fileName):
+    """
+    Adds new patient data to the patient list.
+
+    patients: The dictionary of patient IDs, where each patient has a list of visits, to add data to.
+    patientId: The ID of the patient to add data for.
+    date: The date of the patient visit in the format 'yyyy-mm-dd'.
+    temp: The patient's body temperature.
+    hr: The patient's heart rate.
+    rr: The patient's respiratory rate.
+    sbp: The patient's systolic blood pressure.
+    dbp: The patient's diastolic blood pressure.
+    spo2: The patient's oxygen saturation level.
+    fileName: The name of the file to append new data to.
+    """
+    if isinstance(patients, ShardedPatients):
+        #Only the shard of the patient is changed
+        try:
+            index = patients.shardOf(int(patientId))
+        except ValueError:
+            print("Invalid input. Please enter valid values.")
+            return
+        return addPatientData(patients.store(index), patientId, date, temp, hr, rr, sbp, dbp, spo2, patients.shardFile(index))
+
+    # exception handling
+    try:
+        # converting and checking the data range of patients data
+        record, error = validateVisit(patientId, date, temp, hr, rr, sbp, dbp, spo2)
+        if error:
+            print(error)
+            return
+
+        with _writeTransaction(patients, fileName):
+            # adding data to the store or dictionary
+            _storeVisit(patients, record)
+
+            # adding the patient data to the file
+            _appendLines(fileName, [','.join(map(str, record))])
+
+        print(f"Visit saved for Patient # {record[0]}")
+
+    # exception handling
+    except ValueError:
+        print("Invalid input. Please enter valid values.")
+    except Exception:
+        print("An unexpected error occured")
+
+#--- end of addPatientData ---#
+
+#When ingested batches are flushed to disk: 'batch' after every batch, 'interval' at most
+#once every fsyncIntervalSeconds, 'never' leaves it to the operating system
+defaultFsyncPolicy = os.environ.get('HIS_FSYNC_POLICY', 'batch')
+fsyncIntervalSeconds = 1.0
+_lastFsync = 0.0
+#Files written under the 'interval' policy since they were last synced, and the timer that syncs them
+_unsyncedFiles = set()
+_fsyncTimer = None
+
+
+def _syncUnsyncedFiles():
+    #Flushing the files the 'interval' policy left unsynced; run by the next batch, the timer and at exit
+    global _lastFsync, _fsyncTimer
+    with _storageLock:
+        if _fsyncTimer is not None:
+            _fsyncTimer.cancel()
+            _fsyncTimer = None
+        for name in _unsyncedFiles:
+            try:
+                descriptor = os.open(name, os.O_RDONLY)
+                try:
+                    os.fsync(descriptor)
+                finally:
+                    os.close(descriptor)
+            except OSError:
+                #The file was removed meanwhile, so there is nothing left to sync
+                pass
+        _unsyncedFiles.clear()
+        _lastFsync = time.monotonic()
+
+
+atexit.register(_syncUnsyncedFiles)
+
+
+def addPatientDataBatch(patients, records, fileName, fsyncPolicy=None):
+    """
+    Adds many visits at once, with the same checks as addPatientData.
+
+    patients: The VisitStore or dictionary of patient IDs, where each patient has a list of visits, to add data to.
+    records: An iterable of (patientId, date, temp, hr, rr, sbp, dbp, spo2) sequences.
+    fileName: The name of the file to append new data to.
+    fsyncPolicy: 'batch', 'interval' or 'never'. If None, defaultFsyncPolicy is used.
+                 With 'batch' the visits are on disk when the call returns. With 'interval' they are on disk
+                 at most fsyncIntervalSeconds later, synced by a later batch or a timer, or at the latest
+                 when the program exits normally; a crash before that can lose them. With 'never' the
+                 operating system decides when they reach the disk.
+    return: A dictionary {'accepted': number of visits saved,
+                          'rejected': [{'index': position in records, 'record': the record, 'reason': message}, ...]}.
+    The accepted visits are written to the file with a single write, or to ShardedPatients with one write per shard.
+    """
+    global _fsyncTimer
+    policy = fsyncPolicy or defaultFsyncPolicy
+    if policy not in ('batch', 'interval', 'never'):
+        raise ValueError(f"Unknown fsync policy '{policy}'")
+
+    if isinstance(patients, ShardedPatients):
+        #Grouping the records by shard; records without a valid patient ID are left for shard 0 to reject
+        groups = {}
+        for index, record in enumerate(records):
+            try:
+                shard = patients.shardOf(int(record[0]))
+            except (IndexError, TypeError, ValueError):
+                shard = 0
+            groups.setdefault(shard, []).append((index, record))
+        result = {'accepted': 0, 'rejected': []}
+        for shard, items in sorted(groups.items()):
+            part = addPatientDataBatch(patients.store(shard), [record for _, record in items], patients.shardFile(shard), policy)
+            result['accepted'] += part['accepted']
+            for rejected in part['rejected']:
+                rejected['index'] = items[rejected['index']][0]
+                result['rejected'].append(rejected)
+        result['rejected'].sort(key=operator.itemgetter('index'))
+        return result
+
+    accepted = []
+    rejected = []
+    for index, record in enumerate(records):
+        try:
+            fields = len(record)
+        except TypeError:
+            rejected.append({'index': index, 'record': record, 'reason': "Invalid record: expected a list of 8 fields"})
+            continue
+        if fields != 8:
+            rejected.append({'index': index, 'record': record, 'reason': f"Invalid number of fields ({fields})"})
+            continue
+        checked, error = validateVisit(*record)
+        if error:
+            rejected.append({'index': index, 'record': record, 'reason': error})
+        else:
+            accepted.append(checked)
+
+    if accepted:
+        with _writeTransaction(patients, fileName):
+            for record in accepted:
+                _storeVisit(patients, record)
+            _appendLines(fileName, [','.join(map(str, record)) for record in accepted], policy == 'batch')
+            if policy == 'interval':
+                _unsyncedFiles.add(os.path.abspath(fileName))
+                wait = _lastFsync + fsyncIntervalSeconds - time.monotonic()
+                if wait <= 0:
+                    _syncUnsyncedFiles()
+                elif _fsyncTimer is None:
+                    #Syncing this batch later, even when no other batch comes
+                    _fsyncTimer = threading.Timer(wait, _syncUnsyncedFiles)
+                    _fsyncTimer.daemon = True
+                    _fsyncTimer.start()
+
+    return {'accepted': len(accepted), 'rejected': rejected}
+
+#--- end of addpatientdatabatch ---#
+
+def findVisitsByDate(patients, year=None, month=None):
+    """
+    Find visits by year, month, or both.
+
+    patients: A VisitStore or a dictionary of patient IDs, where each patient has a list of visits.
+    year: The year to filter by.
+    month: The month to filter by.
+    return: A list of tuples containing patient ID and visit that match the filter, in date order.
+    """
+    #To store the visits of the patients
+    visits = []
+    #Exception Handling
+    try:
+        if isinstance(patients, ShardedPatients):
+            return _shardedVisits(patients, 'visits', year, month)
+        store = _asStore(patients)
+        span = store.dayRange()
+        #Nothing can match an empty store or a month/year outside the calendar
+        if span is None or (month is not None and not 1 <= month <= 12) or (year is not None and not 1 <= year <= 9999):
+            return visits
+
+        #Working out the day ranges to look up in the date index
+        first_year = datetime.date.fromordinal(span[0]).year
+        last_year = datetime.date.fromordinal(span[1]).year
+        years = [year] if year is not None else range(first_year, last_year + 1)
+        if month is None:
+            day_ranges = [(_firstDayOfMonth(y, 1), _firstDayOfMonth(y + 1, 1) - 1) for y in years]
+        else:
+            day_ranges = [(_firstDayOfMonth(y, month), _firstDayOfMonth(y, month + 1) - 1) for y in years]
+
+        for first_day, last_day in day_ranges:
+            visits.extend((store._pids[row], store._visit(row)) for row in store.rowsBetweenDays(first_day, last_day))
+    #Handling errror                
+    except Exception as e:
+        print("An error occurred while searching for visits:", str(e))
+    return visits
+
+
+def _firstDayOfMonth(year, month):
+    #Day number of the first day of the month; month 13 is January of the next year
+    if month == 13:
+        year, month = year + 1, 1
+    if year > 9999:
+        return datetime.date.max.toordinal() + 1
+    return datetime.date(year, month, 1).toordinal()
+
+
+def findVisitsByDateRange(patients, startDate, endDate):
+    """
+    Find visits between two dates, both included.
+
+    patients: A VisitStore or a dictionary of patient IDs, where each patient has a list of visits.
+    startDate: The first date of the range in the format 'yyyy-mm-dd'.
+    endDate: The last date of the range in the format 'yyyy-mm-dd'.
+    return: A list of tuples containing patient ID and visit that fall within the range, in date order.
+    """
+    visits = []
+    #Exception Handling
+    try:
+        if isinstance(patients, ShardedPatients):
+            return _shardedVisits(patients, 'range', startDate, endDate)
+        store = _asStore(patients)
+        rows = store.rowsBetweenDays(parseVisitDate(startDate), parseVisitDate(endDate))
+        visits.extend((store._pids[row], store._visit(row)) for row in rows)
+    #Handling errror
+    except Exception as e:
+        print("An error occurred while searching for visits:", str(e))
+    return visits
+
+
+#--- end of findvisitbydate ---#
+
+
+#Comparison of a column value x with a rule value v, as the method of v that tests it (x < v is v > x)
+_RULE_OPERATORS = {'<': '__gt__', '<=': '__ge__', '>': '__lt__', '>=': '__le__', '==': '__eq__', '!=': '__ne__'}
+
+#The follow-up criteria used when no rules file is configured
+DEFAULT_FOLLOWUP_RULES = {
+    'rules': [
+        {'name': 'abnormal vital sign',
+         'visits': 'any',
+         'when': {'any': [
+             {'vital': 'temperature', 'op': '<', 'value': 30},
+             {'vital': 'heart_rate', 'op': '<', 'value': 60},
+             {'vital': 'respiratory_rate', 'op': '<', 'value': 15},
+             {'vital': 'systolic_bp', 'op': '<', 'value': 110},
+             {'vital': 'diastolic_bp', 'op': '<', 'value': 70},
+             {'vital': 'oxygen_saturation', 'op': '<', 'value': 90},
+         ]}},
+    ]
+}
+
+
+class FollowUpRules:
+    """
+    Compiled follow-up rules.
+
+    The configuration is a dictionary {'rules': [rule, ...]} and a patient needs a follow-up visit when any rule matches.
+    Each rule has a 'when' condition and a 'visits' window:
+      condition: {'vital': name from VITAL_NAMES, 'op': '<', '<=', '>', '>=', '==' or '!=', 'value': number},
+                 {'any': [condition, ...]} or {'all': [condition, ...]}
+      window: 'any' (any visit matches), 'latest' (the most recent visit matches) or
+              {'n': N, 'of': M} (at least N of the M most recent visits match)
+    Conditions are compiled into functions which evaluate a whole column at once into a byte mask
+    (1 for matching visits), combining masks with big integer and/or.
+    Raises ValueError if the configuration is invalid.
+    """
+
+    def __init__(self, config):
+        try:
+            rules = config['rules']
+            self.key = json.dumps(config, sort_keys=True)
+            self._rules = [(self._compile(rule['when']), self._window(rule.get('visits', 'any'))) for rule in rules]
+        except (KeyError, TypeError) as error:
+            raise ValueError(f"Invalid follow-up rules: {error}")
+
+    def _compile(self, condition):
+        if not isinstance(condition, dict):
+            raise ValueError(f"Invalid follow-up condition: {condition}")
+        if 'any' in condition or 'all' in condition:
+            combine_any = 'any' in condition
+            parts = [self._compile(part) for part in condition['any' if combine_any else 'all']]
+            if not parts:
+                raise ValueError("Invalid follow-up rules: empty condition list")
+
+            def evaluate(columns):
+                mask = parts[0](columns)
+                for part in parts[1:]:
+                    #Stopping early once every visit matches (any) or none does (all)
+                    if (0 not in mask) if combine_any else (1 not in mask):
+                        break
+                    first = int.from_bytes(mask, 'little')
+                    other = int.from_bytes(part(columns), 'little')
+                    mask = (first | other if combine_any else first & other).to_bytes(len(mask), 'little')
+                return mask
+            return evaluate
+
+        if condition.get('vital') not in VITAL_NAMES or condition.get('op') not in _RULE_OPERATORS:
+            raise ValueError(f"Invalid follow-up condition: {condition}")
+        column = VITAL_NAMES.index(condition['vital'])
+        test = getattr(float(condition['value']), _RULE_OPERATORS[condition['op']])
+        return lambda columns: bytes(map(test, columns[column]))
+
+    def _window(self, window):
+        if window in ('any', 'latest'):
+            return window, 0, 0
+        if isinstance(window, dict) and 0 < int(window['n']) <= int(window['of']):
+            return 'recent', int(window['n']), int(window['of'])
+        raise ValueError(f"Invalid follow-up window: {window}")
+
+    def masks(self, columns):
+        """
+        Returns one visit mask per rule for the given vital sign columns.
+        """
+        return [(condition(columns), window) for condition, window in self._rules]
+
+    @staticmethod
+    def matches(masks, ranges, days):
+        """
+        Tells whether a patient whose visits are the given [start, stop) ranges of the masks needs a follow-up.
+
+        days: The day numbers of the visits, indexed like the masks.
+        """
+        for mask, (kind, n, m) in masks:
+            if kind == 'any':
+                if any(mask.find(1, start, stop) != -1 for start, stop in ranges):
+                    return True
+                continue
+            rows = [row for start, stop in ranges for row in range(start, stop)]
+            if not rows:
+                continue
+            if kind == 'latest':
+                if mask[max(rows, key=days.__getitem__)]:
+                    return True
+            elif sum(mask[row] for row in sorted(rows, key=days.__getitem__)[-m:]) >= n:
+                return True
+        return False
+
+
+def loadFollowUpRules(fileName):
+    """
+    Loads follow-up rules from a JSON file in the format described in FollowUpRules.
+    """
+    with open(fileName) as file:
+        return FollowUpRules(json.load(file))
+
+
+def _configuredFollowUpRules():
+    #Rules from the file named by HIS_FOLLOWUP_RULES, or the default rules, loaded once
+    global followUpRules
+    if followUpRules is None:
+        path = os.environ.get('HIS_FOLLOWUP_RULES')
+        followUpRules = loadFollowUpRules(path) if path else FollowUpRules(DEFAULT_FOLLOWUP_RULES)
+    return followUpRules
+
+#Rules used by findPatientsWhoNeedFollowUp when none are given
+followUpRules = None
+
+
+def findPatientsWhoNeedFollowUp(patients, rules=None):
+    """
+    Find patients who need follow-up visits based on abnormal vital signs.
+
+    patients: A VisitStore or a dictionary of patient IDs, where each patient has a list of visits.
+    rules: The FollowUpRules to apply. If None, the rules of HIS_FOLLOWUP_RULES or the default rules are used.
+    return: A list of patient IDs that need follow-up visits to to abnormal health stats.
+    Results are cached per patient in the store and recomputed only for patients whose visits changed.
+    """
+    #To store the patients id who needs followup
+    followup_patients = []
+    #Exception Handling
+    try:
+        if isinstance(patients, ShardedPatients):
+            return _shardedFollowUp(patients, rules)
+        rules = rules or _configuredFollowUpRules()
+        store = _asStore(patients)
+        cache = store._followUpCache.setdefault(rules.key, {})
+        missing = [patient_id for patient_id in store if patient_id not in cache]
+
+        if len(missing) * 4 > len(store):
+            #Evaluating the rules over the whole columns at once
+            masks = rules.masks(store.columns())
+            for patient_id in missing:
+                cache[patient_id] = rules.matches(masks, store.ranges(patient_id), store._days)
+        else:
+            #Evaluating the rules only over the visits of the patients that changed
+            for patient_id in missing:
+                ranges = store.ranges(patient_id)
+                columns = [store.gather(column, ranges) for column in store.columns()]
+                masks = rules.masks(columns)
+                cache[patient_id] = rules.matches(masks, [[0, len(columns[0])]], store.gather(store._days, ranges))
+
+        #for loops to acces the the patient id and its result
+        followup_patients = [patient_id for patient_id in store if cache[patient_id]]
+        return followup_patients
+    
+    #Handling exception
+    except Exception:
+        print("An unexpected error occured")
+
+#--- end of findpatientswhoneedfollowup ---#
+
+#Change of the latest visit against the average of the visits before it that counts as rapid
+#deterioration; positive for vitals that get worse when rising, negative for ones that get worse when falling
+DETERIORATION_THRESHOLDS = {
+    'temperature': 1.0,
+    'heart_rate': 20,
+    'respiratory_rate': 6,
+    'systolic_bp': -20,
+    'oxygen_saturation': -4,
+}
+
+#Number of visits in the rolling window of computeTrends
+TREND_WINDOW = 3
+
+
+def _movingAverages(values, window):
+    #Average of each value and up to window - 1 values before it, kept as a running sum
+    averages = []
+    total = 0
+    for position, value in enumerate(values):
+        total += value
+        if position >= window:
+            total -= values[position - window]
+        averages.append(total / min(position + 1, window))
+    return averages
+
+
+def _slopePerYear(days, values):
+    #Least squares slope of the values against the visit dates, in units per year
+    count = len(values)
+    if count < 2:
+        return None
+    mean_day = sum(days) / count
+    mean_value = sum(values) / count
+    offsets = [day - mean_day for day in days]
+    spread = math.fsum(map(operator.mul, offsets, offsets))
+    if spread == 0:
+        return None
+    return math.fsum(offset * (value - mean_value) for offset, value in zip(offsets, values)) / spread * 365.25
+
+
+def _patientTrends(days, columns, window):
+    #Trends of one patient from the date-sorted day numbers and vital sign values
+    trends = {'dates': [formatVisitDate(day) for day in days], 'vitals': {}, 'deteriorating': []}
+    for name, values in zip(VITAL_NAMES, columns):
+        trends['vitals'][name] = {'movingAverage': _movingAverages(values, window),
+                                  'deltas': list(map(operator.sub, values[1:], values[:-1])),
+                                  'slopePerYear': _slopePerYear(days, values)}
+        threshold = DETERIORATION_THRESHOLDS.get(name)
+        if threshold is not None and len(values) > 1:
+            baseline = values[-window - 1:-1]
+            change = values[-1] - sum(baseline) / len(baseline)
+            if (change >= threshold) if threshold > 0 else (change <= threshold):
+                trends['deteriorating'].append(name)
+    return trends
+
+
+def computeTrends(patients, patientId=0, window=TREND_WINDOW):
+    """
+    Computes rolling-window trends of every vital sign, over the visits of a patient in date order.
+
+    patients: A VisitStore or a dictionary of patient IDs, where each patient has a list of visits.
+    patientId: The ID of the patient to compute trends for. If 0, the trends of every patient are returned.
+    window: The number of visits averaged by the moving average and used as the deterioration baseline.
+    return: For one patient, a dictionary
+            {'dates': [date of each visit, ascending],
+             'vitals': {vital name: {'movingAverage': [average of the visit and the window - 1 before it],
+                                     'deltas': [change from the previous visit],
+                                     'slopePerYear': least squares trend per year, None with fewer than two dates}},
+             'deteriorating': [vital names whose latest value moved past DETERIORATION_THRESHOLDS]};
+            for all patients, a dictionary mapping each patient ID to that dictionary.
+    Raises KeyError if the patient is not found, ValueError if window is less than 1.
+    Results are cached per patient in the store and recomputed only for patients whose visits changed.
+    """
+    if window < 1:
+        raise ValueError(f"Invalid trend window ({window})")
+    if isinstance(patients, ShardedPatients):
+        if patientId != 0:
+            return computeTrends(patients.store(patients.shardOf(patientId)), patientId, window)
+        return {patient_id: trends for part in _fanOut(patients, 'trends', 0, window) for patient_id, trends in part.items()}
+    store = _asStore(patients)
+    cache = store._trendCache.setdefault(window, {})
+    if patientId != 0:
+        store.ranges(patientId)
+        wanted = [patientId]
+    else:
+        wanted = list(store)
+
+    #Sorting the rows of every patient that changed by date and computing their trends in one pass
+    days = store._days
+    columns = store.columns()
+    for patient_id in wanted:
+        if patient_id in cache:
+            continue
+        rows = [row for start, stop in store.ranges(patient_id) for row in range(start, stop)]
+        rows.sort(key=days.__getitem__)
+        cache[patient_id] = _patientTrends([days[row] for row in rows],
+                                           [[column[row] for row in rows] for column in columns], window)
+
+    if patientId != 0:
+        return cache[patientId]
+    return {patient_id: cache[patient_id] for patient_id in wanted}
+
+
+def findPatientsWithDeterioration(patients, window=TREND_WINDOW):
+    """
+    Finds patients whose latest visit shows a rapid deterioration of at least one vital sign.
+
+    patients: A VisitStore or a dictionary of patient IDs, where each patient has a list of visits.
+    window: The number of earlier visits the latest one is compared with.
+    return: A dictionary mapping each such patient ID to the names of the deteriorating vital signs.
+    """
+    if isinstance(patients, ShardedPatients):
+        if window < 1:
+            raise ValueError(f"Invalid trend window ({window})")
+        return {patient_id: names for part in _fanOut(patients, 'deterioration', window) for patient_id, names in part.items()}
+    return {patient_id: trends['deteriorating'] for patient_id, trends in computeTrends(patients, 0, window).items()
+            if trends['deteriorating']}
+
+
+def displayTrends(patients, patientId, window=TREND_WINDOW):
+    """
+    Displays the visits of a patient with the moving average and change of each vital sign.
+
+    patients: A VisitStore or a dictionary of patient IDs, where each patient has a list of visits.
+    patientId: The ID of the patient to display the trends of.
+    window: The number of visits in the moving average.
+    """
+    try:
+        trends = computeTrends(patients, int(patientId), window)
+    except KeyError:
+        print(f"Patient with ID {patientId} not found.")
+        return
+    except ValueError as error:
+        print(error)
+        return
+
+    print(f"Trends for Patient #{patientId} (moving average of {window} visit(s)):")
+    for name in VITAL_NAMES:
+        vital = trends['vitals'][name]
+        slope = vital['slopePerYear']
+        print(f" {name.replace('_', ' ').capitalize()}: " + (f"{slope:+.2f} per year" if slope is not None else "no trend"))
+        for position, date in enumerate(trends['dates']):
+            delta = f"{vital['deltas'][position - 1]:+g}" if position else "-"
+            print(f"  {date}: average {vital['movingAverage'][position]:.2f}, change {delta}")
+    if trends['deteriorating']:
+        print(f" Rapid deterioration: {', '.join(trends['deteriorating'])}")
+
+#--- end of computetrends ---#
+
+
+def deleteAllVisitsOfPatient(patients, patientId, filename):
+    """
+    Delete all visits of a particular patient.
+
+    patients: The dictionary of patient IDs, where each patient has a list of visits, to delete data from.
+    patientId: The ID of the patient to delete data for.
+    filename: The name of the file to save the updated patient data.
+    return: True if the visits were deleted and the change was written to the file, False if the patient
+    was not found or the file could not be updated.
+    In 'log' storage mode a tombstone record is appended to the file, which is compacted once it is
+    mostly garbage; in 'rewrite' mode the whole file is rewritten.
+    """
+    if isinstance(patients, ShardedPatients):
+        #Only the shard of the patient is changed
+        index = patients.shardOf(patientId)
+        return deleteAllVisitsOfPatient(patients.store(index), patientId, patients.shardFile(index))
+
+    #Exception Handling
+    try:
+        if patientId not in patients:
+            return False
+        with _writeTransaction(patients, filename):
+            with _phase('delete.memory'):
+                if isinstance(patients, VisitStore):
+                    removed = patients.deletePatient(patientId)
+                else:
+                    removed = len(patients.pop(patientId))
+
+            if storageMode == 'log':
+                #Appending the tombstone instead of rewriting the file
+                with _phase('delete.append'):
+                    _appendLines(filename, [f"{TOMBSTONE_MARKER},{patientId}"])
+                key = os.path.abspath(filename)
+                _logGarbage[key] = _logGarbage.get(key, 0) + removed + 1
+            else:
+                with _phase('delete.rewrite'):
+                    compactPatientFile(patients, filename)
+        if storageMode == 'log':
+            with _phase('delete.compaction'):
+                _maybeCompact(patients, filename)
+        return True
+
+    #Handling exception            
+    except FileNotFoundError:
+        print(f"The file '{filename}' could not be found.")
+    
+    #Handling exception
+    except Exception :
+        print("An unexpected error occurred while reading the file.")
+    return False
+
+#--- end of deleteallvisitsofpatients ---#
+
+def iterPatientsFromFile(fileName, report=None):
+    """
+    Streams the valid visits of a patient file without loading the whole file.
+
+    fileName: The name of the file to read patient data from.
+    report: Optional dictionary which is filled with the same 'rows', 'rejected' and 'byReason' counts
+    as the loadReport of readPatientsFromFile. Invalid lines are counted, not printed.
+    Yields (patientId, visit) tuples in file order, where visit is [date (str), temperature, heart rate,
+    respiratory rate, systolic bp, diastolic bp, oxygen saturation].
+    Visits removed by a later tombstone record are skipped. Tombstones are found with a quick scan of the
+    mapped file before streaming, so memory only grows with the number of deleted patients.
+    """
+    if report is None:
+        report = {}
+    report.update({'rows': 0, 'rejected': 0, 'byReason': {}})
+    by_reason = report['byReason']
+    deleted = _tombstoneOffsets(fileName)
+    offset = 0
+    with open(fileName, 'rb') as file:
+        for raw in file:
+            line_offset = offset
+            offset += len(raw)
+            parsed = _parseLine(raw.decode(errors='replace'))
+            if parsed is None or parsed[0] == 'delete':
+                continue
+            if parsed[0] == 'error':
+                report['rejected'] += 1
+                by_reason[parsed[1]] = by_reason.get(parsed[1], 0) + 1
+                continue
+            patient_id, day, *vitals = parsed[1]
+            report['rows'] += 1
+            #Skipping visits that a tombstone further down the file removes
+            if patient_id in deleted and line_offset < deleted[patient_id]:
+                continue
+            yield patient_id, [formatVisitDate(day)] + vitals
+
+
+def _tombstoneOffsets(fileName):
+    #patientId -> byte offset of the last tombstone of the patient in the file
+    offsets = {}
+    marker = f"\n{TOMBSTONE_MARKER},".encode()
+    with open(fileName, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return offsets
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            #Start of the first tombstone line, either at the very beginning or right after a newline
+            if data[:len(marker) - 1] == marker[1:]:
+                start = 0
+            else:
+                start = data.find(marker)
+                start = start + 1 if start != -1 else -1
+            while start != -1:
+                end = data.find(b'\n', start)
+                if end == -1:
+                    end = len(data)
+                parsed = _parseLine(data[start:end].decode(errors='replace'))
+                if parsed is not None and parsed[0] == 'delete':
+                    offsets[parsed[1]] = start
+                start = data.find(marker, end)
+                start = start + 1 if start != -1 else -1
+    return offsets
+
+
+def streamVisitsByDate(records, year=None, month=None):
+    """
+    Streaming version of findVisitsByDate.
+
+    records: An iterable of (patientId, visit) tuples, such as iterPatientsFromFile.
+    year: The year to filter by.
+    month: The month to filter by.
+    Yields the (patientId, visit) tuples that match the filter, in the order of records.
+    """
+    for patient_id, visit in records:
+        visit_year, visit_month, _ = visit[0].split('-')
+        if (year is None or int(visit_year) == year) and (month is None or int(visit_month) == month):
+            yield patient_id, visit
+
+
+def streamPatientsWhoNeedFollowUp(records, rules=None):
+    """
+    Streaming version of findPatientsWhoNeedFollowUp.
+
+    records: An iterable of (patientId, visit) tuples, such as iterPatientsFromFile.
+    rules: The FollowUpRules to apply. If None, the rules of HIS_FOLLOWUP_RULES or the default rules are used.
+    Yields each patient ID that needs a follow-up visit once. Patients matching a rule with an 'any' window
+    are yielded as soon as the matching visit is seen. 'latest' and N-of-M windows depend on the most recent
+    visits, so the last M (date, match) pairs of every patient are kept for them, and the patients they
+    match are yielded after the last record.
+    """
+    rules = rules or _configuredFollowUpRules()
+    flagged = set()
+    #patientId -> {rule position: min-heap of the (day, tie breaker, match) entries of the most recent visits}
+    windows = {}
+    for order, (patient_id, visit) in enumerate(records):
+        if patient_id in flagged:
+            continue
+        masks = rules.masks([[value] for value in visit[1:]])
+        if any(mask[0] for mask, (kind, _, _) in masks if kind == 'any'):
+            flagged.add(patient_id)
+            windows.pop(patient_id, None)
+            yield patient_id
+            continue
+        day = parseVisitDate(visit[0])
+        for position, (mask, (kind, _, m)) in enumerate(masks):
+            if kind == 'any':
+                continue
+            #Among visits on the same day the store takes the first one as latest and the last ones as recent
+            heap = windows.setdefault(patient_id, {}).setdefault(position, [])
+            heapq.heappush(heap, (day, -order if kind == 'latest' else order, mask[0]))
+            if len(heap) > (1 if kind == 'latest' else m):
+                heapq.heappop(heap)
+
+    for patient_id, heaps in windows.items():
+        for position, heap in heaps.items():
+            _, (kind, n, _) = rules._rules[position]
+            if (heap[0][2] if kind == 'latest' else sum(entry[2] for entry in heap) >= n):
+                yield patient_id
+                break
+
+
+def streamStats(records):
+    """
+    Streaming version of the statistics of computeStats, in constant memory.
+
+    records: An iterable of (patientId, visit) tuples, such as iterPatientsFromFile.
+    return: A dictionary mapping each name in VITAL_NAMES to its count, mean, min, max and variance.
+    Percentiles need all values and are not computed.
+    """
+    aggregate = RunningAggregate()
+    minimums = [math.inf] * len(VITAL_NAMES)
+    maximums = [-math.inf] * len(VITAL_NAMES)
+    for _, visit in records:
+        values = visit[1:]
+        aggregate.add(values)
+        minimums = list(map(min, minimums, values))
+        maximums = list(map(max, maximums, values))
+    return _aggregateStats(aggregate, minimums, maximums)
+
+
+def _aggregateStats(aggregate, minimums, maximums):
+    #Statistics dictionary in the format of computeStats, from a RunningAggregate and the extremes
+    if aggregate.count == 0:
+        return {name: {'count': 0, 'mean': None, 'min': None, 'max': None, 'variance': None, 'percentiles': {}}
+                for name in VITAL_NAMES}
+    return {name: {'count': aggregate.count, 'mean': mean, 'min': low, 'max': high, 'variance': variance, 'percentiles': {}}
+            for name, mean, low, high, variance in zip(VITAL_NAMES, aggregate.means, minimums, maximums, aggregate.variances())}
+
+#--- end of streaming ---#
+
+#Name of the manifest in the shard directory of a patient file
+SHARD_MANIFEST = 'manifest.json'
+SHARD_VERSION = 1
+#Worker processes used to query the shards; 1 queries them one after another in this process
+shardWorkers = int(os.environ.get('HIS_SHARD_WORKERS', os.cpu_count() or 1))
+
+
+def shardDirectory(fileName):
+    """
+    Returns the directory holding the shards of a patient file.
+    """
+    return fileName + '.shards'
+
+
+def _shardIndex(patientId, shards):
+    #Shard of a patient; crc32 of the 8 byte id, so it is the same in every process and spreads sequential ids
+    return zlib.crc32(int(patientId).to_bytes(8, 'little', signed=True)) % shards
+
+
+class ShardedPatients(Mapping):
+    """
+    Patient data hash-partitioned by patient ID over the shard files of a directory.
+
+    Returned by readPatientsFromFile when migrateToShards has created '<file>.shards/manifest.json'.
+    Every shard is an ordinary patient file with its own log, lock and snapshot, loaded into a VisitStore
+    on first use. Like VisitStore it is a read-only mapping of patientId -> visits. displayStats, computeStats,
+    computeStatsByPatient, computeTrends, findPatientsWithDeterioration, findVisitsByDate, findVisitsByDateRange
+    and findPatientsWhoNeedFollowUp fan out over the shards in worker processes and merge the partial results;
+    queries for one patient, and adding and deleting visits, only touch the shard of the patient.
+    """
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.directory = shardDirectory(fileName)
+        with open(os.path.join(self.directory, SHARD_MANIFEST)) as file:
+            self.manifest = json.load(file)
+        if self.manifest.get('version') != SHARD_VERSION:
+            raise ValueError(f"Unsupported shard manifest version {self.manifest.get('version')}")
+        #VisitStore of each shard, loaded on first use
+        self._stores = [None] * self.manifest['shards']
+
+    def shardOf(self, patientId):
+        """
+        Returns the index of the shard holding the visits of a patient.
+        """
+        return _shardIndex(patientId, len(self._stores))
+
+    def shardFile(self, index):
+        return os.path.join(self.directory, self.manifest['files'][index])
+
+    def store(self, index):
+        """
+        Returns the VisitStore of a shard, reading the shard file the first time.
+        """
+        if self._stores[index] is None:
+            self._stores[index] = readPatientsFromFile(self.shardFile(index))
+        return self._stores[index]
+
+    def stores(self):
+        return [self.store(index) for index in range(len(self._stores))]
+
+    def __getitem__(self, patientId):
+        return self.store(self.shardOf(patientId))[patientId]
+
+    def __contains__(self, patientId):
+        return isinstance(patientId, int) and patientId in self.store(self.shardOf(patientId))
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.stores())
+
+    def __len__(self):
+        return sum(map(len, self.stores()))
+
+    def __repr__(self):
+        return f"ShardedPatients({self.fileName!r}, {len(self._stores)} shards)"
+
+    def visitCount(self):
+        return sum(store.visitCount() for store in self.stores())
+
+
+def _shardFollowUp(store, config):
+    #Follow-up query of a shard; the rules are passed as their configuration because compiled rules cannot be pickled
+    return findPatientsWhoNeedFollowUp(store, FollowUpRules(config) if config is not None else None)
+
+
+def _shardValueCounts(store):
+    #value -> count of every vital sign column of a shard, which merge exactly across shards
+    return store.valueCounts()
+
+
+#Queries the shards can run, by the name sent to the worker processes
+_SHARD_QUERIES = {
+    'aggregate': VisitStore.aggregate,
+    'visits': findVisitsByDate,
+    'range': findVisitsByDateRange,
+    'followup': _shardFollowUp,
+    'counts': _shardValueCounts,
+    'statsByPatient': computeStatsByPatient,
+    'trends': computeTrends,
+    'deterioration': findPatientsWithDeterioration,
+}
+
+#Shard file -> (manifest id, VisitStore) loaded by this worker process
+_workerShards = {}
+#Single-process pools; shard i always goes to pool i % len(pools), so every worker only keeps its own shards
+_shardPools = []
+#Held while the pools are created, replaced or closed, and while queries are submitted to them
+_shardPoolsLock = threading.Lock()
+
+
+def _queryShard(shardFile, manifestId, query, arguments):
+    #Running a query against one shard in a worker process, keeping the shard loaded for the next query
+    cached = _workerShards.get(shardFile)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if cached is None or cached[0] != manifestId:
+            cached = _workerShards[shardFile] = (manifestId, readPatientsFromFile(shardFile))
+        else:
+            refreshPatients(cached[1], shardFile)
+    return _SHARD_QUERIES[query](cached[1], *arguments)
+
+
+def _closeShardPools(pools=None):
+    #Shutting down the worker pools. With pools given (the broken pools of a failed query), they are only
+    #dropped if they are still in use, so pools another thread has created meanwhile are kept
+    with _shardPoolsLock:
+        if pools is not None and pools != _shardPools:
+            return
+        closed = list(_shardPools)
+        _shardPools.clear()
+    for pool in closed:
+        pool.shutdown(wait=pools is None, cancel_futures=True)
 
-    #Handling exception            
-    except FileNotFoundError:
-        print(f"The file '{fileName}' could not be found.")
-    
-    #Handling exception
-    except Exception :
-        print("An unexpected error occurred while reading the file.")
 
-    return patients
-#Name of the text file
-fileName='patients.txt'
+def _fanOut(patients, query, *arguments):
+    #Running a query on every shard, in the worker processes when there are any; returns the results in shard order
+    count = len(patients._stores)
+    workers = min(shardWorkers, count)
+    if workers > 1:
+        pools = None
+        try:
+            with _shardPoolsLock:
+                if len(_shardPools) != workers:
+                    #Queries other threads submitted to the old pools still run, as they are not cancelled
+                    for pool in _shardPools:
+                        pool.shutdown(wait=False)
+                    _shardPools[:] = [concurrent.futures.ProcessPoolExecutor(max_workers=1) for _ in range(workers)]
+                pools = list(_shardPools)
+                futures = [pools[index % workers].submit(_queryShard, patients.shardFile(index),
+                                                         patients.manifest['id'], query, arguments)
+                           for index in range(count)]
+            return [future.result() for future in futures]
+        except (OSError, concurrent.futures.process.BrokenProcessPool):
+            #Falling back to querying in this process when no worker processes can be used
+            if pools is not None:
+                _closeShardPools(pools)
+    return [_SHARD_QUERIES[query](patients.store(index), *arguments) for index in range(count)]
 
-#--- end of readpatientsfromfile ---#
 
-def displayPatientData(patients, patientId=0):
-    """
-    Displays patient data for a given patient ID.
+def _shardedAggregate(patients):
+    #Running aggregate of all patients, merged from the aggregates of the shards
+    total = RunningAggregate()
+    for part in _fanOut(patients, 'aggregate'):
+        total.merge(part)
+    return total
 
-    patients: A dictionary of patient dictionaries, where each patient has a list of visits.
-    patientId: The ID of the patient to display data for. If 0, data for all patients will be displayed.
+
+def _shardedStats(patients, percentiles):
+    #Statistics of computeStats for all patients, from the merged counts of each value in every shard
+    counts = [Counter() for _ in VITAL_NAMES]
+    for part in _fanOut(patients, 'counts'):
+        for total, shard_counts in zip(counts, part):
+            total.update(shard_counts)
+    return {name: _columnStats(column_counts, percentiles) for name, column_counts in zip(VITAL_NAMES, counts)}
+
+
+def _shardedVisits(patients, query, *arguments):
+    #Visits of every shard, merged in date order; the iso dates sort as text
+    parts = _fanOut(patients, query, *arguments)
+    return list(heapq.merge(*parts, key=lambda item: item[1][0]))
+
+
+def _shardedFollowUp(patients, rules):
+    #Patients who need follow-up in every shard, in patient ID order
+    parts = _fanOut(patients, 'followup', json.loads(rules.key) if rules is not None else None)
+    if any(part is None for part in parts):
+        return None
+    return sorted(itertools.chain.from_iterable(parts))
+
+
+def migrateToShards(fileName, shards):
     """
-    #for all the patients information
-    if patientId == 0:
-        for patient_id, visits in patients.items():
-            print(f"Patient ID: {patient_id}")
-            for visit in visits:
-                #Printing the information
-                print(f"  Visit Date: {visit[0]}")
-                print(f"    Temperature: {visit[1]} C")
-                print(f"    Heart Rate: {visit[2]} bpm")
-                print(f"    Respiratory Rate: {visit[3]} bpm")
-                print(f"    Systolic Blood Pressure: {visit[4]} mmHg")
-                print(f"    Diastolic Blood Pressure: {visit[5]} mmHg")
-                print(f"    Oxygen Saturation: {visit[6]} %")
-                print()
+    Converts a patient file to sharded storage, changes its number of shards, or converts it back to one file.
 
-    #For single patient information            
-    elif patientId in patients:
-        print(f"Patient ID: {patientId}")
-        for visit in patients[patientId]:
-            #Printing the information
-            print(f"  Visit Date: {visit[0]}")
-            print(f"    Temperature: {visit[1]} C")
-            print(f"    Heart Rate: {visit[2]} bpm")
-            print(f"    Respiratory Rate: {visit[3]} bpm")
-            print(f"    Systolic Blood Pressure: {visit[4]} mmHg")
-            print(f"    Diastolic Blood Pressure: {visit[5]} mmHg")
-            print(f"    Oxygen Saturation: {visit[6]} %")
-            print()
-
-    #If patientId not found
+    fileName: The name of the patient file, e.g. 'patients.txt'.
+    shards: The number of shard files. If 0, the shards are merged back into fileName.
+    return: The number of visits migrated.
+    The visits are written to a new directory which then replaces '<file>.shards', so an interrupted
+    migration leaves the old data in place. A single file that is converted is kept as '<file>.unsharded'.
+    Other processes must not write to the data while it is being migrated.
+    """
+    if shards < 0:
+        raise ValueError(f"Invalid number of shards ({shards})")
+    directory = shardDirectory(fileName)
+    manifest_file = os.path.join(directory, SHARD_MANIFEST)
+    sharded = os.path.exists(manifest_file)
+    if sharded:
+        with open(manifest_file) as file:
+            sources = [os.path.join(directory, name) for name in json.load(file)['files']]
+    elif os.path.exists(fileName):
+        sources = [fileName]
     else:
-        print(f"Patient with ID {patientId} not found.")
-    
-    return patients
+        raise FileNotFoundError(fileName)
+    records = itertools.chain.from_iterable(iterPatientsFromFile(source) for source in sources)
+    migrated = 0
 
-#--- end of displaypatientdata ---#
+    with _patientFileLock(fileName, exclusive=True) as lock:
+        if shards == 0:
+            if not sharded:
+                return sum(1 for _ in records)
+            temporary = fileName + '.tmp'
+            with open(temporary, 'w') as file:
+                for patient_id, visit in records:
+                    file.write(("\n" if migrated else "") + _visitRecord(patient_id, visit))
+                    migrated += 1
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, fileName)
+            shutil.rmtree(directory)
+            #Telling readers of an older single file that it was rewritten
+            generation = _readGeneration(lock) + 1
+            lock.truncate(0)
+            lock.write(str(generation))
+            lock.flush()
+            return migrated
 
-def displayStats(patients, patientId=0):
+        #Writing the new shards next to the old ones and swapping the directories
+        temporary = directory + '.tmp'
+        shutil.rmtree(temporary, ignore_errors=True)
+        os.makedirs(temporary)
+        names = [f"shard-{index:03d}.txt" for index in range(shards)]
+        files = [open(os.path.join(temporary, name), 'w') for name in names]
+        try:
+            written = [False] * shards
+            for patient_id, visit in records:
+                index = _shardIndex(patient_id, shards)
+                files[index].write(("\n" if written[index] else "") + _visitRecord(patient_id, visit))
+                written[index] = True
+                migrated += 1
+            for file in files:
+                file.flush()
+                os.fsync(file.fileno())
+        finally:
+            for file in files:
+                file.close()
+        manifest = {'version': SHARD_VERSION, 'id': os.urandom(8).hex(), 'shards': shards,
+                    'hash': 'crc32', 'files': names}
+        with open(os.path.join(temporary, SHARD_MANIFEST), 'w') as file:
+            json.dump(manifest, file, indent=2)
+
+        if sharded:
+            os.replace(directory, directory + '.old')
+        os.replace(temporary, directory)
+        if sharded:
+            shutil.rmtree(directory + '.old')
+        else:
+            os.replace(fileName, fileName + '.unsharded')
+    return migrated
+
+#--- end of sharding ---#
+
+def _visitJson(patientId, visit):
+    #JSON object of one visit
+    record = {'patientId': patientId, 'date': visit[0]}
+    record.update(zip(VITAL_NAMES, visit[1:]))
+    return record
+
+
+class PatientService:
     """
-    Prints the average of each vital sign for all patients or for the specified patient.
+    Local HTTP/JSON query service keeping the patient data in memory.
 
-    patients: A dictionary of patient IDs, where each patient has a list of visits.
-    patientId: The ID of the patient to display vital signs for. If 0, vital signs will be displayed for all patients.
+    The data is loaded once through readPatientsFromFile. Requests are handled on one asyncio event loop:
+      GET    /stats?patientId=N          statistics of computeStats (all patients when N is 0 or missing)
+      GET    /visits?year=Y&month=M      findVisitsByDate; from=yyyy-mm-dd&to=yyyy-mm-dd gives a date range
+      GET    /followup                   findPatientsWhoNeedFollowUp
+      GET    /trends?patientId=N&window=W  computeTrends; without patientId, findPatientsWithDeterioration
+      POST   /visits                     addPatientData for one JSON visit object or a list of them
+      DELETE /patients/N                 deleteAllVisitsOfPatient
+      GET    /metrics                    metricsText, as plain text (empty unless instrumentation is enabled)
+    Queries and writes run in a thread pool behind a reader/writer guard, so the event loop keeps
+    accepting requests while they run: reads run concurrently with each other, and a write waits for
+    the running reads and holds back new ones. Writes are queued to a single writer task, so they are
+    applied one at a time in arrival order. The all-patients statistics and the follow-up list are
+    cached until the next write.
     """
-    #Exception Handling
-    try:
-        # type casting the patientId into suitable type
-        patientId = int(patientId)
 
-        # if else conditions to check the status of patientId for printing the stats accordingly
-        if patientId == 0:
-            # calculating average of all patients data
-            avg_temperature = sum(visit[1] for visits in patients.values() for visit in visits) / sum(len(visits) for visits in patients.values())
-            avg_heart_rate = sum(visit[2] for visits in patients.values() for visit in visits) / sum(len(visits) for visits in patients.values())
-            avg_respiratory_rate = sum(visit[3] for visits in patients.values() for visit in visits) / sum(len(visits) for visits in patients.values())
-            avg_systolic_bp = sum(visit[4] for visits in patients.values() for visit in visits) / sum(len(visits) for visits in patients.values())
-            avg_diastolic_bp = sum(visit[5] for visits in patients.values() for visit in visits) / sum(len(visits) for visits in patients.values())
-            avg_oxygen_saturation = sum(visit[6] for visits in patients.values() for visit in visits) / sum(len(visits) for visits in patients.values())
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.patients = readPatientsFromFile(fileName)
+        self._cache = {}
+        self._writes = None
+        self._guard = None
+        self._executor = None
 
-            # printing the average vital signs for all patients
-            print("Vital Signs for All Patients:")
-            print("  Average Temperature:", round(avg_temperature, 2), "°C")
-            print("  Average Heart Rate:", round(avg_heart_rate, 2), "bpm")
-            print("  Average Respiratory Rate:", round(avg_respiratory_rate, 2), "bpm")
-            print("  Average Systolic Blood Pressure:", round(avg_systolic_bp, 2), "mmHg")
-            print("  Average Diastolic Blood Pressure:", round(avg_diastolic_bp, 2), "mmHg")
-            print("  Average Oxygen Saturation:", round(avg_oxygen_saturation, 2), "%")
+    async def serve(self, host='127.0.0.1', port=8080, ready=None):
+        """
+        Serves requests until the task is cancelled.
 
-        elif patientId in patients:
-            visits = patients[patientId]
-            if not visits:
-                print(f"No data found for patient with ID {patientId}.")
-                return
+        ready: Optional callable run with the listening server once it accepts connections.
+        """
+        self._writes = asyncio.Queue()
+        self._guard = _ReadWriteGuard()
+        self._executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix='patient-service')
+        writer_task = asyncio.create_task(self._writer())
+        try:
+            server = await asyncio.start_server(self._handle, host, port)
+            if ready is not None:
+                ready(server)
+            async with server:
+                await server.serve_forever()
+        finally:
+            writer_task.cancel()
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _writer(self):
+        #Applying the queued writes one at a time, with no read running
+        loop = asyncio.get_running_loop()
+        while True:
+            operation, future = await self._writes.get()
+            async with self._guard.writing():
+                try:
+                    result = await loop.run_in_executor(self._executor, operation)
+                except Exception as error:
+                    if not future.done():
+                        future.set_exception(error)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+                finally:
+                    #A write that failed part way may still have changed the data
+                    self._cache.clear()
 
-            # calculating average of single patient data
-            num_visits = len(visits)
-            avg_temperature = sum(visit[1] for visit in visits) / num_visits
-            avg_heart_rate = sum(visit[2] for visit in visits) / num_visits
-            avg_respiratory_rate = sum(visit[3] for visit in visits) / num_visits
-            avg_systolic_bp = sum(visit[4] for visit in visits) / num_visits
-            avg_diastolic_bp = sum(visit[5] for visit in visits) / num_visits
-            avg_oxygen_saturation = sum(visit[6] for visit in visits) / num_visits
+    async def _write(self, operation):
+        future = asyncio.get_running_loop().create_future()
+        await self._writes.put((operation, future))
+        return await future
 
-            # printing the average vital signs for single patient
-            print(f"Vital Signs for Patient {patientId}:")
-            print("  Average Temperature:", round(avg_temperature, 2), "°C")
-            print("  Average Heart Rate:", round(avg_heart_rate, 2), "bpm")
-            print("  Average Respiratory Rate:", round(avg_respiratory_rate, 2), "bpm")
-            print("  Average Systolic Blood Pressure:", round(avg_systolic_bp, 2), "mmHg")
-            print("  Average Diastolic Blood Pressure:", round(avg_diastolic_bp, 2), "mmHg")
-            print("  Average Oxygen Saturation:", round(avg_oxygen_saturation, 2), "%")
-        
+    async def _read(self, query, cacheKey=None):
+        #Running a query in the thread pool while no write runs, answering from the cache when cacheKey is given
+        async with self._guard.reading():
+            if cacheKey is not None and cacheKey in self._cache:
+                return self._cache[cacheKey]
+            result = await asyncio.get_running_loop().run_in_executor(self._executor, query)
+            if cacheKey is not None:
+                self._cache[cacheKey] = result
+            return result
+
+    async def _handle(self, reader, writer):
+        try:
+            status, body = await self._respond(reader)
+        except (ValueError, KeyError, json.JSONDecodeError) as error:
+            status, body = 400, {'error': str(error)}
+        except Exception:
+            status, body = 500, {'error': "An unexpected error occurred."}
+        if isinstance(body, str):
+            payload, content_type = body.encode(), 'text/plain; version=0.0.4'
         else:
-            print(f"Patient with ID {patientId} not found.")
+            payload, content_type = json.dumps(body).encode(), 'application/json'
+        writer.write(f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n"
+                     f"Content-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n"
+                     f"Connection: close\r\n\r\n".encode() + payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
 
-    # exception handling
-    except ValueError:
-        print("Error: 'patientId' should be an integer.")
-    except TypeError:
-        print("Error: 'patients' should be a dictionary.")
-    except Exception:
-        print("An unexpected error occurred while displaying the data.")
+    async def _respond(self, reader):
+        #Reading one request and working out the status and JSON body of the answer
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) != 3:
+            return 400, {'error': "Malformed request line."}
+        method, target, _ = request_line
+        length = 0
+        while True:
+            header = (await reader.readline()).decode('latin-1').strip()
+            if not header:
+                break
+            name, _, value = header.partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+        if length > MAX_REQUEST_BYTES:
+            return 413, {'error': "Request body is too large."}
+        body = await reader.readexactly(length) if length else b''
 
-#--- end of displaystats ---#
+        url = urllib.parse.urlsplit(target)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        path = url.path.rstrip('/')
 
-def addPatientData(patients, patientId, date, temp, hr, rr, sbp, dbp, spo2, fileName):
-    """
-    Adds new patient data to the patient list.
+        if method == 'GET' and path == '/stats':
+            patient_id = int(query.get('patientId', 0))
+            if patient_id == 0:
+                return 200, await self._read(lambda: computeStats(self.patients), 'stats')
 
-    patients: The dictionary of patient IDs, where each patient has a list of visits, to add data to.
-    patientId: The ID of the patient to add data for.
-    date: The date of the patient visit in the format 'yyyy-mm-dd'.
-    temp: The patient's body temperature.
-    hr: The patient's heart rate.
-    rr: The patient's respiratory rate.
-    sbp: The patient's systolic blood pressure.
-    dbp: The patient's diastolic blood pressure.
-    spo2: The patient's oxygen saturation level.
-    fileName: The name of the file to append new data to.
+            def patientStats():
+                if patient_id not in self.patients:
+                    return 404, {'error': f"Patient with ID {patient_id} not found."}
+                return 200, computeStats(self.patients, patient_id)
+            return await self._read(patientStats)
+
+        if method == 'GET' and path == '/visits':
+            if 'from' in query or 'to' in query:
+                start, end = query.get('from', '0001-01-01'), query.get('to', '9999-12-31')
+                #The search functions print errors and return no visits, so bad dates are caught here
+                for name, date in (('from', start), ('to', end)):
+                    try:
+                        parseVisitDate(date)
+                    except ValueError:
+                        return 400, {'error': f"Invalid '{name}' date '{date}', expected yyyy-mm-dd."}
+                search = lambda: findVisitsByDateRange(self.patients, start, end)
+            else:
+                year = int(query['year']) if query.get('year') else None
+                month = int(query['month']) if query.get('month') else None
+                if month is not None and not 1 <= month <= 12:
+                    return 400, {'error': f"Invalid month {month}, expected 1 to 12."}
+                search = lambda: findVisitsByDate(self.patients, year, month)
+            return 200, await self._read(lambda: {'visits': [_visitJson(patient_id, visit) for patient_id, visit in search()]})
+
+        if method == 'GET' and path == '/followup':
+            return 200, await self._read(lambda: {'patients': findPatientsWhoNeedFollowUp(self.patients)}, 'followup')
+
+        if method == 'GET' and path == '/trends':
+            window = int(query.get('window', TREND_WINDOW))
+            patient_id = int(query.get('patientId', 0))
+
+            def trends():
+                if patient_id == 0:
+                    return 200, {'deteriorating': findPatientsWithDeterioration(self.patients, window)}
+                if patient_id not in self.patients:
+                    return 404, {'error': f"Patient with ID {patient_id} not found."}
+                return 200, computeTrends(self.patients, patient_id, window)
+            return await self._read(trends)
+
+        if method == 'GET' and path == '/metrics':
+            return 200, metricsText()
+
+        if method == 'POST' and path == '/visits':
+            data = json.loads(body or b'null')
+            items = data if isinstance(data, list) else [data]
+            records = [[item.get(name) for name in ('patientId', 'date', 'temp', 'hr', 'rr', 'sbp', 'dbp', 'spo2')]
+                       if isinstance(item, dict) else item for item in items]
+            result = await self._write(lambda: addPatientDataBatch(self.patients, records, self.fileName))
+            return (201 if result['accepted'] else 400), result
+
+        if method == 'DELETE' and path.startswith('/patients/'):
+            patient_id = int(path[len('/patients/'):])
+
+            def delete():
+                if patient_id not in self.patients:
+                    return None
+                return deleteAllVisitsOfPatient(self.patients, patient_id, self.fileName)
+            deleted = await self._write(delete)
+            if deleted:
+                return 200, {'deleted': patient_id}
+            if deleted is None:
+                return 404, {'error': f"Patient with ID {patient_id} not found."}
+            return 500, {'error': f"The visits of patient {patient_id} could not be deleted."}
+
+        return 404, {'error': f"No route for {method} {url.path}."}
+
+
+#Largest request body the service accepts
+MAX_REQUEST_BYTES = 16 << 20
+
+
+class _ReadWriteGuard:
+    #Lets any number of readers or a single writer in; a waiting writer keeps new readers out so it is not starved
+
+    def __init__(self):
+        self._condition = asyncio.Condition()
+        self._readers = 0
+        self._writing = False
+        self._waitingWriters = 0
+
+    @contextlib.asynccontextmanager
+    async def reading(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self._writing and not self._waitingWriters)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._readers -= 1
+                self._condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def writing(self):
+        async with self._condition:
+            self._waitingWriters += 1
+            try:
+                await self._condition.wait_for(lambda: not self._writing and not self._readers)
+            finally:
+                self._waitingWriters -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+def runServer(fileName='patients.txt', host='127.0.0.1', port=8080):
     """
-    # exception handling
+    Loads the patient file and serves it over HTTP until interrupted. See PatientService for the routes.
+    """
+    service = PatientService(fileName)
+    print(f"Serving '{fileName}' on http://{host}:{port}")
     try:
-        # Convert patientId to integer
-        patientId = int(patientId)
+        asyncio.run(service.serve(host, port))
+    except KeyboardInterrupt:
+        pass
+    return 0
 
-        # Check if date is in valid format
-        parts = date.split('-')
-        if len(parts) != 3:
-            print("Invalid date. Please enter a valid date.")
-            return
-        year, month, day = map(int, parts)
-        if not (1900 <= year <= 9999 and 1 <= month <= 12 and 1 <= day <= 31):
-            print("Invalid date. Please enter a valid date.")
-            return
+#--- end of server ---#
 
-        # Convert other input values to appropriate types
-        date = str(year) + '-' + str(month) + '-' + str(day)
-        temp = float(temp)
-        hr = int(hr)
-        rr = int(rr)
-        sbp = int(sbp)
-        dbp = int(dbp)
-        spo2 = int(spo2)
+class Instrumentation:
+    """
+    Counters and latency histograms of the operations run in this process.
 
-    # if conditions to check the data range of patients data
-        # Check for invalid temperature range
-        if not (35.0 <= temp <= 42.0):
-            print("Invalid temperature. Please enter a temperature between 35.0 and 42.0 Celsius.")
-            return
-        # Check for invalid heart rate range
-        if not (30 <= hr <= 180):
-            print("Invalid heart rate. Please enter a heart rate between 30 and 180 bpm.")
-            return
-        # Check for invalid respiratory rate range
-        if not (5 <= rr <= 40):
-            print("Invalid respiratory rate. Please enter a respiratory rate between 5 and 40 bpm.")
-            return
-        # Check for invalid systolic blood pressure range
-        if not (70 <= sbp <= 200):
-            print("Invalid systolic blood pressure. Please enter a systolic blood pressure between 70 and 200 mmHg.")
-            return
-        # Check for invalid diastolic blood pressure range
-        if not (40 <= dbp <= 120):
-            print("Invalid diastolic blood pressure. Please enter a diastolic blood pressure between 40 and 120 mmHg.")
-            return
-        # Check for invalid oxygen saturation range
-        if not (70 <= spo2 <= 100):
-            print("Invalid oxygen saturation. Please enter an oxygen saturation between 70 and 100%.")
-            return
+    Metrics are kept per name and set of labels, and dumped in the Prometheus text format by prometheusText.
+    Created by enableInstrumentation, which also wraps the public functions so every call is timed:
+      his_call_seconds{function}       histogram of the latency of each public function
+      his_phase_seconds{phase}         histogram of the internal phases of reading, writing and deleting
+      his_errors_total{function}       calls which raised an exception
+      his_rows_read_total{source}      rows loaded from the text file or from the snapshot
+      his_rows_rejected_total{reason}  invalid lines skipped while reading
+      his_bytes_written_total{file}    bytes written to the data file or to the snapshot
+    """
 
-        # adding data to the dictionary
-        if patientId not in patients:
-            patients[patientId] = []
-        patients[patientId].append([date, temp, hr, rr, sbp, dbp, spo2])
+    #Upper bounds in seconds of the latency histogram buckets
+    LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
 
-        # adding the patient data to the file
-        with open(fileName, 'a') as file:
-            file.write(f"\n{patientId},{date},{temp},{hr},{rr},{sbp},{dbp},{spo2}")
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
 
-        print(f"Visit saved for Patient # {patientId}")
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
 
-    # exception handling
-    except ValueError:
-        print("Invalid input. Please enter valid values.")
-    except Exception:
-        print("An unexpected error occured")
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                #Bucket counts (not cumulative), sum and count
+                histogram = self.histograms[key] = [[0] * len(self.LATENCY_BUCKETS), 0.0, 0]
+            index = bisect.bisect_left(self.LATENCY_BUCKETS, seconds)
+            if index < len(self.LATENCY_BUCKETS):
+                histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
 
-#--- end of addPatientData ---#
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('his_phase_seconds', time.perf_counter() - started, phase=name)
 
-def findVisitsByDate(patients, year=None, month=None):
+    def wrap(self, function):
+        #Function timing every call of the given one; the original is kept in __wrapped__
+        name = function.__name__
+
+        @functools.wraps(function)
+        def instrumented(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except BaseException:
+                self.count('his_errors_total', function=name)
+                raise
+            finally:
+                self.observe('his_call_seconds', time.perf_counter() - started, function=name)
+        return instrumented
+
+    def prometheusText(self):
+        """
+        return: The metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(buckets), total, count)) for key, (buckets, total, count) in self.histograms.items())
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_labelText(labels)} {value}")
+        for (name, labels), (buckets, total, count) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, bucket in zip(self.LATENCY_BUCKETS, buckets):
+                cumulative += bucket
+                lines.append(f"{name}_bucket{_labelText(labels + (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_labelText(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_labelText(labels)} {total}")
+            lines.append(f"{name}_count{_labelText(labels)} {count}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+
+def _labelText(labels):
+    #Prometheus label set, e.g. {function="displayStats"}
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+#Functions timed while instrumentation is enabled
+INSTRUMENTED_FUNCTIONS = ('readPatientsFromFile', 'refreshPatients', 'compactPatientFile', 'writeSnapshot', 'loadSnapshot',
+                          'displayPatientData', 'displayVisits', 'computeStats', 'computeStatsByPatient', 'displayStats',
+                          'addPatientData', 'addPatientDataBatch', 'findVisitsByDate', 'findVisitsByDateRange',
+                          'findPatientsWhoNeedFollowUp', 'computeTrends', 'findPatientsWithDeterioration',
+                          'displayTrends', 'deleteAllVisitsOfPatient', 'migrateToShards')
+
+#The Instrumentation collecting metrics, or None when instrumentation is disabled
+instrumentation = None
+
+
+def enableInstrumentation():
     """
-    Find visits by year, month, or both.
+    Starts collecting metrics, replacing the public functions of this module with timed wrappers.
 
-    patients: A dictionary of patient IDs, where each patient has a list of visits.
-    year: The year to filter by.
-    month: The month to filter by.
-    return: A list of tuples containing patient ID and visit that match the filter.
+    return: The Instrumentation holding the metrics.
+    Set HIS_INSTRUMENT=1 to enable it on import. Code which imported the functions by name beforehand
+    keeps calling the unwrapped ones. While disabled nothing is wrapped, and the phase and counter
+    hooks only cost a check of the instrumentation global.
     """
-    #To store the visits of the patients
-    visits = []
-    #Exception Handling
-    try:
-        for patient_id, patient_visits in patients.items():
-            for visit in patient_visits:
-                #Accesing the year and month of the visit
-                visit_date = visit[0].split('-')
-                visit_year = int(visit_date[0])
-                visit_month = int(visit_date[1])
-                
-                #Checking the year and month is matching or not
-                if (year is None or visit_year == year) and (month is None or visit_month == month):
-                    visits.append((patient_id, visit))
-    #Handling errror                
-    except Exception as e:
-        print("An error occurred while searching for visits:", str(e))
-    return visits
+    global instrumentation
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+        module = globals()
+        for name in INSTRUMENTED_FUNCTIONS:
+            module[name] = instrumentation.wrap(module[name])
+    return instrumentation
 
 
-#--- end of findvisitbydate ---#
+def disableInstrumentation():
+    """
+    Stops collecting metrics and puts the unwrapped public functions back.
+    """
+    global instrumentation
+    if instrumentation is not None:
+        module = globals()
+        for name in INSTRUMENTED_FUNCTIONS:
+            module[name] = module[name].__wrapped__
+        instrumentation = None
 
 
-def findPatientsWhoNeedFollowUp(patients):
+def metricsText():
     """
-    Find patients who need follow-up visits based on abnormal vital signs.
+    return: The collected metrics in the Prometheus text format, or an empty string when instrumentation is disabled.
+    """
+    return instrumentation.prometheusText() if instrumentation is not None else ""
 
-    patients: A dictionary of patient IDs, where each patient has a list of visits.
-    return: A list of patient IDs that need follow-up visits to to abnormal health stats.
+
+def _phase(name):
+    #Timing an internal phase of an operation; does nothing unless instrumentation is enabled
+    return _NO_PHASE if instrumentation is None else instrumentation.phase(name)
+
+
+_NO_PHASE = contextlib.nullcontext()
+
+
+def profileOperation(function, *args, out=None, limit=20, **kwargs):
     """
-    #Function to call the visits of the patients that needs follow up
-    def follow_up(visit):
-        _, temp, hr, rr, sbp, dbp, spo2 = visit
-        #Checking for any abnormal health stats
-        return temp < 30 or hr < 60 or rr < 15 or sbp < 110 or dbp < 70 or spo2 < 90
-    
-    #To store the patients id who needs followup
-    followup_patients = []
-    #Exception Handling
+    Runs a single operation under cProfile and tracemalloc and prints where its time and memory went.
+
+    function: The operation to run, called with the remaining positional and keyword arguments.
+    out: The stream to print the report to. If None, sys.stderr is used.
+    limit: The number of functions and source lines listed.
+    return: The return value of the operation.
+    """
+    out = out or sys.stderr
+    profiler = cProfile.Profile()
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
     try:
-        #for loops to acces the the patient id and its visits
-        for patient_id, patient_visits in patients.items():
-            for visit in patient_visits:
-                if follow_up(visit):
-                    followup_patients.append(patient_id)
-                    break
-        return followup_patients
-    
-    #Handling exception
-    except Exception:
-        print("An unexpected error occured")
+        result = profiler.runcall(function, *args, **kwargs)
+        after = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        if not tracing:
+            tracemalloc.stop()
 
-#--- end of findpatientswhoneedfollowup ---#
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+    print(f"Peak traced memory: {peak / 1024:.1f} KiB. Largest allocations:", file=out)
+    for difference in after.compare_to(before, 'lineno')[:limit]:
+        print(f"  {difference}", file=out)
+    return result
 
+#--- end of instrumentation ---#
 
-def deleteAllVisitsOfPatient(patients, patientId, filename):
+def _buildParser():
+    #Command line parser of the non-interactive interface
+    parser = argparse.ArgumentParser(prog='main_22BCSF22.py', description="Health Information System. Run without arguments for the interactive menu.")
+    parser.add_argument('--file', default='patients.txt', help="patient data file (default: patients.txt)")
+    parser.add_argument('--timing', action='store_true', help="print the load, query and output time to stderr")
+    parser.add_argument('--instrument', action='store_true', help="collect metrics of the public functions and their phases")
+    parser.add_argument('--metrics', metavar='FILE', help="write the metrics in the Prometheus text format to FILE ('-' for stderr) on exit; implies --instrument")
+    parser.add_argument('--profile', action='store_true', help="print a cProfile and tracemalloc report of the command to stderr")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def addOutputOptions(command):
+        command.add_argument('--format', choices=('text', 'csv', 'jsonl'), default='text')
+        command.add_argument('--limit', type=int)
+        command.add_argument('--offset', type=int, default=0)
+
+    command = commands.add_parser('show', help="display patient data")
+    command.add_argument('--patient', type=int, default=0)
+    addOutputOptions(command)
+
+    command = commands.add_parser('stats', help="display patient statistics")
+    command.add_argument('--patient', type=int, default=0)
+    command.add_argument('--json', action='store_true', help="print count, mean, min, max, variance and percentiles as JSON")
+
+    command = commands.add_parser('visits', help="find visits by year, month or date range")
+    command.add_argument('--year', type=int)
+    command.add_argument('--month', type=int)
+    command.add_argument('--from', dest='start', help="first date (yyyy-mm-dd) of a date range")
+    command.add_argument('--to', dest='end', help="last date (yyyy-mm-dd) of a date range")
+    addOutputOptions(command)
+
+    command = commands.add_parser('followup', help="find patients who need follow-up")
+    command.add_argument('--rules', help="JSON file with follow-up rules")
+
+    command = commands.add_parser('trends', help="show the trends of a patient, or the patients with a rapid deterioration")
+    command.add_argument('--patient', type=int, default=0, help="patient to show; if 0, list the deteriorating patients")
+    command.add_argument('--window', type=int, default=TREND_WINDOW, help=f"visits in the moving average (default: {TREND_WINDOW})")
+    command.add_argument('--json', action='store_true', help="print the trends as JSON")
+
+    command = commands.add_parser('add', help="add a visit")
+    for name in ('patientId', 'date', 'temp', 'hr', 'rr', 'sbp', 'dbp', 'spo2'):
+        command.add_argument(name)
+
+    command = commands.add_parser('delete', help="delete all visits of a patient")
+    command.add_argument('patientId', type=int)
+
+    command = commands.add_parser('import', help="add the visits of a csv file in one batch")
+    command.add_argument('source', help="file with patientId,date,temp,hr,rr,sbp,dbp,spo2 lines")
+    command.add_argument('--fsync', choices=('batch', 'interval', 'never'))
+
+    command = commands.add_parser('serve', help="serve the data over a local HTTP/JSON interface")
+    command.add_argument('--host', default='127.0.0.1')
+    command.add_argument('--port', type=int, default=8080)
+
+    command = commands.add_parser('migrate', help="split the data file into hash-partitioned shards, or merge them back")
+    command.add_argument('--shards', type=int, required=True, help="number of shard files; 0 converts back to a single file")
+
+    command = commands.add_parser('batch', help="run the commands listed in a file against one loaded dataset")
+    command.add_argument('queries', help="file with one command per line; empty lines and lines starting with # are skipped")
+    return parser
+
+
+def _runCommand(patients, args, fileName):
+    #Running one parsed command other than batch; everything it prints goes to stdout. Returns 1 if the command failed
+    if args.command == 'show':
+        displayPatientData(patients, args.patient, format=args.format, limit=args.limit, offset=args.offset)
+    elif args.command == 'stats':
+        if args.json:
+            try:
+                print(json.dumps(computeStats(patients, args.patient), indent=2))
+            except KeyError:
+                print(f"Patient with ID {args.patient} not found.")
+        else:
+            displayStats(patients, args.patient)
+    elif args.command == 'visits':
+        if args.start or args.end:
+            visits = findVisitsByDateRange(patients, args.start or '0001-01-01', args.end or '9999-12-31')
+        else:
+            visits = findVisitsByDate(patients, args.year, args.month)
+        if visits or args.format != 'text':
+            displayVisits(visits, format=args.format, limit=args.limit, offset=args.offset)
+        else:
+            print("No visits found for the specified year/month.")
+    elif args.command == 'followup':
+        try:
+            rules = loadFollowUpRules(args.rules) if args.rules else None
+        except (OSError, ValueError) as error:
+            print(f"Could not load the follow-up rules: {error}")
+            return
+        followup_patients = findPatientsWhoNeedFollowUp(patients, rules)
+        if followup_patients:
+            print("Patients who need follow-up visits:")
+            print("\n".join(map(str, followup_patients)))
+        else:
+            print("No patients found who need follow-up visits.")
+    elif args.command == 'trends':
+        try:
+            if args.patient:
+                if args.json:
+                    print(json.dumps(computeTrends(patients, args.patient, args.window), indent=2))
+                else:
+                    displayTrends(patients, args.patient, args.window)
+            else:
+                deteriorating = findPatientsWithDeterioration(patients, args.window)
+                if args.json:
+                    print(json.dumps(deteriorating, indent=2))
+                elif deteriorating:
+                    print("Patients with a rapid deterioration:")
+                    for patient_id, names in deteriorating.items():
+                        print(f"{patient_id}: {', '.join(names)}")
+                else:
+                    print("No patients found with a rapid deterioration.")
+        except KeyError:
+            print(f"Patient with ID {args.patient} not found.")
+        except ValueError as error:
+            print(error)
+    elif args.command == 'add':
+        addPatientData(patients, args.patientId, args.date, args.temp, args.hr, args.rr, args.sbp, args.dbp, args.spo2, fileName)
+    elif args.command == 'delete':
+        if args.patientId not in patients:
+            print(f"Patient with ID {args.patientId} not found.")
+            return 1
+        if not deleteAllVisitsOfPatient(patients, args.patientId, fileName):
+            print(f"The visits of Patient # {args.patientId} could not be deleted.")
+            return 1
+        print(f"Deleted all visits of Patient # {args.patientId}")
+    elif args.command == 'import':
+        #Number of records read before each blank line, to turn record indexes back into line numbers
+        blank_lines = []
+
+        def readRecords(source):
+            count = 0
+            for line in source:
+                if line.strip():
+                    count += 1
+                    yield line.strip().split(',')
+                else:
+                    blank_lines.append(count)
+
+        with open(args.source) as source:
+            result = addPatientDataBatch(patients, readRecords(source), fileName, args.fsync)
+        print(f"Imported {result['accepted']} visit(s), rejected {len(result['rejected'])}.")
+        for rejected in result['rejected']:
+            index = rejected['index']
+            print(f"  line {index + 1 + bisect.bisect_right(blank_lines, index)}: {rejected['reason']}")
+
+
+class _TimedOutput(io.TextIOBase):
+    #Pass-through text stream adding up the time spent writing to the stream it wraps
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.seconds = 0.0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        started = time.perf_counter()
+        try:
+            return self._stream.write(text)
+        finally:
+            self.seconds += time.perf_counter() - started
+
+    def flush(self):
+        started = time.perf_counter()
+        try:
+            self._stream.flush()
+        finally:
+            self.seconds += time.perf_counter() - started
+
+
+def _timedCommand(patients, args, fileName, label):
+    #Running a command with its output streamed through a timing stream, so query and output time can be told apart
+    output = _TimedOutput(sys.stdout)
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        status = _runCommand(patients, args, fileName) or 0
+        output.flush()
+    return label, time.perf_counter() - started - output.seconds, output.seconds, status
+
+
+def _runBatch(patients, queriesFile, fileName, parser):
+    #Running every command of a query file; returns the timing and exit status of each command
+    timings = []
+    with open(queriesFile) as queries:
+        for number, line in enumerate(queries, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                query = parser.parse_args(shlex.split(line))
+            except SystemExit:
+                print(f"Invalid query on line {number}: {line}")
+                continue
+            if query.command == 'batch':
+                print(f"Nested batch on line {number} is not allowed.")
+                continue
+            if query.command in ('serve', 'migrate'):
+                print(f"'{query.command}' on line {number} is not allowed in a batch.")
+                continue
+            timings.append(_timedCommand(patients, query, fileName, f"line {number}: {line}"))
+    return timings
+
+
+def cliMain(argv=None):
     """
-    Delete all visits of a particular patient.
+    Runs the non-interactive command line interface.
 
-    patients: The dictionary of patient IDs, where each patient has a list of visits, to delete data from.
-    patientId: The ID of the patient to delete data for.
-    filename: The name of the file to save the updated patient data.
-    return: None
+    argv: The command line arguments, without the program name. If None, sys.argv is used.
+    return: The exit status.
+    Subcommands: show, stats, visits, followup, trends, add, delete, import, serve, migrate, and batch, which runs many
+    commands from a file against a single loaded dataset. With --timing, the time spent loading,
+    querying and writing output is printed to stderr. --instrument and --metrics collect and dump
+    metrics (see Instrumentation), and --profile profiles the command with profileOperation.
     """
-    #Exception Handling
+    parser = _buildParser()
+    args = parser.parse_args(argv)
+    if args.instrument or args.metrics:
+        enableInstrumentation()
     try:
-        if patientId in patients:
-            patients.pop(patientId)
-            #Opening the file to access the datas
-            with open(filename, 'w') as file:
-                for patient_id, visits in patients.items():
-                    for visit in visits:
-                        file.write(f"{patient_id},{','.join(map(str, visit))}\n")
+        return _cliCommand(parser, args)
+    finally:
+        if args.metrics == '-':
+            sys.stderr.write(metricsText())
+        elif args.metrics:
+            with open(args.metrics, 'w') as file:
+                file.write(metricsText())
 
-    #Handling exception            
-    except FileNotFoundError:
-        print(f"The file '{fileName}' could not be found.")
-    
-    #Handling exception
-    except Exception :
-        print("An unexpected error occurred while reading the file.")
 
-#--- end of deleteallvisitsofpatients ---#
+def _cliCommand(parser, args):
+    #Loading the data and running the parsed command line
+    if args.command == 'serve':
+        return runServer(args.file, args.host, args.port)
+    if args.command == 'migrate':
+        try:
+            migrated = migrateToShards(args.file, args.shards)
+        except (OSError, ValueError) as error:
+            print(f"Migration failed: {error}")
+            return 1
+        print(f"Migrated {migrated} visit(s) to " + (f"{args.shards} shard(s) in '{shardDirectory(args.file)}'." if args.shards else f"'{args.file}'."))
+        return 0
+    started = time.perf_counter()
+    patients = readPatientsFromFile(args.file)
+    loaded = time.perf_counter()
+
+    if args.command == 'batch':
+        run = lambda: _runBatch(patients, args.queries, args.file, parser)
+    else:
+        run = lambda: [_timedCommand(patients, args, args.file, args.command)]
+    timings = profileOperation(run) if args.profile else run()
+    if args.timing:
+        print(f"load: {(loaded - started) * 1000:.2f} ms", file=sys.stderr)
+        for label, query, output, _ in timings:
+            print(f"{label}: query {query * 1000:.2f} ms, output {output * 1000:.2f} ms", file=sys.stderr)
+        print(f"total: load {(loaded - started) * 1000:.2f} ms, query {sum(t[1] for t in timings) * 1000:.2f} ms, "
+              f"output {sum(t[2] for t in timings) * 1000:.2f} ms", file=sys.stderr)
+    return max((t[3] for t in timings), default=0)
+
+#--- end of cli ---#
+
+#Instrumenting the public functions when asked for through the environment
+if os.environ.get('HIS_INSTRUMENT', '0') != '0':
+    enableInstrumentation()
 
 
 ###########################################################################
@@ -438,15 +3458,7 @@ def main():
             visits = findVisitsByDate(patients, int(year) if year != '0' else None,
                                       int(month) if month != '0' else None)
             if visits:
-                for visit in visits:
-                    print("Patient ID:", visit[0])
-                    print(" Visit Date:", visit[1][0])
-                    print("  Temperature:", "%.2f" % visit[1][1], "C")
-                    print("  Heart Rate:", visit[1][2], "bpm")
-                    print("  Respiratory Rate:", visit[1][3], "bpm")
-                    print("  Systolic Blood Pressure:", visit[1][4], "mmHg")
-                    print("  Diastolic Blood Pressure:", visit[1][5], "mmHg")
-                    print("  Oxygen Saturation:", visit[1][6], "%")
+                displayVisits(visits)
             else:
                 print("No visits found for the specified year/month.")
         elif choice == '6':
@@ -468,4 +3480,7 @@ def main():
 
 
 if __name__ == '__main__':
+    #Running the command line interface when arguments are given, the interactive menu otherwise
+    if len(sys.argv) > 1:
+        sys.exit(cliMain())
     main()
@@ -0,0 +1,44 @@
+import os
+
+import benchmark_22BCSF22 as bench
+import main_22BCSF22 as his
+
+
+def testGeneratorIsDeterministicAndSkewed(tmp_path):
+    first, second = str(tmp_path / 'first.txt'), str(tmp_path / 'second.txt')
+
+    assert bench.generateSyntheticDataset(first, 1000, skew=1.0, seed=3) == 100
+    bench.generateSyntheticDataset(second, 1000, skew=1.0, seed=3)
+
+    with open(first) as file:
+        lines = file.read().split("\n")
+    with open(second) as file:
+        assert file.read().split("\n") == lines
+    counts = [sum(1 for line in lines if line.split(',')[0] == str(patient_id)) for patient_id in (1, 100)]
+    assert len(lines) == 1000 and counts[0] > 10 * counts[1] > 0
+
+
+def testGeneratorWritesRequestedInvalidLines(tmp_path, monkeypatch):
+    monkeypatch.setattr(his, 'useSnapshots', False)
+    fileName = str(tmp_path / 'patients.txt')
+    bench.generateSyntheticDataset(fileName, 2000, skew=0.0, invalidRatio=0.1)
+
+    report = his.readPatientsFromFile(fileName).loadReport
+
+    assert report['rows'] + report['rejected'] == 2000
+    assert 150 < report['rejected'] < 250
+
+
+def testBenchmarkDateQueriesFindVisits(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(his, 'useSnapshots', his.useSnapshots)
+
+    result = bench._benchmarkSize(500, None, 1.0, 0.0, str(tmp_path), 1, 5)
+
+    operations = result['operations']
+    assert operations['findVisitsByDate (year and month)']['items'] > 0
+    assert operations['findVisitsByDate (month)']['items'] >= operations['findVisitsByDate (year and month)']['items']
+    assert operations['readPatientsFromFile']['items'] == 500
+    assert result['peakRssKb'] == result['peakRssSelfKb'] + result['peakRssChildrenKb'] > 0
+    assert os.listdir(tmp_path) == []
+    bench.printBenchmark(result)
+    assert capsys.readouterr().out.startswith("500 rows, 50 patients")
@@ -0,0 +1,1081 @@
+import asyncio
+import io
+import json
+import math
+import multiprocessing
+import os
+import random
+import statistics
+import threading
+from array import array
+
+import pytest
+
+import main_22BCSF22 as his
+
+
+def _writeLines(fileName, lines):
+    with open(fileName, 'w') as file:
+        file.write("\n".join(lines))
+
+
+def _appendLines(fileName, lines):
+    with open(fileName, 'a') as file:
+        file.write("\n" + "\n".join(lines))
+
+
+def _visitLines(patients=40, visits=6, seed=0):
+    #Visit records of a few patients, with a patient's visits spread over the file
+    generator = random.Random(seed)
+    lines = []
+    for visit in range(visits):
+        for patient_id in range(1, patients + 1):
+            lines.append(f"{patient_id},{2000 + visit}-{generator.randint(1, 12)}-{generator.randint(1, 28)},"
+                         f"{round(generator.uniform(35.5, 39.5), 1)},{generator.randint(50, 130)},"
+                         f"{generator.randint(10, 28)},{generator.randint(85, 170)},"
+                         f"{generator.randint(55, 100)},{generator.randint(88, 100)}")
+    return lines
+
+
+def _visit(line):
+    #Visit of a record line, as the store returns it
+    fields = line.split(',')
+    return [his.formatVisitDate(his.parseVisitDate(fields[1])), float(fields[2])] + [int(field) for field in fields[3:]]
+
+
+def _inDateOrder(visits):
+    #Visits found by a date query; visits on the same day may come in any order
+    days = [visit[0] for _, visit in visits]
+    assert days == sorted(days, key=his.parseVisitDate)
+    return sorted((visit[0], patient_id, list(visit)) for patient_id, visit in visits)
+
+
+def _contents(patients):
+    #Plain copy of a store, with the visits of each patient in a fixed order
+    return {patient_id: sorted(list(visit) for visit in visits) for patient_id, visits in patients.items()}
+
+
+@pytest.fixture
+def patientFile(tmp_path, monkeypatch):
+    #A patient file in a fresh directory, with background work made synchronous
+    monkeypatch.setattr(his, 'backgroundCompaction', False)
+    monkeypatch.setattr(his, 'useSnapshots', True)
+    monkeypatch.setattr(his, 'parallelLoadMinBytes', 32 << 20)
+    fileName = str(tmp_path / 'patients.txt')
+    _writeLines(fileName, _visitLines())
+    yield fileName
+    his._closeShardPools()
+
+
+def testStoreBehavesLikeVisitDictionary():
+    lines = _visitLines(patients=5, visits=3)
+    visits = {}
+    for line in lines:
+        visits.setdefault(int(line.split(',')[0]), []).append(_visit(line))
+
+    store = his.VisitStore.fromPatients(visits)
+
+    assert len(store) == 5 and 3 in store and 6 not in store
+    assert {patient_id: [list(visit) for visit in store[patient_id]] for patient_id in store} == visits
+    assert store[2][-1] == visits[2][-1] and store[2][1:] == visits[2][1:]
+    assert store.visitCount() == 15
+    with pytest.raises(KeyError):
+        store[6]
+
+
+def testStoreKeepsColumnsAlignedWhenAppendFails():
+    store = his.VisitStore()
+    store.appendVisit(1, '2024-01-01', 37.0, 70, 18, 120, 80, 95)
+    with pytest.raises(ValueError):
+        store.appendVisit(2 ** 70, '2024-01-02', 37.0, 70, 18, 120, 80, 95)
+    with pytest.raises(ValueError):
+        store.appendVisit(2, '2024-01-02', 37.0, 70, 18, 120, 80, 10 ** 6)
+    store.appendVisit(11, '2025-01-01', 37.5, 72, 18, 121, 81, 96)
+
+    assert len(store._pids) == len(store._days) == len(store._temps) == len(store._live) == 2
+    assert sorted(store) == [1, 11]
+    assert list(store[11]) == [['2025-01-01', 37.5, 72, 18, 121, 81, 96]]
+    assert his.findVisitsByDate(store, 2025) == [(11, ['2025-01-01', 37.5, 72, 18, 121, 81, 96])]
+
+
+def testAddRejectsPatientIdOutsideStore(patientFile):
+    patients = his.readPatientsFromFile(patientFile)
+    size = os.path.getsize(patientFile)
+
+    his.addPatientData(patients, 2 ** 70, '2024-01-01', 37.0, 70, 18, 120, 80, 95, patientFile)
+    his.addPatientData(patients, 41, '2025-01-01', 37.0, 70, 18, 120, 80, 95, patientFile)
+
+    assert os.path.getsize(patientFile) > size
+    assert 2 ** 70 not in patients and len(patients[41]) == 1
+    assert len(his.findVisitsByDate(patients, 2025)) == 1
+
+
+def _naiveStats(values, percentiles):
+    #Statistics of one column the slow way, sorting every value
+    ordered = sorted(values)
+    mean = statistics.fmean(ordered)
+    stats = {'count': len(ordered), 'mean': mean, 'min': ordered[0], 'max': ordered[-1],
+             'variance': statistics.pvariance(ordered, mean), 'percentiles': {}}
+    for percent in percentiles:
+        position = (len(ordered) - 1) * percent / 100
+        lower = math.floor(position)
+        upper = min(lower + 1, len(ordered) - 1)
+        stats['percentiles'][percent] = ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+    return stats
+
+
+def _assertStatsEqual(stats, expected):
+    for name in his.VITAL_NAMES:
+        assert stats[name]['count'] == expected[name]['count']
+        assert stats[name]['min'] == expected[name]['min'] and stats[name]['max'] == expected[name]['max']
+        assert stats[name]['mean'] == pytest.approx(expected[name]['mean'])
+        assert stats[name]['variance'] == pytest.approx(expected[name]['variance'])
+        assert stats[name]['percentiles'] == pytest.approx(expected[name]['percentiles'])
+
+
+def _expectedStats(visits, percentiles=(25, 50, 75, 90)):
+    return {name: _naiveStats([visit[column + 1] for visit in visits], percentiles)
+            for column, name in enumerate(his.VITAL_NAMES)}
+
+
+def testStatsMatchSortedColumns():
+    lines = _visitLines(patients=30, visits=7)
+    store = his.VisitStore()
+    for line in lines:
+        store.appendVisit(int(line.split(',')[0]), *_visit(line))
+    visits = [list(visit) for patient_visits in store.values() for visit in patient_visits]
+
+    _assertStatsEqual(his.computeStats(store), _expectedStats(visits))
+    _assertStatsEqual(his.computeStats(store, 4, (10, 50, 100)), _expectedStats(store[4], (10, 50, 100)))
+    by_patient = his.computeStatsByPatient(store, (50,))
+    assert sorted(by_patient) == list(range(1, 31))
+    _assertStatsEqual(by_patient[7], _expectedStats(store[7], (50,)))
+    assert his.computeStats(his.VisitStore())['temperature']['count'] == 0
+
+
+def testStatsFollowAddsAndDeletes():
+    store = his.VisitStore()
+    for line in _visitLines(patients=10, visits=4):
+        store.appendVisit(int(line.split(',')[0]), *_visit(line))
+    his.computeStats(store)
+
+    #The cached value counts are updated, including values that no patient has any more
+    store.appendVisit(11, '2024-01-01', 42.0, 180, 40, 200, 120, 100)
+    store.deletePatient(3)
+    store.appendVisit(12, '2024-01-02', 35.0, 30, 5, 70, 40, 70)
+    store.deletePatient(11)
+    visits = [list(visit) for patient_visits in store.values() for visit in patient_visits]
+
+    _assertStatsEqual(his.computeStats(store), _expectedStats(visits))
+
+
+def _rows(count, seed):
+    generator = random.Random(seed)
+    return [(round(generator.uniform(35, 42), 1), generator.randint(30, 180), generator.randint(5, 40),
+             generator.randint(70, 200), generator.randint(40, 120), generator.randint(70, 100)) for _ in range(count)]
+
+
+def _assertAggregateOf(aggregate, rows):
+    assert aggregate.count == len(rows)
+    for i, values in enumerate(zip(*rows)):
+        assert aggregate.means[i] == pytest.approx(statistics.fmean(values))
+        assert aggregate.variances()[i] == pytest.approx(statistics.pvariance(values), abs=1e-9)
+
+
+def testRunningAggregateAddsMergesAndSubtracts():
+    part = _rows(50, 1)
+    rest = _rows(120, 2)
+    total = his.RunningAggregate()
+    for values in part + rest:
+        total.add(values)
+    removed = his.RunningAggregate.fromColumns([array('d', column) for column in zip(*part)])
+    merged = removed.copy()
+    merged.merge(his.RunningAggregate.fromColumns([array('d', column) for column in zip(*rest)]))
+
+    _assertAggregateOf(merged, part + rest)
+    total.subtract(removed)
+    _assertAggregateOf(total, rest)
+    total.subtract(total.copy())
+    assert total.count == 0 and total.variances() == [None] * 6
+
+
+def testStoreAggregatesFollowAddsAndDeletes():
+    store = his.VisitStore()
+    rows = _rows(60, 3)
+    for i, values in enumerate(rows):
+        store.appendVisit(i % 6 + 1, '2024-01-01', *values)
+    store.aggregate()
+
+    store.deletePatient(2)
+    store.appendVisit(7, '2024-01-02', 36.0, 60, 12, 110, 70, 97)
+    kept = [values for i, values in enumerate(rows) if i % 6 + 1 != 2] + [(36.0, 60, 12, 110, 70, 97)]
+
+    _assertAggregateOf(store.aggregate(), kept)
+    _assertAggregateOf(store.aggregate(7), [(36.0, 60, 12, 110, 70, 97)])
+    with pytest.raises(KeyError):
+        store.aggregate(2)
+
+
+def testDisplayStatsAfterChangesMatchesFreshLoad(patientFile, capsys):
+    patients = his.readPatientsFromFile(patientFile)
+    his.displayStats(patients, 0)
+    his.addPatientData(patients, 41, '2024-03-01', 38.5, 120, 22, 150, 95, 90, patientFile)
+    his.deleteAllVisitsOfPatient(patients, 3, patientFile)
+    capsys.readouterr()
+
+    his.displayStats(patients, 0)
+    his.displayStats(patients, 41)
+    updated = capsys.readouterr().out
+    with his._snapshotsDisabled():
+        fresh = his.readPatientsFromFile(patientFile)
+    capsys.readouterr()
+    his.displayStats(fresh, 0)
+    his.displayStats(fresh, 41)
+
+    assert updated == capsys.readouterr().out
+    assert "Vital Signs for Patient 41:\n  Average Temperature: 38.5 °C\n  Average Heart Rate: 120.0 bpm" in updated
+
+
+def _naiveVisitsByDate(patients, year=None, month=None):
+    #The visits a date query must find, by splitting every date like the old findVisitsByDate
+    found = []
+    for patient_id, visits in patients.items():
+        for visit in visits:
+            visit_year, visit_month, _ = map(int, visit[0].split('-'))
+            if (year is None or visit_year == year) and (month is None or visit_month == month):
+                found.append((patient_id, list(visit)))
+    return sorted(found, key=lambda item: his.parseVisitDate(item[1][0]))
+
+
+def testDateIndexFollowsLateInsertsAndDeletes():
+    generator = random.Random(4)
+    store = his.VisitStore()
+    for line in _visitLines(patients=20, visits=5):
+        store.appendVisit(int(line.split(',')[0]), *_visit(line))
+    assert his.findVisitsByDate(store, 2002)
+
+    #Visits dated before the end of the index wait in the pending buffer until the next query
+    for patient_id in range(1, 40):
+        store.appendVisit(patient_id, f"{generator.randint(1999, 2006)}-{generator.randint(1, 12)}-1",
+                          37.0, 70, 18, 120, 80, 95)
+    assert len(store._datePending) > 0
+    store.deletePatient(5)
+
+    for year, month in [(2002, None), (None, 7), (2004, 3), (1999, None), (2030, None)]:
+        found = his.findVisitsByDate(store, year, month)
+        assert _inDateOrder(found) == _inDateOrder(_naiveVisitsByDate(store, year, month))
+    assert len(store._datePending) == 0
+    found = his.findVisitsByDateRange(store, '2001-03-15', '2003-02-28')
+    expected = [(patient_id, list(visit)) for patient_id, visits in store.items() for visit in visits
+                if his.parseVisitDate('2001-03-15') <= his.parseVisitDate(visit[0]) <= his.parseVisitDate('2003-02-28')]
+    assert _inDateOrder(found) == sorted((visit[0], patient_id, visit) for patient_id, visit in expected)
+    assert all(patient_id != 5 for patient_id, _ in found)
+
+
+def testDateIndexKeepsRowOrderWithinADay():
+    store = his.VisitStore()
+    for patient_id in (3, 1, 2):
+        store.appendVisit(patient_id, '2024-05-01', 37.0, 70, 18, 120, 80, 95)
+    store._buildDateIndex()
+    store.appendVisit(4, '2024-04-01', 37.0, 70, 18, 120, 80, 95)
+    store.appendVisit(5, '2024-05-01', 37.0, 70, 18, 120, 80, 95)
+
+    assert [patient_id for patient_id, _ in his.findVisitsByDate(store, 2024)] == [4, 3, 1, 2, 5]
+    assert his.findVisitsByDate(store, 2024, 13) == []
+
+
+def testReplaysInterleavedDeletes(patientFile, monkeypatch):
+    monkeypatch.setattr(his, 'useSnapshots', False)
+    lines = _visitLines(patients=3, visits=2)
+    #Patient 1 is deleted and then visits again, patient 2 is deleted twice, patient 3 is never deleted
+    _writeLines(patientFile, lines[:3] + ["DELETE,1", "DELETE,2"] + lines[3:] + ["DELETE,2"])
+
+    patients = his.readPatientsFromFile(patientFile)
+
+    assert sorted(patients) == [1, 3]
+    assert _contents(patients) == {1: [_visit(lines[3])], 3: sorted([_visit(lines[2]), _visit(lines[5])])}
+
+
+def testWriterCatchesUpWithCompaction(patientFile, monkeypatch):
+    monkeypatch.setattr(his, 'storageMode', 'log')
+    monkeypatch.setattr(his, 'compactionThresholdBytes', 0)
+    first = his.readPatientsFromFile(patientFile)
+    second = his.readPatientsFromFile(patientFile)
+
+    #Deleting most patients makes the file mostly garbage, so the second store compacts it
+    for patient_id in range(1, 31):
+        his.deleteAllVisitsOfPatient(second, patient_id, patientFile)
+    with open(patientFile + '.lock') as lock:
+        assert int(lock.read()) > 0
+    his.addPatientData(first, 42, '2024-03-02', 37.0, 70, 18, 120, 80, 95, patientFile)
+
+    assert sorted(first) == list(range(31, 41)) + [42]
+    with his._snapshotsDisabled():
+        assert _contents(his.readPatientsFromFile(patientFile)) == _contents(first)
+
+
+def testRewriteDeleteKeepsPlainTextFile(patientFile, monkeypatch):
+    monkeypatch.setattr(his, 'storageMode', 'rewrite')
+    patients = his.readPatientsFromFile(patientFile)
+
+    his.deleteAllVisitsOfPatient(patients, 3, patientFile)
+
+    with open(patientFile) as file:
+        lines = file.read().split("\n")
+    assert len(lines) == 234 and not any(line.startswith(('3,', 'DELETE')) for line in lines)
+
+
+def testLogDeleteAppendsTombstone(patientFile, monkeypatch):
+    monkeypatch.setattr(his, 'storageMode', 'log')
+    patients = his.readPatientsFromFile(patientFile)
+    size = os.path.getsize(patientFile)
+
+    his.deleteAllVisitsOfPatient(patients, 3, patientFile)
+
+    with open(patientFile) as file:
+        file.seek(size)
+        assert file.read() == "\nDELETE,3"
+    with his._snapshotsDisabled():
+        assert _contents(his.readPatientsFromFile(patientFile)) == _contents(patients)
+
+
+def testBackgroundCompactionLeavesStoreInPlace(patientFile, monkeypatch):
+    monkeypatch.setattr(his, 'storageMode', 'log')
+    monkeypatch.setattr(his, 'compactionThresholdBytes', 0)
+    monkeypatch.setattr(his, 'backgroundCompaction', True)
+    patients = his.readPatientsFromFile(patientFile)
+    #Stores changed in place by the compaction thread
+    changed = []
+    for method in ('compact', '_replaceWith'):
+        def record(store, *args, original=getattr(his.VisitStore, method)):
+            if threading.current_thread().name == 'compaction':
+                changed.append(store)
+            return original(store, *args)
+        monkeypatch.setattr(his.VisitStore, method, record)
+
+    for patient_id in range(1, 25):
+        his.deleteAllVisitsOfPatient(patients, patient_id, patientFile)
+        if his._compactionThread is not None:
+            his._compactionThread.join()
+    assert not any(store is patients for store in changed)
+    with open(patientFile + '.lock') as lock:
+        generation = int(lock.read())
+    assert generation > 0 and patients._sourceGeneration == generation
+
+    #The store matched the rewritten file, so the next write does not read it again
+    columns = patients._days
+    his.addPatientData(patients, 42, '2024-03-02', 37.0, 70, 18, 120, 80, 95, patientFile)
+    assert patients._days is columns
+    with his._snapshotsDisabled():
+        assert _contents(his.readPatientsFromFile(patientFile)) == _contents(patients)
+
+
+def testBatchReportsRejectedRecords(patientFile):
+    patients = his.readPatientsFromFile(patientFile)
+    size = os.path.getsize(patientFile)
+    records = [(41, '2024-01-01', 37.0, 70, 18, 120, 80, 95),
+               (42, '2024-01-01', 45.0, 70, 18, 120, 80, 95),
+               (43, '2024-01-01', 37.0, 70),
+               17,
+               ('x', '2024-01-01', 37.0, 70, 18, 120, 80, 95),
+               ('44', '2024-2-30', 37.0, 70, 18, 120, 80, 95),
+               ('45', '2024-2-3', '37.5', '70', '18', '120', '80', '95')]
+
+    result = his.addPatientDataBatch(patients, records, patientFile, 'never')
+
+    assert result['accepted'] == 2
+    assert [(rejected['index'], rejected['record']) for rejected in result['rejected']] == [
+        (index, records[index]) for index in (1, 2, 3, 4, 5)]
+    assert result['rejected'][0]['reason'].startswith("Invalid temperature")
+    assert result['rejected'][1]['reason'] == "Invalid number of fields (4)"
+    assert result['rejected'][2]['reason'] == "Invalid record: expected a list of 8 fields"
+    assert list(patients[45]) == [['2024-02-03', 37.5, 70, 18, 120, 80, 95]]
+    with open(patientFile) as file:
+        file.seek(size)
+        assert file.read() == "\n41,2024-1-1,37.0,70,18,120,80,95\n45,2024-2-3,37.5,70,18,120,80,95"
+    with pytest.raises(ValueError):
+        his.addPatientDataBatch(patients, records, patientFile, 'sometimes')
+
+
+def testIntervalPolicySyncsLastBatch(patientFile, monkeypatch):
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(his.os, 'fsync', lambda descriptor: (synced.append(descriptor), fsync(descriptor)))
+    monkeypatch.setattr(his, 'fsyncIntervalSeconds', 0.2)
+    monkeypatch.setattr(his, '_lastFsync', 0.0)
+    patients = his.readPatientsFromFile(patientFile)
+    synced.clear()
+    record = (41, '2024-01-01', 37.0, 70, 18, 120, 80, 95)
+
+    his.addPatientDataBatch(patients, [record], patientFile, 'interval')
+    assert len(synced) == 1
+    #The next batches come within the interval, so a timer syncs them once it is over
+    his.addPatientDataBatch(patients, [record], patientFile, 'interval')
+    his.addPatientDataBatch(patients, [record], patientFile, 'interval')
+    assert len(synced) == 1 and his._unsyncedFiles
+    timer = his._fsyncTimer
+    timer.join(5)
+
+    assert len(synced) == 2 and not his._unsyncedFiles and his._fsyncTimer is None
+
+
+def testParallelParseMatchesSequential(patientFile, monkeypatch):
+    monkeypatch.setattr(his, 'useSnapshots', False)
+    lines = _visitLines(patients=200, visits=20)
+    lines[7] = "7,2001-02-30,37.0,70,18,120,80,95"
+    lines[400:400] = ["DELETE,13"]
+    _writeLines(patientFile, lines)
+
+    monkeypatch.setattr(his, 'loadWorkers', 1)
+    sequential = his.readPatientsFromFile(patientFile)
+    monkeypatch.setattr(his, 'parallelLoadMinBytes', 0)
+    monkeypatch.setattr(his, 'loadWorkers', 4)
+    parallel = his.readPatientsFromFile(patientFile)
+
+    assert len(his._chunkBoundaries(patientFile, os.path.getsize(patientFile), 4)) > 2
+    assert _contents(parallel) == _contents(sequential)
+    assert parallel.loadReport['rejected'] == sequential.loadReport['rejected'] == 1
+
+
+def testBoundedChunksMatchOneChunk(patientFile, monkeypatch):
+    monkeypatch.setattr(his, 'useSnapshots', False)
+    _writeLines(patientFile, _visitLines(patients=100, visits=10))
+    whole = his.readPatientsFromFile(patientFile)
+    parsed = []
+    parseChunk = his._parseChunk
+    monkeypatch.setattr(his, '_parseChunk', lambda *args: parsed.append(args[2] - args[1]) or parseChunk(*args))
+    monkeypatch.setattr(his, 'loadChunkBytes', 1000)
+
+    chunked = his.readPatientsFromFile(patientFile)
+
+    assert len(parsed) > 30 and max(parsed) < 1100
+    assert _contents(chunked) == _contents(whole)
+
+
+def testRejectsPatientIdOutsideInt64(patientFile, monkeypatch):
+    monkeypatch.setattr(his, 'useSnapshots', False)
+    _appendLines(patientFile, ["99999999999999999999,2022-05-01,37.0,70,18,120,80,95",
+                               "-9223372036854775808,2022-05-01,37.0,70,18,120,80,95"])
+
+    patients = his.readPatientsFromFile(patientFile)
+
+    assert len(patients) == 41 and -2 ** 63 in patients
+    assert patients.loadReport['byReason'] == {'patient id': 1}
+
+
+def testFailedLoadNeverRewritesFile(patientFile, monkeypatch, capsys):
+    monkeypatch.setattr(his, 'useSnapshots', False)
+    monkeypatch.setattr(his, '_parseChunk', lambda *args: 1 / 0)
+    size = os.path.getsize(patientFile)
+
+    patients = his.readPatientsFromFile(patientFile)
+    assert "An unexpected error occurred while reading the file." in capsys.readouterr().out
+    assert len(patients) == 0 and patients._sourceFile is None
+    his.addPatientData(patients, 5, '2024-01-01', 37.0, 70, 18, 120, 80, 95, patientFile)
+    his.deleteAllVisitsOfPatient(patients, 5, patientFile)
+
+    assert os.path.getsize(patientFile) > size
+    monkeypatch.undo()
+    with his._snapshotsDisabled():
+        assert len(his.readPatientsFromFile(patientFile)) == 40
+
+
+def testRejectsSnapshotOfRewrittenFile(patientFile):
+    his.readPatientsFromFile(patientFile)
+    assert os.path.exists(patientFile + his.SNAPSHOT_SUFFIX)
+
+    #Same length, different values, so only the checksum and the inode tell the files apart
+    lines = _visitLines(seed=1)
+    os.remove(patientFile)
+    _writeLines(patientFile, lines)
+    expected = {}
+    for line in lines:
+        expected.setdefault(int(line.split(',')[0]), []).append(_visit(line))
+
+    patients = his.readPatientsFromFile(patientFile)
+
+    assert not patients.loadReport.get('snapshot')
+    assert _contents(patients) == _contents(expected)
+
+
+def testSnapshotReplaysAppendedLines(patientFile):
+    his.readPatientsFromFile(patientFile)
+    _appendLines(patientFile, ["41,2024-03-01,38.5,120,22,150,95,90", "DELETE,1"])
+
+    patients = his.readPatientsFromFile(patientFile)
+
+    assert patients.loadReport.get('snapshot')
+    assert 41 in patients and 1 not in patients
+    with his._snapshotsDisabled():
+        assert _contents(patients) == _contents(his.readPatientsFromFile(patientFile))
+
+
+def testConvertsBetweenTextAndSnapshot(patientFile, tmp_path):
+    snapshot = str(tmp_path / 'copy.snap')
+    text = str(tmp_path / 'copy.txt')
+
+    original = his.convertTextToSnapshot(patientFile, snapshot)
+    loaded, header = his.loadSnapshot(snapshot)
+    his.convertSnapshotToText(snapshot, text)
+
+    assert header['version'] == his.SNAPSHOT_VERSION and header['rowCount'] == 240
+    assert _contents(loaded) == _contents(original)
+    with his._snapshotsDisabled():
+        assert _contents(his.readPatientsFromFile(text)) == _contents(original)
+    with open(snapshot, 'r+b') as file:
+        file.write(b'NOTASNAP')
+    with pytest.raises(ValueError):
+        his.loadSnapshot(snapshot)
+
+
+def testStreamingMatchesLoadedStore(patientFile, monkeypatch):
+    monkeypatch.setattr(his, 'useSnapshots', False)
+    lines = _visitLines(patients=30, visits=6, seed=5)
+    lines[10:10] = ["DELETE,4", "7,2001-02-30,37.0,70,18,120,80,95"]
+    _writeLines(patientFile, lines + ["DELETE,9", "9,2024-01-01,37.0,70,18,120,80,95"])
+    patients = his.readPatientsFromFile(patientFile)
+    report = {}
+
+    streamed = list(his.iterPatientsFromFile(patientFile, report))
+
+    expected = {}
+    for patient_id, visit in streamed:
+        expected.setdefault(patient_id, []).append(visit)
+    assert _contents(patients) == _contents(expected)
+    assert report['rejected'] == patients.loadReport['rejected'] == 1
+    assert report['byReason'] == patients.loadReport['byReason']
+    for year, month in [(2003, None), (None, 5), (2001, 2)]:
+        assert (sorted(his.streamVisitsByDate(streamed, year, month))
+                == sorted((patient_id, list(visit)) for patient_id, visit in his.findVisitsByDate(patients, year, month)))
+    assert sorted(his.streamPatientsWhoNeedFollowUp(iter(streamed))) == sorted(his.findPatientsWhoNeedFollowUp(patients))
+    stats = his.streamStats(iter(streamed))
+    _assertStatsEqual(stats, his.computeStats(patients, percentiles=()))
+
+
+def testStreamingReadsLazily(patientFile):
+    records = his.iterPatientsFromFile(patientFile)
+
+    assert next(records) == (1, _visit(_visitLines()[0]))
+    assert list(his.streamVisitsByDate(iter([]), 2020)) == []
+    assert his.streamStats(iter([]))['temperature']['count'] == 0
+
+
+def _ruleStore(rows):
+    #Store of (patientId, date, heart rate) visits with the other vitals normal
+    store = his.VisitStore()
+    for patient_id, date, heart_rate in rows:
+        store.appendVisit(patient_id, date, 37.0, heart_rate, 18, 120, 80, 95)
+    return store
+
+
+def _records(store):
+    return [(patient_id, list(visit)) for patient_id, visits in store.items() for visit in visits]
+
+
+def testFollowUpRuleWindows():
+    low = {'vital': 'heart_rate', 'op': '<', 'value': 60}
+    store = _ruleStore([
+        #Latest visit low, although it was added first
+        (1, '2024-06-01', 50), (1, '2024-01-01', 70),
+        #Only an old visit low
+        (2, '2023-01-01', 50), (2, '2024-01-01', 70), (2, '2024-06-01', 70),
+        #Two of the last three low
+        (3, '2022-01-01', 70), (3, '2023-01-01', 50), (3, '2024-01-01', 70), (3, '2024-06-01', 55),
+        #Two low, but only one of them among the last three
+        (4, '2021-01-01', 50), (4, '2022-01-01', 70), (4, '2023-01-01', 70), (4, '2024-01-01', 55),
+    ])
+    expected = {'any': [1, 2, 3, 4], 'latest': [1, 3, 4], 'recent': [3]}
+
+    for name, window in [('any', 'any'), ('latest', 'latest'), ('recent', {'n': 2, 'of': 3})]:
+        rules = his.FollowUpRules({'rules': [{'when': low, 'visits': window}]})
+        assert sorted(his.findPatientsWhoNeedFollowUp(store, rules)) == expected[name]
+        assert sorted(his.streamPatientsWhoNeedFollowUp(_records(store), rules)) == expected[name]
+
+
+def testFollowUpConditionsCombine():
+    store = _ruleStore([(1, '2024-01-01', 50), (2, '2024-01-01', 170), (3, '2024-01-01', 70)])
+    low = {'vital': 'heart_rate', 'op': '<', 'value': 60}
+    high = {'vital': 'heart_rate', 'op': '>=', 'value': 170}
+    normal_spo2 = {'vital': 'oxygen_saturation', 'op': '==', 'value': 95}
+
+    either = his.FollowUpRules({'rules': [{'when': {'any': [low, high]}}]})
+    both = his.FollowUpRules({'rules': [{'when': {'all': [high, normal_spo2]}}]})
+    assert his.findPatientsWhoNeedFollowUp(store, either) == [1, 2]
+    assert his.findPatientsWhoNeedFollowUp(store, both) == [2]
+    assert his.findPatientsWhoNeedFollowUp(store) == [1]
+
+    #The cached result of a patient is dropped when the patient gets a visit
+    store.appendVisit(3, '2024-02-01', 37.0, 40, 18, 120, 80, 95)
+    assert his.findPatientsWhoNeedFollowUp(store, either) == [1, 2, 3]
+
+
+@pytest.mark.parametrize('config', [
+    {}, {'rules': [{'when': []}]}, {'rules': [{'when': {'vital': 'pulse', 'op': '<', 'value': 1}}]},
+    {'rules': [{'when': {'any': []}}]}, {'rules': [{'when': {'vital': 'heart_rate', 'op': '=~', 'value': 1}}]},
+    {'rules': [{'when': {'vital': 'heart_rate', 'op': '<', 'value': 1}, 'visits': {'n': 3, 'of': 2}}]},
+])
+def testInvalidFollowUpRulesRaiseValueError(config):
+    with pytest.raises(ValueError):
+        his.FollowUpRules(config)
+
+
+def testStreamingFollowUpMatchesStoreOnRandomRules():
+    generator = random.Random(6)
+    for _ in range(50):
+        store = _ruleStore([(generator.randint(1, 8), f"2024-{generator.randint(1, 3)}-{generator.randint(1, 3)}",
+                             generator.randint(40, 100)) for _ in range(40)])
+        window = generator.choice(['any', 'latest', {'n': generator.randint(1, 2), 'of': generator.randint(2, 4)}])
+        rules = his.FollowUpRules({'rules': [{'when': {'vital': 'heart_rate', 'op': '<', 'value': 60}, 'visits': window}]})
+        assert (sorted(his.streamPatientsWhoNeedFollowUp(_records(store), rules))
+                == sorted(his.findPatientsWhoNeedFollowUp(store, rules)))
+
+
+def testFollowUpCommandReportsBadRulesFile(patientFile, tmp_path, capsys):
+    rules = tmp_path / 'rules.json'
+    rules.write_text(json.dumps({'rules': [{'when': {'vital': 'heart_rate', 'op': '>', 'value': 125}}]}))
+
+    assert his.cliMain(['--file', patientFile, 'followup', '--rules', str(tmp_path / 'missing.json')]) == 0
+    assert "Could not load the follow-up rules" in capsys.readouterr().out
+    assert his.cliMain(['--file', patientFile, 'followup', '--rules', str(rules)]) == 0
+    assert capsys.readouterr().out.startswith("Patients who need follow-up visits:")
+
+
+def _baselinePatientText(patients, patientIds):
+    #The listing displayPatientData printed before the renderers were added
+    text = ""
+    for patient_id in patientIds:
+        text += f"Patient ID: {patient_id}\n"
+        for visit in patients[patient_id]:
+            text += (f"  Visit Date: {visit[0]}\n    Temperature: {visit[1]} C\n    Heart Rate: {visit[2]} bpm\n"
+                     f"    Respiratory Rate: {visit[3]} bpm\n    Systolic Blood Pressure: {visit[4]} mmHg\n"
+                     f"    Diastolic Blood Pressure: {visit[5]} mmHg\n    Oxygen Saturation: {visit[6]} %\n\n")
+    return text
+
+
+def _baselineVisitText(visits):
+    #The listing of the find visits by date menu option before the renderers were added
+    text = ""
+    for patient_id, visit in visits:
+        text += (f"Patient ID: {patient_id}\n Visit Date: {visit[0]}\n  Temperature: {'%.2f' % visit[1]} C\n"
+                 f"  Heart Rate: {visit[2]} bpm\n  Respiratory Rate: {visit[3]} bpm\n"
+                 f"  Systolic Blood Pressure: {visit[4]} mmHg\n  Diastolic Blood Pressure: {visit[5]} mmHg\n"
+                 f"  Oxygen Saturation: {visit[6]} %\n")
+    return text
+
+
+def testTextRenderersMatchBaselineListing(patientFile, capsys):
+    patients = his.readPatientsFromFile(patientFile)
+    capsys.readouterr()
+
+    his.displayPatientData(patients)
+    assert capsys.readouterr().out == _baselinePatientText(patients, list(patients))
+    his.displayPatientData(patients, 7)
+    assert capsys.readouterr().out == _baselinePatientText(patients, [7])
+    his.displayPatientData(patients, 99)
+    assert capsys.readouterr().out == "Patient with ID 99 not found.\n"
+
+    visits = his.findVisitsByDate(patients, 2001)
+    his.displayVisits(visits)
+    assert capsys.readouterr().out == _baselineVisitText(visits)
+
+
+def testMachineReadableFormatsAndPaging(patientFile, capsys, monkeypatch):
+    patients = his.readPatientsFromFile(patientFile)
+    rows = list(his.iterVisitRows(patients))
+    capsys.readouterr()
+
+    his.displayPatientData(patients, format='csv', limit=5, offset=3)
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == ",".join(his.CSV_HEADER)
+    assert lines[1:] == [f"{patient_id},{','.join(map(str, visit))}" for patient_id, visit in rows[3:8]]
+
+    his.displayPatientData(patients, 7, format='jsonl')
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert records == [dict(zip(his.CSV_HEADER, [7] + list(visit))) for visit in patients[7]]
+
+    #Paging stops when the user answers q after the first page
+    monkeypatch.setattr(his, 'RENDER_BUFFER_ROWS', 2)
+    monkeypatch.setattr('builtins.input', lambda prompt: 'q')
+    assert his.renderVisits(rows, format='csv', pageSize=4) == 4
+    assert len(capsys.readouterr().out.splitlines()) == 5
+    with pytest.raises(ValueError):
+        his.renderVisits(rows, format='xml')
+
+
+def testCliQueriesMatchLibrary(patientFile, capsys):
+    patients = his.readPatientsFromFile(patientFile)
+    capsys.readouterr()
+
+    assert his.cliMain(['--file', patientFile, 'show', '--patient', '3', '--format', 'csv', '--limit', '2']) == 0
+    assert capsys.readouterr().out.splitlines()[1:] == [f"3,{','.join(map(str, visit))}" for visit in patients[3][:2]]
+    assert his.cliMain(['--file', patientFile, 'stats', '--patient', '3', '--json']) == 0
+    assert json.loads(capsys.readouterr().out) == json.loads(json.dumps(his.computeStats(patients, 3)))
+    assert his.cliMain(['--file', patientFile, 'visits', '--year', '2001', '--format', 'jsonl']) == 0
+    assert len(capsys.readouterr().out.splitlines()) == len(his.findVisitsByDate(patients, 2001))
+    assert his.cliMain(['--file', patientFile, 'visits', '--year', '1990']) == 0
+    assert capsys.readouterr().out == "No visits found for the specified year/month.\n"
+
+
+def testCliAddAndDelete(patientFile, capsys):
+    assert his.cliMain(['--file', patientFile, 'add', '41', '2024-05-01', '37.1', '70', '16', '120', '80', '97']) == 0
+    assert capsys.readouterr().out == "Visit saved for Patient # 41\n"
+    assert his.cliMain(['--file', patientFile, 'delete', '41']) == 0
+    assert capsys.readouterr().out == "Deleted all visits of Patient # 41\n"
+    assert 41 not in his.readPatientsFromFile(patientFile)
+
+    assert his.cliMain(['--file', patientFile, 'delete', '41']) == 1
+    assert capsys.readouterr().out == "Patient with ID 41 not found.\n"
+
+
+def testCliDeleteReportsFailedRewrite(patientFile, monkeypatch, capsys):
+    def failingRewrite(patients, fileName):
+        raise OSError("disk full")
+    monkeypatch.setattr(his, 'storageMode', 'rewrite')
+    monkeypatch.setattr(his, 'compactPatientFile', failingRewrite)
+
+    assert his.cliMain(['--file', patientFile, 'delete', '5']) == 1
+    output = capsys.readouterr().out
+    assert "could not be deleted" in output and "Deleted all visits" not in output
+    monkeypatch.undo()
+    assert 5 in his.readPatientsFromFile(patientFile)
+
+
+def testCliImportReportsLineNumbers(patientFile, tmp_path, capsys):
+    source = tmp_path / 'import.csv'
+    source.write_text("41,2024-05-01,37.1,70,16,120,80,97\n\n41,2024-13-01,37.1,70,16,120,80,97\n"
+                      "42,2024-05-02,37.2,71,16,121,81,98\n")
+
+    assert his.cliMain(['--file', patientFile, 'import', str(source)]) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == "Imported 2 visit(s), rejected 1."
+    assert lines[1].startswith("  line 3: ")
+
+
+def testCliBatchSkipsServeAndMigrate(patientFile, tmp_path, capsys):
+    queries = tmp_path / 'queries.txt'
+    queries.write_text("# queries\nstats --patient 2 --json\n\nserve\nmigrate --shards 2\nbatch other.txt\nshow --bogus\n")
+
+    assert his.cliMain(['--file', patientFile, '--timing', 'batch', str(queries)]) == 0
+    captured = capsys.readouterr()
+    assert "'serve' on line 4 is not allowed in a batch." in captured.out
+    assert "'migrate' on line 5 is not allowed in a batch." in captured.out
+    assert "Nested batch on line 6 is not allowed." in captured.out
+    assert "Invalid query on line 7: show --bogus" in captured.out
+    #The usage message of the invalid query goes to stderr as well
+    timing = [line for line in captured.err.splitlines() if line.startswith(('load: ', 'line ', 'total: '))]
+    assert timing[0].startswith("load: ") and timing[1].startswith("line 2: stats --patient 2 --json: query ")
+    assert timing[-1].startswith("total: load ") and len(timing) == 3
+    assert not os.path.exists(his.shardDirectory(patientFile))
+
+
+def testWriterCatchesUpWithOtherWriter(patientFile):
+    first = his.readPatientsFromFile(patientFile)
+    second = his.readPatientsFromFile(patientFile)
+
+    his.addPatientData(second, 41, '2024-03-01', 38.5, 120, 22, 150, 95, 90, patientFile)
+    his.deleteAllVisitsOfPatient(second, 2, patientFile)
+    his.addPatientData(first, 42, '2024-03-02', 37.0, 70, 18, 120, 80, 95, patientFile)
+
+    assert 41 in first and 2 not in first
+    assert _contents(first) == _contents(second) | {42: _contents(first)[42]}
+    with his._snapshotsDisabled():
+        assert _contents(his.readPatientsFromFile(patientFile)) == _contents(first)
+
+
+def testLockRefusesUpgradeAndReadsWithoutLockFile(patientFile):
+    with his._patientFileLock(patientFile, exclusive=False) as lock:
+        assert lock is None
+    assert not os.path.exists(patientFile + '.lock')
+
+    with his._patientFileLock(patientFile, exclusive=True) as lock:
+        with his._patientFileLock(patientFile, exclusive=False) as nested:
+            assert nested is lock
+    with his._patientFileLock(patientFile, exclusive=False) as lock:
+        assert lock is not None
+        with pytest.raises(RuntimeError):
+            with his._patientFileLock(patientFile, exclusive=True):
+                pass
+
+
+def _addVisits(fileName, patientId, count):
+    #Writer process of testConcurrentWritersKeepEveryVisit
+    patients = his.readPatientsFromFile(fileName)
+    for day in range(1, count + 1):
+        his.addPatientData(patients, patientId, f"2024-01-{day}", 37.0, 70, 18, 120, 80, 95, fileName)
+
+
+def testConcurrentWritersKeepEveryVisit(patientFile, capsys):
+    writers = [multiprocessing.Process(target=_addVisits, args=(patientFile, patient_id, 20)) for patient_id in (41, 42, 43)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join(60)
+        assert writer.exitcode == 0
+
+    with his._snapshotsDisabled():
+        patients = his.readPatientsFromFile(patientFile)
+    assert [len(patients[patient_id]) for patient_id in (41, 42, 43)] == [20, 20, 20]
+    assert patients.visitCount() == 300
+
+
+def _serve(fileName, requests):
+    #Answers of a PatientService on a free local port to (method, target, JSON body) requests, sent one by one
+    async def run():
+        service = his.PatientService(fileName)
+        ready = asyncio.get_running_loop().create_future()
+        task = asyncio.create_task(service.serve('127.0.0.1', 0, ready.set_result))
+        port = (await ready).sockets[0].getsockname()[1]
+        answers = []
+        try:
+            for method, target, body in requests:
+                payload = b'' if body is None else json.dumps(body).encode()
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(f"{method} {target} HTTP/1.1\r\nContent-Length: {len(payload)}\r\n\r\n".encode() + payload)
+                head, _, answer = (await reader.read()).partition(b'\r\n\r\n')
+                writer.close()
+                status = int(head.split()[1])
+                answers.append((status, json.loads(answer) if b'application/json' in head else answer.decode()))
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        return service, answers
+    return asyncio.run(run())
+
+
+def testServiceRoutesMatchLibrary(patientFile):
+    single = his.readPatientsFromFile(patientFile)
+    service, answers = _serve(patientFile, [
+        ('GET', '/stats', None), ('GET', '/stats?patientId=4', None), ('GET', '/stats?patientId=99', None),
+        ('GET', '/visits?year=2001&month=6', None), ('GET', '/visits?from=2001-01-01&to=2002-06-30', None),
+        ('GET', '/followup', None), ('GET', '/trends?patientId=4', None), ('GET', '/trends', None),
+        ('GET', '/metrics', None), ('GET', '/nothing', None),
+    ])
+
+    def visits(found):
+        return {'visits': [his._visitJson(patient_id, visit) for patient_id, visit in found]}
+    assert answers[0] == (200, json.loads(json.dumps(his.computeStats(single))))
+    assert answers[1] == (200, json.loads(json.dumps(his.computeStats(single, 4))))
+    assert answers[2][0] == 404
+    assert answers[3] == (200, visits(his.findVisitsByDate(single, 2001, 6)))
+    assert answers[4] == (200, visits(his.findVisitsByDateRange(single, '2001-01-01', '2002-06-30')))
+    assert answers[5] == (200, {'patients': his.findPatientsWhoNeedFollowUp(single)})
+    assert answers[6] == (200, json.loads(json.dumps(his.computeTrends(single, 4))))
+    assert answers[7] == (200, json.loads(json.dumps({'deteriorating': his.findPatientsWithDeterioration(single)})))
+    assert answers[8][0] == 200 and isinstance(answers[8][1], str)
+    assert answers[9][0] == 404
+
+
+def testServiceWritesAndRejectsBadInput(patientFile):
+    visit = {'patientId': 41, 'date': '2024-03-01', 'temp': 38.5, 'hr': 120, 'rr': 22, 'sbp': 150, 'dbp': 95, 'spo2': 90}
+    service, answers = _serve(patientFile, [
+        ('GET', '/stats', None), ('POST', '/visits', [visit, dict(visit, date='2024-02-30')]),
+        ('GET', '/stats', None), ('DELETE', '/patients/2', None), ('DELETE', '/patients/2', None),
+        ('GET', '/visits?from=2024-13-01', None), ('GET', '/visits?from=2001-01-01&to=2001-02-30', None),
+        ('GET', '/visits?month=13', None), ('GET', '/stats?patientId=x', None), ('POST', '/visits', {'patientId': 41}),
+    ])
+
+    assert answers[1][0] == 201 and answers[1][1]['accepted'] == 1 and answers[1][1]['rejected'][0]['index'] == 1
+    #The cached statistics are dropped by the write
+    assert answers[2][1]['temperature']['count'] == answers[0][1]['temperature']['count'] + 1
+    assert answers[3] == (200, {'deleted': 2})
+    assert answers[4][0] == 404
+    assert [status for status, _ in answers[5:]] == [400, 400, 400, 400, 400]
+    assert "'from'" in answers[5][1]['error'] and "'to'" in answers[6][1]['error']
+    with his._snapshotsDisabled():
+        assert _contents(his.readPatientsFromFile(patientFile)) == _contents(service.patients)
+
+
+@pytest.fixture
+def instrumented():
+    #Instrumentation enabled for one test, with the plain functions put back afterwards
+    yield his.enableInstrumentation()
+    his.disableInstrumentation()
+
+
+def testInstrumentationCountsRowsAndCalls(patientFile, instrumented, monkeypatch):
+    monkeypatch.setattr(his, 'useSnapshots', False)
+    _appendLines(patientFile, ["7,2001-02-30,37.0,70,18,120,80,95"])
+
+    patients = his.readPatientsFromFile(patientFile)
+    size = os.path.getsize(patientFile)
+    his.addPatientData(patients, 41, '2024-03-01', 38.5, 120, 22, 150, 95, 90, patientFile)
+    with pytest.raises(KeyError):
+        his.computeStats(patients, 99)
+
+    counters = instrumented.counters
+    assert counters[('his_rows_read_total', (('source', 'text'),))] == 240
+    assert counters[('his_rows_rejected_total', (('reason', 'date'),))] == 1
+    assert counters[('his_errors_total', (('function', 'computeStats'),))] == 1
+    assert counters[('his_bytes_written_total', (('file', 'data'),))] == os.path.getsize(patientFile) - size
+    assert instrumented.histograms[('his_call_seconds', (('function', 'readPatientsFromFile'),))][2] == 1
+    assert instrumented.histograms[('his_phase_seconds', (('phase', 'read.parse'),))][2] >= 1
+
+
+def testPrometheusTextFormat():
+    metrics = his.Instrumentation()
+    metrics.count('his_errors_total', function='show "all"')
+    for seconds in (0.00005, 0.003, 20.0):
+        metrics.observe('his_call_seconds', seconds, function='computeStats')
+
+    lines = metrics.prometheusText().splitlines()
+
+    assert lines[:2] == ['# TYPE his_errors_total counter', 'his_errors_total{function="show \\"all\\""} 1']
+    assert lines[2] == '# TYPE his_call_seconds histogram'
+    buckets = {line.split('le="')[1].split('"')[0]: int(line.split()[-1]) for line in lines if '_bucket' in line}
+    assert buckets['0.0001'] == 1 and buckets['0.001'] == 1 and buckets['0.005'] == 2 and buckets['10.0'] == 2
+    assert buckets['+Inf'] == 3
+    assert lines[-1] == 'his_call_seconds_count{function="computeStats"} 3'
+    assert his.Instrumentation().prometheusText() == ""
+
+
+def testDisablingInstrumentationRestoresFunctions():
+    plain = his.computeStats
+    assert his.metricsText() == ""
+
+    his.enableInstrumentation()
+    try:
+        assert his.computeStats is not plain and his.computeStats.__wrapped__ is plain
+        assert his.enableInstrumentation() is his.instrumentation
+    finally:
+        his.disableInstrumentation()
+
+    assert his.computeStats is plain and his.instrumentation is None
+    assert his._phase('read.parse') is his._NO_PHASE
+
+
+def testProfileOperationReportsTimeAndMemory():
+    out = io.StringIO()
+
+    assert his.profileOperation(sorted, [3, 1, 2], out=out, limit=5, reverse=True) == [3, 2, 1]
+    assert "function calls" in out.getvalue() and "Peak traced memory" in out.getvalue()
+
+
+def _naiveTrend(visits, name, window):
+    #Moving average, deltas and yearly slope of one vital, from the visits in date order
+    visits = sorted(visits, key=lambda visit: his.parseVisitDate(visit[0]))
+    values = [visit[1 + his.VITAL_NAMES.index(name)] for visit in visits]
+    days = [his.parseVisitDate(visit[0]) for visit in visits]
+    averages = [statistics.fmean(values[max(0, position - window + 1):position + 1]) for position in range(len(values))]
+    slope = statistics.linear_regression(days, values).slope * 365.25 if len(set(days)) > 1 else None
+    return averages, [b - a for a, b in zip(values, values[1:])], slope
+
+
+def testTrendsMatchNaiveComputation():
+    store = his.VisitStore()
+    for line in _visitLines(patients=6, visits=7, seed=4):
+        store.appendVisit(int(line.split(',')[0]), *_visit(line))
+
+    for window in (1, 2, 3):
+        trends = his.computeTrends(store, 0, window)
+        assert sorted(trends) == list(range(1, 7))
+        for patient_id, patient in trends.items():
+            assert patient['dates'] == sorted((visit[0] for visit in store[patient_id]), key=his.parseVisitDate)
+            for name in his.VITAL_NAMES:
+                averages, deltas, slope = _naiveTrend(store[patient_id], name, window)
+                vital = patient['vitals'][name]
+                assert vital['movingAverage'] == pytest.approx(averages)
+                assert vital['deltas'] == pytest.approx(deltas)
+                assert vital['slopePerYear'] == pytest.approx(slope)
+    with pytest.raises(ValueError):
+        his.computeTrends(store, 0, 0)
+    with pytest.raises(KeyError):
+        his.computeTrends(store, 99)
+
+
+def testDeteriorationFlagsFollowThresholdsAndChanges():
+    store = his.VisitStore()
+    for day, temp, hr, spo2 in (('2024-01-01', 37.0, 70, 97), ('2024-02-01', 37.2, 72, 97), ('2024-03-01', 37.1, 74, 96)):
+        store.appendVisit(1, day, temp, hr, 16, 120, 80, spo2)
+        store.appendVisit(2, day, temp, hr, 16, 120, 80, spo2)
+    #Heart rate 20 above and oxygen more than 4 below the average of the visits before, and just short of it
+    store.appendVisit(1, '2024-04-01', 37.3, 92, 16, 120, 80, 92)
+    store.appendVisit(2, '2024-04-01', 37.3, 91, 16, 120, 80, 93)
+
+    assert his.findPatientsWithDeterioration(store) == {1: ['heart_rate', 'oxygen_saturation']}
+    assert his.computeTrends(store, 2)['deteriorating'] == []
+
+    #A later visit of patient 2 replaces the cached trends; an early one does not count as the latest
+    store.appendVisit(2, '2023-12-01', 41.0, 150, 30, 200, 80, 80)
+    assert his.computeTrends(store, 2)['deteriorating'] == []
+    store.appendVisit(2, '2024-05-01', 39.0, 90, 16, 120, 80, 97)
+    assert his.computeTrends(store, 2)['dates'][-1] == '2024-05-01'
+    assert his.findPatientsWithDeterioration(store) == {1: ['heart_rate', 'oxygen_saturation'], 2: ['temperature']}
+    store.deletePatient(1)
+    assert his.findPatientsWithDeterioration(store) == {2: ['temperature']}
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def testShardedQueriesMatchSingleFile(patientFile, monkeypatch, workers):
+    monkeypatch.setattr(his, 'shardWorkers', workers)
+    single = his.readPatientsFromFile(patientFile)
+    his.migrateToShards(patientFile, 4)
+    sharded = his.readPatientsFromFile(patientFile)
+
+    assert isinstance(sharded, his.ShardedPatients)
+    assert _contents(sharded) == _contents(single)
+    assert his.computeStats(sharded) == his.computeStats(single)
+    assert his.computeStats(sharded, 5) == his.computeStats(single, 5)
+    assert his.computeStatsByPatient(sharded) == his.computeStatsByPatient(single)
+    assert _inDateOrder(his.findVisitsByDate(sharded, 2003)) == _inDateOrder(his.findVisitsByDate(single, 2003))
+    assert _inDateOrder(his.findVisitsByDate(sharded, None, 6)) == _inDateOrder(his.findVisitsByDate(single, None, 6))
+    assert (_inDateOrder(his.findVisitsByDateRange(sharded, '2001-01-01', '2002-06-30'))
+            == _inDateOrder(his.findVisitsByDateRange(single, '2001-01-01', '2002-06-30')))
+    assert sorted(his.findPatientsWhoNeedFollowUp(sharded)) == sorted(his.findPatientsWhoNeedFollowUp(single))
+    assert his.computeTrends(sharded) == his.computeTrends(single)
+    assert his.findPatientsWithDeterioration(sharded) == his.findPatientsWithDeterioration(single)
+
+
+def testMigratesToShardsAndBack(patientFile):
+    with his._snapshotsDisabled():
+        original = _contents(his.readPatientsFromFile(patientFile))
+
+    assert his.migrateToShards(patientFile, 3) == 240
+    assert os.path.exists(patientFile + '.unsharded') and not os.path.exists(patientFile)
+    sharded = his.readPatientsFromFile(patientFile)
+    his.addPatientData(sharded, 41, '2024-03-01', 38.5, 120, 22, 150, 95, 90, patientFile)
+    his.deleteAllVisitsOfPatient(sharded, 2, patientFile)
+    expected = {patient_id: visits for patient_id, visits in original.items() if patient_id != 2}
+    expected[41] = [['2024-03-01', 38.5, 120, 22, 150, 95, 90]]
+
+    #Changing the number of shards, then merging them back into one file
+    assert his.migrateToShards(patientFile, 5) == 235
+    assert _contents(his.readPatientsFromFile(patientFile)) == expected
+    assert his.migrateToShards(patientFile, 0) == 235
+
+    assert not os.path.exists(his.shardDirectory(patientFile))
+    with his._snapshotsDisabled():
+        merged = his.readPatientsFromFile(patientFile)
+    assert not isinstance(merged, his.ShardedPatients)
+    assert _contents(merged) == expected
+
+
+def testConcurrentShardedQueriesShareWorkerPools(patientFile, monkeypatch):
+    single = his.readPatientsFromFile(patientFile)
+    expected = his.computeStats(single)
+    his.migrateToShards(patientFile, 4)
+    sharded = his.readPatientsFromFile(patientFile)
+    his._closeShardPools()
+    start = threading.Barrier(9)
+    results, errors = [], []
+
+    def query():
+        start.wait()
+        try:
+            for _ in range(3):
+                results.append(his.computeStats(sharded))
+        except Exception as error:
+            errors.append(error)
+
+    #The first queries race to create the pools while the pool count keeps changing under them
+    threads = [threading.Thread(target=query) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    for workers in (3, 2, 3, 2, 3):
+        monkeypatch.setattr(his, 'shardWorkers', workers)
+    for thread in threads:
+        thread.join(120)
+
+    assert errors == []
+    assert len(results) == 24 and all(result == expected for result in results)
+    assert 2 <= len(his._shardPools) <= 3